@@ -0,0 +1,232 @@
+# accounting.py
+#
+# Per-request accounting of OpenAI tokens (from each completion's usage,
+# cached prompt tokens included) and
+# Shopify query cost (requestedQueryCost/actualQueryCost from each GraphQL
+# response's extensions), attributed to the request's intent and call site
+# or operation. Usage is recorded where the upstream call is actually made,
+# so a coalesced call is counted once, for the request that made it, and a
+# retried one as often as it was sent; of a hedged call's attempts only the
+# one whose answer is used counts.
+#
+# Each request also has budgets (REQUEST_TOKEN_BUDGET, REQUEST_SHOPIFY_COST_BUDGET;
+# 0 disables). Once a budget is spent, further calls to that upstream raise
+# BudgetExceeded, an UpstreamUnavailable, so callers take the paths they
+# already have for an unavailable upstream: keyword intent extraction, local
+# title matching and plain-text answers instead of the LLM; cached or
+# snapshot data instead of Shopify.
+
+import os
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from metrics import record_request_usage, record_budget_exceeded, record_prompt_tokens
+from resilience import UpstreamUnavailable, note_upstream_failure
+
+REQUEST_TOKEN_BUDGET = int(os.getenv("REQUEST_TOKEN_BUDGET", "8000"))
+REQUEST_SHOPIFY_COST_BUDGET = int(os.getenv("REQUEST_SHOPIFY_COST_BUDGET", "1000"))
+
+
+class BudgetExceeded(UpstreamUnavailable):
+    """The request has spent its token or Shopify cost budget"""
+
+
+class RequestUsage:
+    """Tokens and query cost of one request; speculative and batch threads add to it concurrently"""
+
+    def __init__(self, token_budget=None, shopify_cost_budget=None):
+        self.intent = "unknown"
+        self.token_budget = REQUEST_TOKEN_BUDGET if token_budget is None else token_budget
+        self.shopify_cost_budget = REQUEST_SHOPIFY_COST_BUDGET if shopify_cost_budget is None else shopify_cost_budget
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        # Prompt tokens the provider served from its prompt cache (part of prompt_tokens)
+        self.cached_tokens = 0
+        self.requested_cost = 0
+        self.actual_cost = 0
+        # call site -> [prompt, completion, cached]; operation -> [requested, actual]
+        self.llm = {}
+        self.shopify = {}
+        self.exceeded = set()
+        # Usage of nested blocks (a batch's questions), shown in the totals but recorded under their own intents
+        self.children = []
+        self.lock = threading.Lock()
+
+    @property
+    def tokens(self):
+        return self.prompt_tokens + self.completion_tokens
+
+    def add_llm(self, call_site, prompt_tokens, completion_tokens, cached_tokens=0):
+        with self.lock:
+            self.prompt_tokens += prompt_tokens
+            self.completion_tokens += completion_tokens
+            self.cached_tokens += cached_tokens
+            counts = self.llm.setdefault(call_site, [0, 0, 0])
+            counts[0] += prompt_tokens
+            counts[1] += completion_tokens
+            counts[2] += cached_tokens
+
+    def add_shopify(self, operation, requested, actual):
+        with self.lock:
+            self.requested_cost += requested
+            self.actual_cost += actual
+            costs = self.shopify.setdefault(operation, [0, 0])
+            costs[0] += requested
+            costs[1] += actual
+
+    def add_usage(self, other):
+        """Add in what another block (e.g. a hedge race's winning attempt) spent"""
+        with other.lock:
+            llm = {site: list(counts) for site, counts in other.llm.items()}
+            shopify = {operation: list(costs) for operation, costs in other.shopify.items()}
+        for call_site, (prompt_tokens, completion_tokens, cached_tokens) in llm.items():
+            self.add_llm(call_site, prompt_tokens, completion_tokens, cached_tokens)
+        for operation, (requested, actual) in shopify.items():
+            self.add_shopify(operation, requested, actual)
+
+    def add_child(self, child):
+        with self.lock:
+            self.children.append(child)
+
+    def totals(self):
+        """(prompt tokens, completion tokens, cached prompt tokens, requested cost, actual cost,
+        budgets exceeded), nested blocks included"""
+        with self.lock:
+            children = list(self.children)
+            totals = [self.prompt_tokens, self.completion_tokens, self.cached_tokens, self.requested_cost,
+                      self.actual_cost, set(self.exceeded)]
+        for child in children:
+            *numbers, exceeded = child.totals()
+            for position, number in enumerate(numbers):
+                totals[position] += number
+            totals[-1] |= exceeded
+        return tuple(totals)
+
+    def check(self, budget, spent, limit):
+        if limit > 0 and spent >= limit:
+            with self.lock:
+                first = budget not in self.exceeded
+                self.exceeded.add(budget)
+            if first:
+                record_budget_exceeded(budget)
+            # The answer comes from a cheaper path, so it is not cached as if it were the full one
+            note_upstream_failure()
+            raise BudgetExceeded(f"request {budget} budget of {limit} spent")
+
+    def headers(self):
+        prompt_tokens, completion_tokens, cached_tokens, requested_cost, actual_cost, exceeded = self.totals()
+        headers = {
+            "X-Request-Intent": self.intent,
+            "X-LLM-Prompt-Tokens": str(prompt_tokens),
+            "X-LLM-Cached-Prompt-Tokens": str(cached_tokens),
+            "X-LLM-Completion-Tokens": str(completion_tokens),
+            "X-Shopify-Requested-Cost": str(requested_cost),
+            "X-Shopify-Actual-Cost": str(actual_cost),
+        }
+        if exceeded:
+            headers["X-Budget-Exceeded"] = ",".join(sorted(exceeded))
+        return headers
+
+
+class SessionUsage:
+    """Running totals for one conversation, kept in its state"""
+
+    __slots__ = ("requests", "tokens", "shopify_cost")
+
+    def __init__(self):
+        self.requests = 0
+        self.tokens = 0
+        self.shopify_cost = 0
+
+    def add(self, usage):
+        prompt_tokens, completion_tokens, _, _, actual_cost, _ = usage.totals()
+        self.requests += 1
+        self.tokens += prompt_tokens + completion_tokens
+        self.shopify_cost += actual_cost
+
+    def headers(self):
+        return {
+            "X-Session-Requests": str(self.requests),
+            "X-Session-LLM-Tokens": str(self.tokens),
+            "X-Session-Shopify-Cost": str(self.shopify_cost),
+        }
+
+
+_current_usage = contextvars.ContextVar("current_usage", default=None)
+
+
+@contextmanager
+def track_usage(session_usage=None):
+    """Account for the upstream calls made inside this block, with budgets of its own;
+    a nested block's usage also shows in the enclosing one's totals"""
+    usage = RequestUsage()
+    parent = _current_usage.get()
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+        record_request_usage(usage)
+        if parent is not None:
+            parent.add_child(usage)
+        if session_usage is not None:
+            session_usage.add(usage)
+
+
+@contextmanager
+def separate_usage():
+    """Count the upstream calls made inside this block apart from the request's, which
+    only gets them through add_usage (a hedged call counts its winning attempt only)"""
+    usage = RequestUsage(token_budget=0, shopify_cost_budget=0)
+    token = _current_usage.set(usage)
+    try:
+        yield usage
+    finally:
+        _current_usage.reset(token)
+
+
+def current_usage():
+    return _current_usage.get()
+
+
+def set_intent(intent):
+    """Attribute the current request's usage to an intent type (the last one set wins)"""
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.intent = intent
+
+
+def check_llm_budget():
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.check("tokens", usage.tokens, usage.token_budget)
+
+
+def check_shopify_budget():
+    usage = _current_usage.get()
+    if usage is not None:
+        usage.check("shopify_cost", usage.actual_cost, usage.shopify_cost_budget)
+
+
+def record_llm_usage(call_site, response, prompt=None):
+    """Count a completion's tokens for the request, and its prompt cache use under prompt (name@version)"""
+    usage = _current_usage.get()
+    tokens = getattr(response, "usage", None)
+    if tokens is None:
+        return
+    prompt_tokens = tokens.prompt_tokens or 0
+    cached_tokens = getattr(getattr(tokens, "prompt_tokens_details", None), "cached_tokens", None) or 0
+    record_prompt_tokens(prompt or call_site, prompt_tokens, cached_tokens)
+    if usage is not None:
+        usage.add_llm(call_site, prompt_tokens, tokens.completion_tokens or 0, cached_tokens)
+
+
+def record_shopify_usage(operation, result):
+    usage = _current_usage.get()
+    cost = (result.get("extensions") or {}).get("cost") or {}
+    if usage is not None and cost:
+        requested = int(cost.get("requestedQueryCost") or 0)
+        # Shopify refunds the difference once the query has run, so actual cost is what the budget counts
+        actual = int(cost.get("actualQueryCost") if cost.get("actualQueryCost") is not None else requested)
+        usage.add_shopify(operation, requested, actual)
@@ -0,0 +1,76 @@
+# bench/common.py
+#
+# Helpers shared by the fake upstream servers and the load driver.
+
+import json
+import math
+import random
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class LatencyDistribution:
+    """Latency in seconds drawn from a spec such as:
+
+        fixed:0.2            always 0.2s
+        uniform:0.1,0.5      uniform between 0.1s and 0.5s
+        normal:0.8,0.2       mean 0.8s, stddev 0.2s (clamped at 0)
+        lognormal:0.5,0.6    median 0.5s, sigma 0.6 (long tail)
+    """
+
+    def __init__(self, spec="fixed:0", seed=None):
+        self.spec = spec
+        kind, _, params = spec.partition(":")
+        self.kind = kind
+        self.params = [float(p) for p in params.split(",") if p] or [0.0]
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+
+    def sample(self):
+        with self.lock:
+            if self.kind == "fixed":
+                return self.params[0]
+            if self.kind == "uniform":
+                return self.random.uniform(self.params[0], self.params[1])
+            if self.kind == "normal":
+                return max(0.0, self.random.gauss(self.params[0], self.params[1]))
+            if self.kind == "lognormal":
+                return self.random.lognormvariate(math.log(self.params[0]), self.params[1])
+        raise ValueError(f"unknown latency distribution {self.spec!r}")
+
+
+def percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+class JSONHandler(BaseHTTPRequestHandler):
+    """Base request handler for the fake servers"""
+
+    def log_message(self, format, *args):
+        pass
+
+    def read_json(self):
+        length = int(self.headers.get("Content-Length", 0))
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def send_body(self, status, body, content_type="application/json"):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_json(self, status, payload):
+        self.send_body(status, json.dumps(payload).encode())
+
+
+def serve_in_background(handler_class, host="127.0.0.1", port=0):
+    """Start a threaded HTTP server on a daemon thread (server.server_port has the port)"""
+    server = ThreadingHTTPServer((host, port), handler_class)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
@@ -0,0 +1,213 @@
+# bench/fake_openai.py
+#
+# OpenAI-compatible chat completions server for local testing. Latency is
+# drawn per model from a configurable distribution, and replies are shaped
+# after the chatbot_api prompt they answer (intent JSON, clarification
+# matches, free-text answers) so the whole pipeline can run offline.
+# Prompt caching is simulated per message: leading messages identical to
+# those of an earlier request (at least --cache-min-tokens of them) are
+# reported as usage.prompt_tokens_details.cached_tokens.
+#
+#   python -m bench.fake_openai --port 8011 --latency gpt-3.5-turbo=lognormal:0.6,0.5
+#   OPENAI_BASE_URL=http://127.0.0.1:8011/v1 OPENAI_API_KEY=test uvicorn main:app
+
+import re
+import json
+import time
+import argparse
+import threading
+
+from bench.common import JSONHandler, LatencyDistribution, serve_in_background
+
+FIELD_WORDS = {
+    "price": "price", "cost": "cost", "profit": "profit", "margin": "margin", "markup": "markup",
+    "inventory": "inventory", "stock": "inventory", "dimensions": "dimensions", "image": "image_url",
+}
+STOPWORDS = {
+    "what", "is", "the", "of", "for", "a", "an", "me", "give", "show", "tell", "about", "how", "much",
+    "many", "and", "compare", "vs", "versus", "with", "its", "it", "please", "price", "cost", "profit",
+    "margin", "markup", "inventory", "stock", "dimensions", "image", "url", "between", "difference",
+}
+
+
+def quoted_query(prompt):
+    match = re.search(r'(?:Query|User query|specified): "(.*?)"', prompt, re.S)
+    return match.group(1) if match else ""
+
+
+def requested_fields(text):
+    lower = text.lower()
+    return sorted({field for word, field in FIELD_WORDS.items() if word in lower})
+
+
+def product_words(text):
+    return " ".join(w for w in re.findall(r"[A-Za-z0-9][-A-Za-z0-9]*", text) if w.lower() not in STOPWORDS)
+
+
+def match_title(user_text, titles):
+    words = [w for w in re.findall(r"[a-z0-9]+", user_text.lower()) if w not in STOPWORDS]
+    matches = [t for t in titles if words and all(w in t.lower() for w in words)]
+    return matches[0] if len(matches) == 1 else None
+
+
+def default_reply(prompt):
+    """Reply the way the real model would for each chatbot_api prompt"""
+    query = quoted_query(prompt)
+    if '"is_comparison"' in prompt:
+        match = re.search(r"(?:compare\s+)?([\w-]+)\s+(?:and|vs|versus)\s+([\w-]+)", query, re.I)
+        if match and re.search(r"\b(compare|vs|versus|difference)\b", query, re.I):
+            return json.dumps({
+                "is_comparison": True, "product1_name_or_sku": match.group(1),
+                "product2_name_or_sku": match.group(2), "requested_info": requested_fields(query),
+            })
+        return json.dumps({"is_comparison": False, "product1_name_or_sku": "", "product2_name_or_sku": "", "requested_info": []})
+    if '"product_name_or_sku"' in prompt:
+        name = product_words(query)
+        return json.dumps({"product_name_or_sku": name or None, "requested_info": requested_fields(query)})
+    if '"date_condition"' in prompt:
+        match = re.search(r"(after|before|on)\s+(\d{4}-\d{2}-\d{2})", query)
+        condition, date = (match.group(1), match.group(2)) if match else ("after", "2024-01-01")
+        return json.dumps({"date_condition": condition, "date_value": date,
+                           "query_type": "count" if "how many" in query.lower() else "list"})
+    if '"status_value"' in prompt:
+        status = next((s.upper() for s in ("draft", "active", "archived") if s in query.lower()), "")
+        return json.dumps({"status_value": status, "category_value": ""})
+    if '"matched_product_title"' in prompt or '"matched_variant_title"' in prompt:
+        titles = re.findall(r"^\s*- (.+)$", prompt, re.M)
+        title = match_title(query, titles)
+        key = "matched_variant_title" if '"matched_variant_title"' in prompt else "matched_product_title"
+        return json.dumps({key: title, "confidence": "high" if title else "low"})
+    return "Here is the requested product information: " + " ".join(prompt.split()[:40])
+
+
+class FakeOpenAIState:
+    def __init__(self, latencies=None, default_latency="fixed:0", reply=None, seed=None, cache_min_tokens=0):
+        self.latencies = {model: LatencyDistribution(spec, seed) for model, spec in (latencies or {}).items()}
+        self.default_latency = LatencyDistribution(str(default_latency) if ":" in str(default_latency) else f"fixed:{default_latency}", seed)
+        self.reply = reply
+        self.cache_min_tokens = cache_min_tokens
+        self.calls = {}
+        # Leading-message prefixes seen so far (tuples of message contents)
+        self.prefixes = set()
+        self.lock = threading.Lock()
+
+    def latency_for(self, model):
+        return self.latencies.get(model, self.default_latency).sample()
+
+    def reply_for(self, model, messages):
+        if self.reply is not None:
+            return self.reply
+        return default_reply("\n".join(m.get("content", "") for m in messages))
+
+    def cached_tokens(self, messages):
+        """Tokens of the leading messages an earlier request already sent"""
+        contents = tuple(m.get("content", "") for m in messages)
+        cached = 0
+        hit = True
+        with self.lock:
+            for end in range(1, len(contents) + 1):
+                hit = hit and contents[:end] in self.prefixes
+                if hit:
+                    cached += len(contents[end - 1].split())
+                self.prefixes.add(contents[:end])
+        return cached if cached >= self.cache_min_tokens else 0
+
+    def count(self, model):
+        with self.lock:
+            self.calls[model] = self.calls.get(model, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+            self.prefixes.clear()
+
+
+def completion_payload(model, content, messages, cached_tokens=0):
+    prompt_tokens = sum(len(m.get("content", "").split()) for m in messages)
+    completion_tokens = len(content.split())
+    return {
+        "id": f"chatcmpl-fake-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{
+            "index": 0,
+            "message": {"role": "assistant", "content": content},
+            "finish_reason": "stop",
+        }],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+def make_handler(state):
+    class Handler(JSONHandler):
+        def do_GET(self):
+            if self.path == "/__stats":
+                self.send_json(200, {"calls": state.stats()})
+            elif self.path.endswith("/models"):
+                models = sorted(set(state.latencies) | {"gpt-3.5-turbo", "gpt-4o-mini"})
+                self.send_json(200, {"object": "list", "data": [
+                    {"id": model, "object": "model", "created": 0, "owned_by": "fake"} for model in models
+                ]})
+            else:
+                self.send_json(404, {"error": {"message": "not found"}})
+
+        def do_POST(self):
+            if self.path == "/__reset":
+                state.reset()
+                self.send_json(200, {})
+                return
+            request = self.read_json()
+            if not self.path.endswith("/chat/completions"):
+                self.send_json(404, {"error": {"message": "not found"}})
+                return
+            model = request.get("model", "")
+            messages = request.get("messages", [])
+            state.count(model)
+            time.sleep(state.latency_for(model))
+            self.send_json(200, completion_payload(model, state.reply_for(model, messages), messages, state.cached_tokens(messages)))
+
+    return Handler
+
+
+def start_server(state, host="127.0.0.1", port=0):
+    """Start the server on a background thread and return it (server.server_port has the port)"""
+    return serve_in_background(make_handler(state), host, port)
+
+
+def parse_latencies(values):
+    """model=spec pairs; a bare number means a fixed latency"""
+    latencies = {}
+    for value in values or []:
+        model, spec = value.split("=", 1)
+        latencies[model] = spec if ":" in spec else f"fixed:{spec}"
+    return latencies
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake OpenAI chat completions server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8011)
+    parser.add_argument("--latency", action="append", help="per-model latency, e.g. gpt-3.5-turbo=lognormal:0.6,0.5")
+    parser.add_argument("--default-latency", default="fixed:0")
+    parser.add_argument("--reply", help="fixed message content for every completion")
+    parser.add_argument("--cache-min-tokens", type=int, default=0, help="shortest prefix reported as cached (OpenAI: 1024)")
+    args = parser.parse_args()
+
+    state = FakeOpenAIState(parse_latencies(args.latency), args.default_latency, args.reply, cache_min_tokens=args.cache_min_tokens)
+    server = start_server(state, args.host, args.port)
+    print(f"Fake OpenAI server on http://{args.host}:{server.server_port}/v1")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,372 @@
+# bench/fake_shopify.py
+#
+# Local stand-in for the Shopify Admin GraphQL API, seeded with a synthetic
+# Pelican-style catalog. It understands the query shapes chatbot_api sends
+# (product search, product details and batched nodes, criteria/date searches,
+# inventory items, bulk operations) by their root field rather than by parsing GraphQL, and returns the
+# fields those queries select.
+#
+#   python -m bench.fake_shopify --port 8012 --products 500 --variants 12
+#   SHOPIFY_GRAPHQL_URL=http://127.0.0.1:8012/graphql.json uvicorn main:app
+
+import re
+import json
+import time
+import random
+import argparse
+import threading
+
+from bench.common import JSONHandler, LatencyDistribution, serve_in_background
+
+COLORS = [
+    ("Black", "BLK"), ("Yellow", "YLW"), ("Orange", "OD"), ("Clear", "CLR"),
+    ("Red", "RED"), ("Tan", "TAN"), ("Silver", "SLV"), ("Blue", "BLU"),
+]
+INTERIORS = [
+    ("No Foam", "NF"), ("With Foam", "F"), ("Dividers", "DIV"), ("Padded Dividers", "PD"),
+]
+PRODUCT_TYPES = ["Hard Case", "Rolling Case", "Backpack", "Accessories"]
+STATUSES = ["ACTIVE"] * 7 + ["DRAFT"] * 2 + ["ARCHIVED"]
+
+
+def format_dimensions(length, width, height):
+    return f'{length:.2f}" x {width:.2f}" x {height:.2f}"'
+
+
+class Catalog:
+    """Deterministic synthetic catalog. Every other product has a single
+    variant so both the direct and the clarification flows get exercised."""
+
+    def __init__(self, products=500, variants=8, metafields=20, seed=7):
+        rng = random.Random(seed)
+        self.products = []
+        self.by_id = {}
+        self.inventory_items = {}
+        variant_options = [(color, interior) for color in COLORS for interior in INTERIORS]
+        for index in range(products):
+            model = 1010 + index * 10
+            product_type = PRODUCT_TYPES[index % len(PRODUCT_TYPES)]
+            length = round(rng.uniform(6, 40), 2)
+            width = round(length * rng.uniform(0.5, 0.9), 2)
+            height = round(rng.uniform(2, 16), 2)
+            product = {
+                "id": f"gid://shopify/Product/{1000000 + index}",
+                "title": f"Pelican {model} {product_type}",
+                "handle": f"pelican-{model}-{product_type.lower().replace(' ', '-')}",
+                "status": STATUSES[rng.randrange(len(STATUSES))],
+                "vendor": "Pelican",
+                "productType": product_type,
+                "tags": ["pelican", product_type.lower(), rng.choice(["waterproof", "crushproof", "travel", "drone", "camera"])],
+                "createdAt": f"{rng.randint(2022, 2025)}-{rng.randint(1, 12):02d}-{rng.randint(1, 28):02d}T10:00:00Z",
+                "updatedAt": "2025-06-01T10:00:00Z",
+                "onlineStoreUrl": f"https://example.com/products/pelican-{model}",
+                "description": f"Pelican {model} {product_type.lower()} with {length:.1f} inch interior, "
+                               f"{rng.choice(['watertight', 'dustproof', 'crushproof'])} and built for "
+                               f"{rng.choice(['cameras', 'drones', 'firearms', 'laptops', 'tools', 'medical gear'])}.",
+                "images": [{"url": f"https://cdn.example.com/pelican-{model}.jpg", "altText": f"Pelican {model}"}],
+                "metafields": [],
+                "variants": [],
+            }
+            product["metafields"].append({
+                "namespace": "custom", "key": "interior_dimensions",
+                "value": format_dimensions(length, width, height),
+            })
+            product["metafields"].append({
+                "namespace": "custom", "key": "exterior_dimensions",
+                "value": format_dimensions(length + 1.5, width + 1.5, height + 1.2),
+            })
+            for k in range(max(0, metafields - 2)):
+                product["metafields"].append({"namespace": "custom", "key": f"spec_{k}", "value": f"value {k}"})
+
+            base_price = round(rng.uniform(40, 600), 2)
+            variant_count = variants if index % 2 else 1
+            for v, ((color, color_code), (interior, interior_code)) in enumerate(variant_options[:variant_count]):
+                variant_id = (1000000 + index) * 100 + v
+                price = round(base_price + (10 if interior_code != "NF" else 0), 2)
+                inventory_item = {
+                    "id": f"gid://shopify/InventoryItem/{variant_id}",
+                    "unitCost": {"amount": f"{price * rng.uniform(0.4, 0.7):.2f}", "currencyCode": "USD"},
+                    "tracked": True,
+                    "sku": f"{model}-{color_code}-{interior_code}",
+                }
+                variant = {
+                    "id": f"gid://shopify/ProductVariant/{variant_id}",
+                    "sku": inventory_item["sku"],
+                    "title": f"{color} / {interior}",
+                    "price": f"{price:.2f}",
+                    "inventoryQuantity": rng.randint(0, 250),
+                    "selectedOptions": [{"name": "Color", "value": color}, {"name": "Interior", "value": interior}],
+                    "inventoryItem": inventory_item,
+                }
+                product["variants"].append(variant)
+                self.inventory_items[inventory_item["id"]] = inventory_item
+            self.products.append(product)
+            self.by_id[product["id"]] = product
+
+
+# ---- search query evaluation -------------------------------------------------
+
+def term_matches(product, term):
+    term = term.strip().strip("()").strip()
+    if not term or term == "*":
+        return True
+    field, sep, value = term.partition(":")
+    if not sep:
+        field, value = "title", term
+    value = value.strip().strip("'\"")
+    wildcard = value.startswith("*") or value.endswith("*")
+    value = value.strip("*").lower()
+    if field == "title":
+        return value in product["title"].lower() if wildcard else all(w in product["title"].lower() for w in value.split())
+    if field == "sku":
+        skus = [v["sku"].lower() for v in product["variants"]]
+        return any(value in sku for sku in skus) if wildcard else any(sku == value or sku.startswith(value) for sku in skus)
+    if field == "tag":
+        return any(value == tag.lower() or (wildcard and value in tag.lower()) for tag in product["tags"])
+    if field == "product_type":
+        return value == product["productType"].lower()
+    if field == "status":
+        return value.upper() == product["status"]
+    if field == "created_at":
+        created = product["createdAt"][:10]
+        if value.startswith(">"):
+            return created > value[1:]
+        if value.startswith("<"):
+            return created < value[1:]
+        return created == value
+    return False
+
+
+def product_matches(product, query_string):
+    """Evaluate `a OR b` groups joined by AND"""
+    for clause in re.split(r"\s+AND\s+", query_string or "*"):
+        if not any(term_matches(product, term) for term in re.split(r"\s+OR\s+", clause.strip().strip("()"))):
+            return False
+    return True
+
+
+# ---- response shaping ----------------------------------------------------------
+
+def connection(items, first, after=None):
+    start = int(after) if after else 0
+    page = items[start:start + first]
+    return {
+        "edges": [{"cursor": str(start + i + 1), "node": node} for i, node in enumerate(page)],
+        "pageInfo": {"hasNextPage": start + first < len(items), "endCursor": str(start + len(page)) if page else after},
+    }
+
+
+def first_arg(query, field, default):
+    match = re.search(field + r"\(first:\s*(\d+)", query)
+    return int(match.group(1)) if match else default
+
+
+def after_arg(query, field, variables):
+    match = re.search(field + r"\([^)]*after:\s*(\$\w+|\"[^\"]*\")", query)
+    if not match:
+        return None
+    value = match.group(1)
+    if value.startswith("$"):
+        return variables.get(value[1:])
+    return value.strip('"')
+
+
+def shape_variant(variant, query):
+    node = {"id": variant["id"], "sku": variant["sku"], "title": variant["title"]}
+    for key in ("price", "inventoryQuantity", "selectedOptions"):
+        if re.search(r"\b" + key + r"\b", query):
+            node[key] = variant[key]
+    if "inventoryItem" in query:
+        node["inventoryItem"] = {k: v for k, v in variant["inventoryItem"].items() if k != "sku"}
+    return node
+
+
+def shape_product(product, query, variables):
+    node = {key: product[key] for key in (
+        "id", "title", "handle", "status", "vendor", "productType", "tags",
+        "createdAt", "updatedAt", "onlineStoreUrl", "description",
+    ) if re.search(r"\b" + key + r"\b", query)}
+    node.setdefault("id", product["id"])
+    if "variants(" in query:
+        variants = [shape_variant(v, query) for v in product["variants"]]
+        node["variants"] = connection(variants, first_arg(query, "variants", 10), after_arg(query, "variants", variables))
+    if "metafields(" in query:
+        node["metafields"] = connection(product["metafields"], first_arg(query, "metafields", 20))
+    if "images(" in query:
+        node["images"] = connection(product["images"], first_arg(query, "images", 1))
+    return node
+
+
+def bulk_lines(catalog, bulk_query):
+    """JSONL export of a bulk products query: each product, followed by its variants with __parentId"""
+    literal = re.search(r'products\([^)]*query:\s*"((?:[^"\\]|\\.)*)"', bulk_query)
+    query_string = literal.group(1) if literal else "*"
+    lines = []
+    for product in catalog.products:
+        if not product_matches(product, query_string):
+            continue
+        lines.append(json.dumps(shape_product(product, bulk_query, {})))
+        if re.search(r"\bvariants\b", bulk_query):
+            for variant in product["variants"]:
+                lines.append(json.dumps({**shape_variant(variant, bulk_query), "__parentId": product["id"]}))
+    return "".join(line + "\n" for line in lines).encode()
+
+
+def estimate_cost(query):
+    """Rough requested cost: 1 per root object plus 2 + first for every connection"""
+    return 1 + sum(2 + int(first) for first in re.findall(r"\(first:\s*(\d+)", query))
+
+
+class FakeShopifyState:
+    def __init__(self, catalog, latency="fixed:0", seed=None, bulk_seconds=1.0):
+        self.catalog = catalog
+        self.latency = LatencyDistribution(latency, seed)
+        self.calls = {}
+        self.lock = threading.Lock()
+        # Bulk operations by number: when each completes and its JSONL body
+        self.bulk_seconds = bulk_seconds
+        self.bulk_operations = {}
+
+    def count(self, operation):
+        with self.lock:
+            self.calls[operation] = self.calls.get(operation, 0) + 1
+
+    def stats(self):
+        with self.lock:
+            return dict(self.calls)
+
+    def reset(self):
+        with self.lock:
+            self.calls.clear()
+
+    def run_bulk_operation(self, bulk_query):
+        with self.lock:
+            # One bulk query at a time, like Shopify
+            if any(operation["ready_at"] > time.monotonic() for operation in self.bulk_operations.values()):
+                return {"bulkOperationRunQuery": {"bulkOperation": None, "userErrors": [
+                    {"field": None, "message": "A bulk query operation for this app and shop is already in progress."}
+                ]}}
+            number = len(self.bulk_operations) + 1
+            self.bulk_operations[number] = {
+                "ready_at": time.monotonic() + self.bulk_seconds,
+                "body": bulk_lines(self.catalog, bulk_query),
+            }
+        return {"bulkOperationRunQuery": {
+            "bulkOperation": {"id": f"gid://shopify/BulkOperation/{number}", "status": "CREATED"}, "userErrors": [],
+        }}
+
+    def bulk_operation(self, gid, base_url):
+        number = int(str(gid).rsplit("/", 1)[-1] or 0)
+        operation = self.bulk_operations.get(number)
+        if operation is None:
+            return None
+        done = time.monotonic() >= operation["ready_at"]
+        count = operation["body"].count(b"\n")
+        return {
+            "id": gid,
+            "status": "COMPLETED" if done else "RUNNING",
+            "errorCode": None,
+            "objectCount": str(count if done else count // 2),
+            "url": f"{base_url}/bulk/{number}.jsonl" if done and count else None,
+        }
+
+    def bulk_body(self, number):
+        operation = self.bulk_operations.get(number)
+        return operation["body"] if operation else None
+
+    def execute(self, query, variables, base_url=""):
+        """Return (operation, data) for a GraphQL request"""
+        if re.search(r"\bbulkOperationRunQuery\(", query):
+            return "bulk_run", self.run_bulk_operation(variables.get("query") or "")
+        if re.search(r"\bnode\(id:", query):
+            return "bulk_status", {"node": self.bulk_operation(variables.get("id"), base_url)}
+        if re.search(r"\bshop\s*\{", query):
+            return "shop", {"shop": {"name": "Fake Pelican Store"}}
+        if re.search(r"\binventoryItem\(id:", query):
+            item_id = variables.get("id") or re.search(r'inventoryItem\(id:\s*"([^"]+)"', query).group(1)
+            item = self.catalog.inventory_items.get(item_id)
+            return "inventory_item", {"inventoryItem": item}
+        if re.search(r"\bnodes\(ids:", query):
+            nodes = [self.catalog.by_id.get(node_id) for node_id in variables.get("ids") or []]
+            return "nodes", {"nodes": [shape_product(p, query, variables) if p else None for p in nodes]}
+        if re.search(r"\bproduct\(id:", query):
+            literal = re.search(r'product\(id:\s*"([^"]+)"', query)
+            product_id = literal.group(1) if literal else variables.get("id")
+            product = self.catalog.by_id.get(product_id)
+            return "product_details", {"product": shape_product(product, query, variables) if product else None}
+        if re.search(r"\bproducts\(", query):
+            literal = re.search(r'products\([^)]*query:\s*"((?:[^"\\]|\\.)*)"', query)
+            query_string = literal.group(1) if literal else variables.get("query", "*")
+            first = first_arg(query, "products", 50)
+            matches = [p for p in self.catalog.products if product_matches(p, query_string)]
+            nodes = [shape_product(p, query, variables) for p in matches]
+            return "products", {"products": connection(nodes, first, after_arg(query, "products", variables))}
+        return "unknown", None
+
+    def respond(self, request, base_url=""):
+        query = request.get("query", "")
+        variables = request.get("variables") or {}
+        operation, data = self.execute(query, variables, base_url)
+        self.count(operation)
+        time.sleep(self.latency.sample())
+        if data is None:
+            return {"errors": [{"message": "unsupported query"}]}
+        requested = estimate_cost(query)
+        return {
+            "data": data,
+            "extensions": {"cost": {
+                "requestedQueryCost": requested,
+                "actualQueryCost": max(1, requested // 2),
+                "throttleStatus": {"maximumAvailable": 2000.0, "currentlyAvailable": 1990, "restoreRate": 100.0},
+            }},
+        }
+
+
+def make_handler(state):
+    class Handler(JSONHandler):
+        def do_GET(self):
+            bulk = re.fullmatch(r"/bulk/(\d+)\.jsonl", self.path)
+            if self.path == "/__stats":
+                self.send_json(200, {"calls": state.stats()})
+            elif bulk and state.bulk_body(int(bulk.group(1))) is not None:
+                state.count("bulk_download")
+                self.send_body(200, state.bulk_body(int(bulk.group(1))), "application/jsonl")
+            else:
+                self.send_json(404, {"errors": [{"message": "not found"}]})
+
+        def do_POST(self):
+            if self.path == "/__reset":
+                state.reset()
+                self.send_json(200, {})
+                return
+            self.send_json(200, state.respond(self.read_json(), f"http://{self.headers.get('Host')}"))
+
+    return Handler
+
+
+def start_server(state, host="127.0.0.1", port=0):
+    return serve_in_background(make_handler(state), host, port)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fake Shopify Admin GraphQL server")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8012)
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--variants", type=int, default=8, help="variants per product (max 32)")
+    parser.add_argument("--metafields", type=int, default=20, help="metafields per product")
+    parser.add_argument("--latency", default="fixed:0.05", help="latency distribution, e.g. lognormal:0.15,0.4")
+    parser.add_argument("--bulk-seconds", type=float, default=1.0, help="time a bulk operation takes to complete")
+    parser.add_argument("--seed", type=int, default=7)
+    args = parser.parse_args()
+
+    catalog = Catalog(args.products, args.variants, args.metafields, args.seed)
+    state = FakeShopifyState(catalog, args.latency, bulk_seconds=args.bulk_seconds)
+    server = start_server(state, args.host, args.port)
+    print(f"Fake Shopify GraphQL on http://{args.host}:{server.server_port}/graphql.json "
+          f"({len(state.catalog.products)} products)")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
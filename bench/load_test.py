@@ -0,0 +1,175 @@
+# bench/load_test.py
+#
+# Offline load test: starts the fake Shopify and OpenAI servers, points the
+# app at them, replays a mix of query types against main.app and reports
+# latency percentiles, throughput and upstream calls per query type.
+#
+#   python -m bench.load_test --products 1000 --requests 200 --concurrency 8 \
+#       --shopify-latency lognormal:0.12,0.5 --llm-latency lognormal:0.6,0.5
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from bench.common import percentile
+from bench import fake_shopify, fake_openai
+
+QUERY_TYPES = ["single_product", "clarification", "comparison", "status_count", "date_list", "greeting"]
+
+
+def build_conversations(catalog, query_type, count, rng):
+    """Return `count` conversations (lists of user turns) of one query type"""
+    single = [p for p in catalog.products if len(p["variants"]) == 1]
+    multi = [p for p in catalog.products if len(p["variants"]) > 1]
+    conversations = []
+    for _ in range(count):
+        if query_type == "single_product":
+            product = rng.choice(single)
+            model = product["title"].split()[1]
+            field = rng.choice(["price", "inventory", "margin", "cost", "dimensions"])
+            conversations.append([f"What is the {field} of {model}?"])
+        elif query_type == "clarification":
+            product = rng.choice(multi)
+            model = product["title"].split()[1]
+            variant = rng.choice(product["variants"])
+            conversations.append([f"What is the price of {model}?", variant["title"].replace("/", "")])
+        elif query_type == "comparison":
+            first, second = rng.sample(catalog.products, 2)
+            conversations.append([f"Compare {first['title'].split()[1]} vs {second['title'].split()[1]} price"])
+        elif query_type == "status_count":
+            conversations.append([f"How many products have status {rng.choice(['draft', 'active', 'archived'])}?"])
+        elif query_type == "date_list":
+            conversations.append([f"List products created after {rng.randint(2022, 2025)}-{rng.randint(1, 12):02d}-01"])
+        elif query_type == "greeting":
+            conversations.append([rng.choice(["hi", "hello", "help", "thanks"])])
+    return conversations
+
+
+def run_phase(client, conversations, concurrency, first_session=0):
+    """Run conversations concurrently; return (latencies, errors, shed, wall seconds).
+
+    Conversations turned away by admission control (429/503) count as shed, not errors.
+    """
+    def run(item):
+        session_number, turns = item
+        start = time.perf_counter()
+        for turn in turns:
+            response = client.post("/chat", json={"query": turn, "session_id": f"load-{session_number}"})
+            if response.status_code in (429, 503):
+                return time.perf_counter() - start, "shed"
+            if response.status_code != 200:
+                return time.perf_counter() - start, "error"
+        return time.perf_counter() - start, "ok"
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        results = list(pool.map(run, enumerate(conversations, first_session)))
+    wall = time.perf_counter() - start
+    latencies = [seconds for seconds, outcome in results if outcome == "ok"]
+    errors = sum(1 for _, outcome in results if outcome == "error")
+    shed = sum(1 for _, outcome in results if outcome == "shed")
+    return latencies, errors, shed, wall
+
+
+def stage_seconds(stage_name):
+    """Total seconds observed so far in one pipeline stage (metrics.STAGE_SECONDS)"""
+    from prometheus_client import REGISTRY
+    return REGISTRY.get_sample_value("chatbot_stage_seconds_sum", {"stage": stage_name}) or 0.0
+
+
+def diff_counts(after, before):
+    return {key: after.get(key, 0) - before.get(key, 0) for key in after if after.get(key, 0) - before.get(key, 0)}
+
+
+def format_report(rows):
+    header = (f"{'query type':<16}{'n':>6}{'err':>5}{'shed':>6}{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'req/s':>8}"
+              f"{'shopify/q':>11}{'llm/q':>7}{'parse ms/q':>12}{'decode ms/q':>13}")
+    lines = [header, "-" * len(header)]
+    for row in rows:
+        lines.append(
+            f"{row['query_type']:<16}{row['count']:>6}{row['errors']:>5}{row['shed']:>6}"
+            f"{row['p50'] * 1000:>9.1f}{row['p95'] * 1000:>9.1f}{row['p99'] * 1000:>9.1f}"
+            f"{row['throughput']:>8.1f}{row['shopify_calls_per_query']:>11.2f}{row['llm_calls_per_query']:>7.2f}"
+            f"{row['parse_ms_per_query']:>12.3f}{row['decode_ms_per_query']:>13.3f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Offline load test for the chatbot API")
+    parser.add_argument("--products", type=int, default=500)
+    parser.add_argument("--variants", type=int, default=8)
+    parser.add_argument("--metafields", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=100, help="conversations per query type")
+    parser.add_argument("--concurrency", type=int, default=4)
+    parser.add_argument("--types", default=",".join(QUERY_TYPES))
+    parser.add_argument("--shopify-latency", default="lognormal:0.1,0.4")
+    parser.add_argument("--llm-latency", default="lognormal:0.5,0.5")
+    parser.add_argument("--no-cache", action="store_true", help="disable the product search/detail and answer caches")
+    parser.add_argument("--seed", type=int, default=11)
+    parser.add_argument("--json", help="also write the results to this file")
+    args = parser.parse_args(argv)
+
+    catalog = fake_shopify.Catalog(args.products, args.variants, args.metafields, args.seed)
+    shopify_state = fake_shopify.FakeShopifyState(catalog, args.shopify_latency, args.seed)
+    openai_state = fake_openai.FakeOpenAIState(default_latency=args.llm_latency, seed=args.seed)
+    shopify_server = fake_shopify.start_server(shopify_state)
+    openai_server = fake_openai.start_server(openai_state)
+
+    # The app reads its upstream configuration at import time
+    os.environ["SHOPIFY_GRAPHQL_URL"] = f"http://127.0.0.1:{shopify_server.server_port}/graphql.json"
+    os.environ["OPENAI_BASE_URL"] = f"http://127.0.0.1:{openai_server.server_port}/v1"
+    os.environ.setdefault("OPENAI_API_KEY", "load-test")
+    os.environ.setdefault("SHOPIFY_ADMIN_API_TOKEN", "load-test")
+    if args.no_cache:
+        os.environ["PRODUCT_CACHE_TTL_SECONDS"] = "0"
+        os.environ["ANSWER_CACHE_TTL_SECONDS"] = "0"
+
+    from fastapi.testclient import TestClient
+    import main as app_main
+
+    client = TestClient(app_main.app)
+    rng = random.Random(args.seed)
+    rows = []
+    session_offset = 0
+    for query_type in args.types.split(","):
+        conversations = build_conversations(catalog, query_type, args.requests, rng)
+        shopify_before, llm_before = shopify_state.stats(), openai_state.stats()
+        parse_before, decode_before = stage_seconds("shopify_parse"), stage_seconds("shopify_decode")
+        latencies, errors, shed, wall = run_phase(client, conversations, args.concurrency, session_offset)
+        session_offset += len(conversations)
+        shopify_calls = sum(diff_counts(shopify_state.stats(), shopify_before).values())
+        llm_calls = sum(diff_counts(openai_state.stats(), llm_before).values())
+        # JSON parsing of Shopify bodies and decoding into product records
+        parse_seconds = stage_seconds("shopify_parse") - parse_before
+        decode_seconds = stage_seconds("shopify_decode") - decode_before
+        rows.append({
+            "query_type": query_type,
+            "count": len(conversations),
+            "errors": errors,
+            "shed": shed,
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "throughput": len(conversations) / wall if wall else 0.0,
+            "shopify_calls_per_query": shopify_calls / len(conversations),
+            "llm_calls_per_query": llm_calls / len(conversations),
+            "parse_ms_per_query": parse_seconds * 1000 / len(conversations),
+            "decode_ms_per_query": decode_seconds * 1000 / len(conversations),
+            "shopify_calls": shopify_calls,
+            "llm_calls": llm_calls,
+        })
+
+    print(format_report(rows))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"args": vars(args), "results": rows}, f, indent=2)
+    return rows
+
+
+if __name__ == "__main__":
+    sys.exit(0 if main() else 1)
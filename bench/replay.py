@@ -0,0 +1,121 @@
+# bench/replay.py
+#
+# Deterministic replay of a captured query log (see query_log.py) for
+# latency regression testing. Upstream calls are served from the log, so
+# runs are hermetic; by default each replayed call waits for the latency
+# recorded with it so stage timings stay realistic.
+#
+#   QUERY_LOG_PATH=queries.jsonl.gz uvicorn main:app       # capture
+#   python -m bench.replay run queries.jsonl.gz --out before.jsonl
+#   python -m bench.replay run queries.jsonl.gz --out after.jsonl
+#   python -m bench.replay diff before.jsonl after.jsonl
+
+import os
+import sys
+import json
+import argparse
+
+from bench.common import percentile
+
+
+def replay_log(log_path, out_path, delay=True):
+    # Nothing should reach a real upstream: misses surface as ReplayMiss instead
+    os.environ.setdefault("OPENAI_API_KEY", "replay")
+    os.environ.setdefault("SHOPIFY_GRAPHQL_URL", "http://127.0.0.1:9/graphql.json")
+    os.environ.pop("QUERY_LOG_PATH", None)
+
+    import query_log
+    from metrics import trace_request
+    from resilience import request_budget
+    from chatbot_api import handle_user_input_with_pelican_support, new_conversation_state
+
+    entries = list(query_log.read_log(log_path))
+    global_index = query_log.build_global_index(entries)
+    sessions = {}
+    results = []
+    for number, entry in enumerate(entries):
+        state = sessions.setdefault(entry.get("session") or "default", new_conversation_state())
+        source = query_log.ReplaySource(entry, global_index, delay)
+        with query_log.replaying(source), trace_request("replay") as request_trace, request_budget():
+            answer = handle_user_input_with_pelican_support(entry["query"], state)
+        results.append({
+            "index": number,
+            "session": entry.get("session"),
+            "turn": entry.get("turn"),
+            "query": entry["query"],
+            "answer": answer,
+            "recorded_answer": entry.get("answer"),
+            "stages": request_trace.stage_totals(),
+            "total": sum(request_trace.stage_totals().values()),
+            "misses": source.misses,
+        })
+
+    with open(out_path, "w") as f:
+        for result in results:
+            f.write(json.dumps(result) + "\n")
+    return results
+
+
+def load_run(path):
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def stage_table(runs):
+    """Per-stage p50/p95 in ms for each run: {stage: [(p50, p95), ...]}"""
+    stages = sorted({stage for run in runs for result in run for stage in result["stages"]})
+    table = {}
+    for stage in stages:
+        table[stage] = []
+        for run in runs:
+            values = [result["stages"][stage] for result in run if stage in result["stages"]]
+            table[stage].append((percentile(values, 50) * 1000, percentile(values, 95) * 1000))
+    return table
+
+
+def diff_runs(before, after, show=10):
+    lines = []
+    changed = [(b, a) for b, a in zip(before, after) if b["answer"] != a["answer"]]
+    lines.append(f"requests: {len(before)} vs {len(after)}, answers changed: {len(changed)}")
+    for b, a in changed[:show]:
+        lines.append(f"  #{b['index']} {b['query']!r}\n    before: {b['answer'][:160]!r}\n    after:  {a['answer'][:160]!r}")
+    misses = sum(result["misses"] for result in after)
+    if misses:
+        lines.append(f"upstream calls missing from the log in the second run: {misses}")
+
+    lines.append(f"\n{'stage':<36}{'p50 before':>12}{'p50 after':>12}{'p95 before':>12}{'p95 after':>12}")
+    for stage, ((b50, b95), (a50, a95)) in stage_table([before, after]).items():
+        lines.append(f"{stage:<36}{b50:>12.1f}{a50:>12.1f}{b95:>12.1f}{a95:>12.1f}")
+    return "\n".join(lines)
+
+
+def summarize(results):
+    same = sum(1 for result in results if result["answer"] == result["recorded_answer"])
+    misses = sum(result["misses"] for result in results)
+    lines = [f"replayed {len(results)} requests: {same} answers match the recording, {misses} upstream misses"]
+    lines.append(f"\n{'stage':<36}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, [(p50, p95)] in stage_table([results]).items():
+        lines.append(f"{stage:<36}{p50:>10.1f}{p95:>10.1f}")
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Replay a captured query log")
+    commands = parser.add_subparsers(dest="command", required=True)
+    run = commands.add_parser("run", help="replay a log and write per-request results")
+    run.add_argument("log")
+    run.add_argument("--out", required=True)
+    run.add_argument("--no-delay", action="store_true", help="serve recorded responses without their recorded latency")
+    diff = commands.add_parser("diff", help="compare the results of two replay runs")
+    diff.add_argument("before")
+    diff.add_argument("after")
+    args = parser.parse_args(argv)
+
+    if args.command == "run":
+        print(summarize(replay_log(args.log, args.out, delay=not args.no_delay)))
+    else:
+        print(diff_runs(load_run(args.before), load_run(args.after)))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,142 @@
+# bench/session_size.py
+#
+# Per-session cost of a pending clarification: the raw GraphQL results the
+# conversation state used to hold versus the compact ClarificationContext,
+# in memory and serialized (JSON before, the binary form after).
+#
+#   python -m bench.session_size --products 200 --variants 16 --metafields 20
+
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+from bench import fake_shopify
+
+
+def deep_size(value, seen=None):
+    """Bytes held by value and everything it references (shared objects counted once)"""
+    seen = set() if seen is None else seen
+    if id(value) in seen:
+        return 0
+    seen.add(id(value))
+    size = sys.getsizeof(value)
+    if isinstance(value, dict):
+        size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in value.items())
+    elif isinstance(value, (list, tuple, set, frozenset)):
+        size += sum(deep_size(item, seen) for item in value)
+    for name in getattr(type(value), "__slots__", ()):
+        size += deep_size(getattr(value, name, None), seen)
+    return size
+
+
+def time_per_call(fn, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        fn()
+    return (time.perf_counter() - start) / repeat
+
+
+def build_states(shopify_state, chatbot_api, count, rng):
+    """(kind, raw state as it used to be kept, compact state) pairs for both clarification kinds"""
+    from session_models import ClarificationContext, Product
+
+    requested_info = ["price", "cost", "margin"]
+    details_query = chatbot_api.get_product_details_query(chatbot_api.product_query_selections(requested_info))
+    search_query = 'query { products(first: 10, query: "title:*Pelican*") { edges { node { id title handle } } } }'
+    multi = [p for p in shopify_state.catalog.products if len(p["variants"]) > 1]
+    states = []
+    for _ in range(count):
+        # Several products matched the question
+        products = shopify_state.execute(search_query, {})[1]["products"]["edges"]
+        raw = {
+            "awaiting_clarification": True,
+            "clarification_type": "color_interior_specs",
+            "clarification_data": products,
+            "original_query": "What is the price of Pelican?",
+            "original_requested_info": requested_info,
+            "original_product": None,
+        }
+        compact = ClarificationContext(
+            "color_interior_specs", raw["original_query"], requested_info,
+            candidates=tuple(Product.from_node(p["node"], with_variants=False) for p in products),
+        )
+        states.append(("products", raw, compact))
+
+        # One product matched, with several variants
+        product = rng.choice(multi)
+        product_info = shopify_state.execute(details_query, {"id": product["id"]})[1]["product"]
+        raw = {
+            "awaiting_clarification": True,
+            "clarification_type": "variant_color_interior",
+            "clarification_data": product_info["variants"]["edges"],
+            "original_query": f"What is the price of {product['title']}?",
+            "original_requested_info": requested_info,
+            "original_product": product_info,
+        }
+        compact = ClarificationContext(
+            "variant_color_interior", raw["original_query"], requested_info, product=Product.from_node(product_info)
+        )
+        states.append(("variants", raw, compact))
+    return states
+
+
+def measure(states, repeat):
+    from session_models import ClarificationContext
+
+    rows = {}
+    for kind, raw, compact in states:
+        data = compact.to_bytes()
+        row = rows.setdefault(kind, {"n": 0, "raw_memory": 0, "raw_json": 0, "memory": 0, "binary": 0,
+                                     "json_dump": 0.0, "json_load": 0.0, "encode": 0.0, "decode": 0.0})
+        encoded_json = json.dumps(raw)
+        row["n"] += 1
+        row["raw_memory"] += deep_size(raw)
+        row["raw_json"] += len(encoded_json.encode())
+        row["memory"] += deep_size(compact)
+        row["binary"] += len(data)
+        row["json_dump"] += time_per_call(lambda: json.dumps(raw), repeat)
+        row["json_load"] += time_per_call(lambda: json.loads(encoded_json), repeat)
+        row["encode"] += time_per_call(compact.to_bytes, repeat)
+        row["decode"] += time_per_call(lambda: ClarificationContext.from_bytes(data), repeat)
+    return rows
+
+
+def format_report(rows):
+    header = (f"{'clarification':<15}{'raw mem B':>11}{'raw json B':>12}{'slots mem B':>13}{'binary B':>10}"
+              f"{'json dump/load us':>20}{'bin enc/dec us':>17}")
+    lines = [header, "-" * len(header)]
+    for kind, row in rows.items():
+        n = row["n"]
+        lines.append(
+            f"{kind:<15}{row['raw_memory'] // n:>11}{row['raw_json'] // n:>12}{row['memory'] // n:>13}{row['binary'] // n:>10}"
+            f"{row['json_dump'] / n * 1e6:>11.1f}/{row['json_load'] / n * 1e6:<8.1f}"
+            f"{row['encode'] / n * 1e6:>9.1f}/{row['decode'] / n * 1e6:<7.1f}"
+        )
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-session bytes of clarification state, before and after")
+    parser.add_argument("--products", type=int, default=200)
+    parser.add_argument("--variants", type=int, default=16)
+    parser.add_argument("--metafields", type=int, default=20)
+    parser.add_argument("--sessions", type=int, default=50, help="sessions sampled per clarification kind")
+    parser.add_argument("--repeat", type=int, default=200, help="timing repetitions per session")
+    parser.add_argument("--seed", type=int, default=11)
+    args = parser.parse_args(argv)
+
+    # Only the query builders are used; nothing is sent upstream
+    os.environ.setdefault("OPENAI_API_KEY", "session-size")
+    import chatbot_api
+
+    catalog = fake_shopify.Catalog(args.products, args.variants, args.metafields, args.seed)
+    shopify_state = fake_shopify.FakeShopifyState(catalog)
+    states = build_states(shopify_state, chatbot_api, args.sessions, random.Random(args.seed))
+    print(format_report(measure(states, args.repeat)))
+
+
+if __name__ == "__main__":
+    main()
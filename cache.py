@@ -0,0 +1,125 @@
+# cache.py
+#
+# Small thread-safe TTL cache. Entries past their TTL are not served
+# normally but stay available (until evicted) as stale fallbacks for
+# when an upstream is unavailable. Also the catalog version stamp that
+# caches of derived answers are keyed on, optionally shared by every worker
+# through a file.
+
+import os
+import time
+import weakref
+import threading
+from collections import OrderedDict
+
+from metrics import record_cache_lookup
+
+
+class TTLCache:
+    def __init__(self, ttl_seconds, max_entries=1000, name=None):
+        self.name = name
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key, allow_stale=False):
+        value = self._get(key, allow_stale)
+        # Stale reads are outage fallbacks, so only normal lookups count towards the hit ratio
+        if self.name and not allow_stale:
+            record_cache_lookup(self.name, value is not None)
+        return value
+
+    def _get(self, key, allow_stale):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            stored_at, value = entry
+            if not allow_stale and time.monotonic() - stored_at > self.ttl_seconds:
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self.lock:
+            self.entries[key] = (time.monotonic(), value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def pop(self, key):
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            return entry[1] if entry else None
+
+    def pop_matching(self, predicate):
+        """Drop every entry for which predicate(key, value) holds"""
+        with self.lock:
+            for key in [key for key, (_, value) in self.entries.items() if predicate(key, value)]:
+                del self.entries[key]
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class CatalogVersion:
+    """Counter bumped whenever the catalog may have changed (webhooks, snapshot swaps).
+
+    With a path, shared bumps (webhooks) touch that file and the version
+    includes its mtime, so every worker using the same file sees a change
+    received by any of them within check_interval seconds; on_shared_change
+    (held weakly) is called in a worker that notices another one's bump.
+    Local bumps (a worker's own snapshot swap) only move this process's part.
+    """
+
+    def __init__(self, path=None, check_interval=1.0):
+        self.path = path
+        self.check_interval = check_interval
+        self.local = 0
+        self.shared = self._read_shared()
+        self.checked_at = time.monotonic()
+        self._listener = None
+        self.lock = threading.Lock()
+
+    def _read_shared(self):
+        if not self.path:
+            return 0
+        try:
+            return os.stat(self.path).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    def on_shared_change(self, method):
+        self._listener = weakref.WeakMethod(method)
+
+    def bump(self, shared=True):
+        with self.lock:
+            if shared and self.path:
+                # Strictly later than the last change, even within the clock's resolution
+                stamp = max(time.time_ns(), self._read_shared() + 1)
+                with open(self.path, "a"):
+                    pass
+                os.utime(self.path, ns=(stamp, stamp))
+                self.shared = stamp
+                self.checked_at = time.monotonic()
+            else:
+                self.local += 1
+            return self.shared + self.local
+
+    @property
+    def current(self):
+        if self.path and time.monotonic() - self.checked_at > self.check_interval:
+            shared = self._read_shared()
+            with self.lock:
+                changed = shared != self.shared
+                self.shared, self.checked_at = shared, time.monotonic()
+            listener = self._listener() if changed and self._listener else None
+            if listener:
+                listener()
+        return self.shared + self.local
+
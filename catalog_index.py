@@ -0,0 +1,240 @@
+# catalog_index.py
+#
+# Per-product index of the full variant set with each variant's option
+# attributes (Color, Interior, ...), so a variant can be resolved from the
+# user's words without asking the LLM or re-fetching the product, and of
+# parsed interior/exterior dimensions for range and nearest-size queries.
+
+import re
+import json
+import math
+import time
+import threading
+
+from cache import TTLCache
+
+# Phrases that mean the same interior option
+OPTION_SYNONYMS = [
+    (re.compile(r"\b(empty|without foam|no-foam)\b"), "no foam"),
+    (re.compile(r"\bdivider\b"), "dividers"),
+]
+# Words that do not distinguish one option value from another
+OPTION_FILLER_WORDS = {"with", "and", "the", "a"}
+
+
+def option_words(value):
+    return {word for word in re.findall(r"[a-z0-9]+", value.lower()) if word not in OPTION_FILLER_WORDS}
+
+
+def text_words(text):
+    text = text.lower()
+    for pattern, replacement in OPTION_SYNONYMS:
+        text = pattern.sub(replacement, text)
+    return set(re.findall(r"[a-z0-9]+", text))
+
+
+def variant_attributes(variant):
+    """Option name -> value, plus the SKU segment for each option when the SKU
+    has one segment per option after the model (e.g. 1510-BLK-NF)"""
+    options = [o for o in variant.get("selectedOptions") or [] if o.get("name") != "Title"]
+    segments = (variant.get("sku") or "").lower().split("-")
+    codes = segments[1:] if len(segments) == len(options) + 1 else [None] * len(options)
+    return [
+        {"name": o["name"].lower(), "value": o["value"], "words": option_words(o["value"]), "code": code}
+        for o, code in zip(options, codes)
+    ]
+
+
+# Conversion factors to inches
+UNIT_INCHES = {
+    "in": 1.0, "inch": 1.0, "inches": 1.0, '"': 1.0, "''": 1.0,
+    "ft": 12.0, "feet": 12.0, "foot": 12.0, "'": 12.0,
+    "mm": 1 / 25.4, "cm": 1 / 2.54, "m": 100 / 2.54,
+    "millimeters": 1 / 25.4, "centimeters": 1 / 2.54, "meters": 100 / 2.54,
+    "millimetres": 1 / 25.4, "centimetres": 1 / 2.54, "metres": 100 / 2.54,
+}
+UNIT_PATTERN = r"(millimet(?:er|re)s|centimet(?:er|re)s|met(?:er|re)s|inches|inch|feet|foot|mm|cm|in\b|ft\b|m\b|''|\"|')"
+MEASUREMENT = re.compile(r"(\d+(?:\.\d+)?)\s*" + UNIT_PATTERN + "?", re.IGNORECASE)
+AXES = ("length", "width", "height")
+
+
+def to_inches(number, unit):
+    return round(float(number) * UNIT_INCHES.get((unit or "in").lower(), 1.0), 3)
+
+
+def parse_measurement(value):
+    """One length in inches from "12 in", "30.5cm" or a Shopify dimension JSON value"""
+    if isinstance(value, dict):
+        unit = {"INCHES": "in", "FEET": "ft", "CENTIMETERS": "cm", "MILLIMETERS": "mm", "METERS": "m"}.get(
+            str(value.get("unit", "")).upper(), value.get("unit"))
+        try:
+            return to_inches(value["value"], unit)
+        except (KeyError, TypeError, ValueError):
+            return None
+    match = MEASUREMENT.search(str(value))
+    return to_inches(match.group(1), match.group(2)) if match else None
+
+
+def parse_dimensions(value):
+    """(length, width, height) in inches from a dimensions metafield value, or None.
+
+    Accepts '12.5" x 8" x 4"', "30 x 20 x 10 cm" (a trailing unit applies to
+    every number), "L 12in W 8in H 4in" and JSON objects with length, width
+    and height keys.
+    """
+    if not value:
+        return None
+    if isinstance(value, str) and value.lstrip().startswith("{"):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            pass
+    if isinstance(value, dict):
+        sides = [parse_measurement(value.get(axis)) if value.get(axis) is not None else None for axis in AXES]
+        return tuple(sides) if all(side is not None for side in sides) else None
+    measurements = MEASUREMENT.findall(str(value))
+    if len(measurements) != 3:
+        return None
+    default_unit = next((unit for _, unit in reversed(measurements) if unit), "in")
+    return tuple(to_inches(number, unit or default_unit) for number, unit in measurements)
+
+
+def product_dimensions(product):
+    """{"interior": (l, w, h), "exterior": (l, w, h)} from a product's dimension metafields"""
+    dimensions = {}
+    for edge in (product.get("metafields") or {}).get("edges", []):
+        key = (edge["node"].get("key") or "").lower()
+        if "dimension" not in key:
+            continue
+        kind = "exterior" if "exterior" in key or "outside" in key else "interior"
+        parsed = parse_dimensions(edge["node"].get("value"))
+        if parsed and kind not in dimensions:
+            dimensions[kind] = parsed
+    return dimensions
+
+
+def format_dimensions(sides):
+    return " x ".join(f"{round(side, 2):g}" for side in sides) + " in"
+
+
+class CatalogIndex:
+    """Variant identities and attributes keyed by product id, plus parsed
+    dimensions for the whole catalog"""
+
+    def __init__(self, ttl_seconds, max_products=5000):
+        self.entries = TTLCache(ttl_seconds, max_entries=max_products, name="catalog_index")
+        self.ttl_seconds = ttl_seconds
+        # product id -> {"id", "title", "interior", "exterior"}
+        self.dimensions = {}
+        self.dimensions_loaded_at = None
+        self.lock = threading.Lock()
+
+    def index_product(self, product):
+        """Index (or re-index) a product node with a full variants connection"""
+        variants = []
+        for edge in (product.get("variants") or {}).get("edges", []):
+            node = edge["node"]
+            variants.append({
+                "id": node["id"],
+                "title": node.get("title"),
+                "sku": node.get("sku"),
+                "attributes": variant_attributes(node),
+            })
+        entry = {"variants": variants}
+        self.entries.set(product["id"], entry)
+        dimensions = product_dimensions(product)
+        if dimensions:
+            with self.lock:
+                self.dimensions[product["id"]] = {"id": product["id"], "title": product.get("title"), **dimensions}
+        return entry
+
+    def load_dimensions(self, rows):
+        """Replace the dimension table with rows of {"id", "title", "interior", "exterior"}"""
+        table = {row["id"]: row for row in rows if row.get("interior") or row.get("exterior")}
+        with self.lock:
+            self.dimensions = table
+            self.dimensions_loaded_at = time.monotonic()
+
+    def dimensions_stale(self):
+        return self.dimensions_loaded_at is None or time.monotonic() - self.dimensions_loaded_at > self.ttl_seconds
+
+    def filter_by_dimension(self, kind, axis, minimum=None, maximum=None):
+        """Products whose kind ("interior"/"exterior") axis lies within [minimum, maximum] inches"""
+        position = AXES.index(axis)
+        with self.lock:
+            rows = list(self.dimensions.values())
+        matches = []
+        for row in rows:
+            sides = row.get(kind)
+            if not sides:
+                continue
+            if minimum is not None and sides[position] < minimum:
+                continue
+            if maximum is not None and sides[position] > maximum:
+                continue
+            matches.append(row)
+        return sorted(matches, key=lambda row: row[kind][position])
+
+    def nearest_size(self, kind, target, limit=5, must_fit=False):
+        """Products closest in size to target (l, w, h), ignoring orientation.
+
+        With must_fit only products at least as large on every side are kept,
+        smallest first, i.e. the tightest case the item fits into.
+        """
+        wanted = sorted(target, reverse=True)
+        with self.lock:
+            rows = list(self.dimensions.values())
+        scored = []
+        for row in rows:
+            sides = row.get(kind)
+            if not sides:
+                continue
+            have = sorted(sides, reverse=True)
+            if must_fit and any(h < w for h, w in zip(have, wanted)):
+                continue
+            scored.append((math.dist(have, wanted), row))
+        scored.sort(key=lambda pair: pair[0])
+        return [row for _, row in scored[:limit]]
+
+    def get(self, product_id):
+        return self.entries.get(product_id)
+
+    def forget(self, product_id):
+        self.entries.pop(product_id)
+        with self.lock:
+            self.dimensions.pop(product_id, None)
+
+    def entry_for(self, product):
+        return self.get(product["id"]) or self.index_product(product)
+
+    def resolve_variant_id(self, product, text):
+        """Id of the one variant whose every option is named in text, or None.
+
+        When several match ("black no foam" also names "foam"), the variant
+        whose options account for the most words wins.
+        """
+        return self.resolve_variant_id_in(self.entry_for(product), text)
+
+    def resolve_variant_id_in(self, entry, text):
+        words = text_words(text)
+        scored = []
+        for variant in entry["variants"]:
+            attributes = variant["attributes"]
+            if not attributes:
+                continue
+            score = 0
+            for attribute in attributes:
+                if attribute["words"] and attribute["words"] <= words:
+                    score += len(attribute["words"])
+                elif attribute["code"] and attribute["code"] in words:
+                    score += 1
+                else:
+                    break
+            else:
+                scored.append((score, variant["id"]))
+        if not scored:
+            return None
+        scored.sort(reverse=True)
+        if len(scored) > 1 and scored[0][0] == scored[1][0]:
+            return None
+        return scored[0][1]
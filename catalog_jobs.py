@@ -0,0 +1,348 @@
+# catalog_jobs.py
+#
+# Background jobs for catalog-wide questions ("how many archived products
+# are there in total", "average margin of every active Pelican case") that
+# one products(first: 100) page cannot answer. A job starts a Shopify bulk
+# operation (bulkOperationRunQuery), polls it until the export is ready and
+# streams the JSONL result into a running aggregate, so memory stays flat
+# however large the catalog is. Finished results are kept per catalog
+# version: the same question is answered from them until a webhook or a new
+# snapshot bumps the version.
+#
+# Bulk JSONL holds one object per line; a product's variants follow it,
+# each with a "__parentId" naming the product.
+
+import time
+import uuid
+import logging
+import threading
+from contextlib import nullcontext
+from concurrent.futures import ThreadPoolExecutor
+
+from cache import TTLCache
+from catalog_snapshot import to_cents
+from metrics import stage
+from resilience import Overloaded
+from shopify_decode import loads_lines
+
+logger = logging.getLogger(__name__)
+
+BULK_RUN_MUTATION = """
+mutation RunBulkQuery($query: String!) {
+  bulkOperationRunQuery(query: $query) {
+    bulkOperation {
+      id
+      status
+    }
+    userErrors {
+      field
+      message
+    }
+  }
+}
+"""
+
+BULK_STATUS_QUERY = """
+query BulkOperation($id: ID!) {
+  node(id: $id) {
+    ... on BulkOperation {
+      id
+      status
+      errorCode
+      objectCount
+      url
+    }
+  }
+}
+"""
+
+# Variant fields each aggregated field needs in the bulk query
+VARIANT_FIELD_SELECTIONS = {
+    "price": ["price"],
+    "cost": ["inventoryItem { unitCost { amount } }"],
+    "profit": ["price", "inventoryItem { unitCost { amount } }"],
+    "margin": ["price", "inventoryItem { unitCost { amount } }"],
+    "markup": ["price", "inventoryItem { unitCost { amount } }"],
+    "inventory": ["inventoryQuantity"],
+}
+METRIC_WORDS = {"average": "average", "total": "total", "min": "lowest", "max": "highest"}
+FAILED_STATUSES = ("FAILED", "CANCELED", "EXPIRED")
+
+
+class CatalogJobError(Exception):
+    """A bulk operation could not be started, failed or took too long"""
+
+
+class CatalogAggregate:
+    """A count of the products matching search (a Shopify search string, "" for
+    every product), or an average/total/min/max of a variant field over them"""
+
+    __slots__ = ("metric", "field", "search", "description")
+
+    def __init__(self, metric, field=None, search="", description="products"):
+        self.metric = metric
+        self.field = field
+        self.search = search
+        # "active products matching 'pelican case'", for answers
+        self.description = description
+
+    @property
+    def key(self):
+        return (self.metric, self.field, self.search)
+
+    def bulk_query(self):
+        """The products query the bulk operation exports; variants only when a field is aggregated"""
+        arguments = f'(query: "{self.search}")' if self.search else ""
+        fields = "id"
+        if self.field:
+            fields += " variants { edges { node { id " + " ".join(VARIANT_FIELD_SELECTIONS[self.field]) + " } } }"
+        return f"{{ products{arguments} {{ edges {{ node {{ {fields} }} }} }} }}"
+
+
+def variant_value(field, node):
+    """A variant's number for field, or None when it cannot be worked out (as in session_models.financials)"""
+    if field == "inventory":
+        return node.get("inventoryQuantity")
+    price_cents = to_cents(node.get("price"))
+    cost_cents = to_cents(((node.get("inventoryItem") or {}).get("unitCost") or {}).get("amount"))
+    if field == "price":
+        return price_cents / 100 if price_cents >= 0 else None
+    if field == "cost":
+        return cost_cents / 100 if cost_cents >= 0 else None
+    if cost_cents <= 0 or price_cents < 0:
+        return None
+    if field == "markup":
+        return price_cents / cost_cents
+    if price_cents == 0:
+        return None
+    if field == "profit":
+        return (price_cents - cost_cents) / 100
+    return (price_cents - cost_cents) / price_cents * 100
+
+
+class RunningAggregate:
+    """Folds bulk JSONL objects into counts, a sum and the extremes, one object at a time"""
+
+    def __init__(self, aggregate):
+        self.aggregate = aggregate
+        self.products = 0
+        self.variants = 0
+        self.values = 0
+        self.total = 0.0
+        self.low = None
+        self.high = None
+
+    def add(self, line):
+        if "__parentId" not in line:
+            self.products += 1
+            return
+        self.variants += 1
+        value = variant_value(self.aggregate.field, line)
+        if value is None:
+            return
+        self.values += 1
+        self.total += value
+        self.low = value if self.low is None else min(self.low, value)
+        self.high = value if self.high is None else max(self.high, value)
+
+    def value(self):
+        metric = self.aggregate.metric
+        if metric == "count":
+            return self.products
+        if not self.values:
+            return None
+        if metric == "average":
+            return self.total / self.values
+        if metric == "total":
+            return self.total
+        return self.low if metric == "min" else self.high
+
+    def result(self):
+        result = {
+            "metric": self.aggregate.metric,
+            "field": self.aggregate.field,
+            "search": self.aggregate.search,
+            "value": self.value(),
+            "products": self.products,
+            "variants": self.variants,
+            "variants_with_value": self.values,
+        }
+        result["answer"] = format_aggregate_answer(self.aggregate, result)
+        return result
+
+
+def format_value(field, value):
+    if field in ("price", "cost", "profit"):
+        return f"${value:,.2f}"
+    if field == "margin":
+        return f"{value:.2f}%"
+    if field == "inventory" and float(value).is_integer():
+        return f"{int(value):,}"
+    return f"{value:,.2f}"
+
+
+def format_aggregate_answer(aggregate, result):
+    if aggregate.metric == "count":
+        return f"There are {result['products']:,} {aggregate.description}."
+    if result["value"] is None:
+        return f"None of the {result['products']:,} {aggregate.description} has a known {aggregate.field}."
+    return (f"The {METRIC_WORDS[aggregate.metric]} {aggregate.field} across {result['variants_with_value']:,} variants "
+            f"of {result['products']:,} {aggregate.description} is {format_value(aggregate.field, result['value'])}.")
+
+
+class CatalogJob:
+    def __init__(self, aggregate, question, version):
+        self.id = uuid.uuid4().hex
+        self.aggregate = aggregate
+        self.question = question
+        self.catalog_version = version
+        self.status = "queued"
+        self.created_at = time.time()
+        self.finished_at = None
+        # Objects Shopify has exported so far, and objects folded into the aggregate
+        self.exported = 0
+        self.processed = 0
+        self.result = None
+        self.error = None
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "question": self.question,
+            "created_at": self.created_at,
+            "finished_at": self.finished_at,
+            "exported_objects": self.exported,
+            "processed_objects": self.processed,
+            "result": self.result,
+            "error": self.error,
+        }
+
+
+class CatalogJobQueue:
+    """Runs catalog jobs on a bounded pool of workers. run_query(query, variables,
+    operation) sends a GraphQL request; download(url) yields the lines of a file.
+    Results are kept under the catalog version each question is submitted
+    with, and enter(version) is the context a job for that version runs in.
+
+    Shopify runs one bulk query per shop at a time (before API 2026-01), so one
+    worker is the default; a job that finds another bulk query running waits
+    for it rather than failing."""
+
+    def __init__(self, run_query, download, workers=1, max_pending=20, poll_seconds=2.0,
+                 timeout_seconds=1800.0, job_ttl_seconds=3600.0, result_ttl_seconds=86400.0,
+                 enter=None):
+        self.run_query = run_query
+        self.download = download
+        self.enter = enter or (lambda version: nullcontext())
+        self.max_pending = max_pending
+        self.poll_seconds = poll_seconds
+        self.timeout_seconds = timeout_seconds
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="catalog-job")
+        self.jobs = TTLCache(job_ttl_seconds, max_entries=1000)
+        # (catalog version, aggregate key) -> result
+        self.results = TTLCache(result_ttl_seconds, max_entries=500, name="catalog_job_results")
+        # Queued and running jobs by (catalog version, aggregate key), so a repeated question joins the running job
+        self.active = {}
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+
+    def submit(self, aggregate, question, version):
+        """(job, result): the finished result for that catalog version if there
+        is one, otherwise the queued or running job that will produce it"""
+        key = (version, aggregate.key)
+        result = self.results.get(key)
+        if result is not None:
+            return None, result
+        with self.lock:
+            job = self.active.get(key)
+            if job is not None:
+                return job, None
+            if len(self.active) >= self.max_pending:
+                raise Overloaded("Too many catalog-wide questions are being worked on", 429, max(1, int(self.poll_seconds)))
+            job = CatalogJob(aggregate, question, version)
+            self.active[key] = job
+            self.jobs.set(job.id, job)
+        self.executor.submit(self.run, job)
+        return job, None
+
+    def get(self, job_id):
+        return self.jobs.get(job_id)
+
+    def drop_store(self, name):
+        """Forget the results and jobs of a store whose catalog changed or which was evicted
+        (versions are (store name, version)); running jobs finish, but nothing joins them"""
+        self.results.pop_matching(lambda key, result: key[0][0] == name)
+        self.jobs.pop_matching(lambda job_id, job: job.catalog_version[0] == name)
+        with self.lock:
+            for key in [key for key in self.active if key[0][0] == name]:
+                del self.active[key]
+
+    def run(self, job):
+        key = (job.catalog_version, job.aggregate.key)
+        job.status = "running"
+        try:
+            with self.enter(job.catalog_version), stage("catalog_job"):
+                job.result = self.execute(job)
+            job.status = "completed"
+            self.results.set(key, job.result)
+        except Exception as e:
+            logger.warning("catalog job %s (%s) failed: %s", job.id, job.question, e)
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            job.finished_at = time.time()
+            # Setting it again restarts its expiry, counted from when it finished
+            self.jobs.set(job.id, job)
+            with self.lock:
+                if self.active.get(key) is job:
+                    del self.active[key]
+
+    def execute(self, job):
+        deadline = time.monotonic() + self.timeout_seconds
+        operation_id = self.start_bulk_operation(job.aggregate.bulk_query(), deadline)
+        url = self.wait_for_bulk_operation(operation_id, job, deadline)
+        aggregate = RunningAggregate(job.aggregate)
+        # No url: the operation completed without exporting anything
+        if url:
+            with stage("catalog_job_download"):
+                for line in loads_lines(self.download(url)):
+                    aggregate.add(line)
+                    job.processed += 1
+        return aggregate.result()
+
+    def start_bulk_operation(self, bulk_query, deadline):
+        while True:
+            result = self.run_query(BULK_RUN_MUTATION, {"query": bulk_query}, "bulk_run")
+            payload = (result.get("data") or {}).get("bulkOperationRunQuery") or {}
+            errors = payload.get("userErrors") or result.get("errors") or []
+            if payload.get("bulkOperation") and not errors:
+                return payload["bulkOperation"]["id"]
+            message = "; ".join(error.get("message", "") for error in errors) or "no bulk operation was started"
+            # Another bulk query is running (another worker's, or one started elsewhere): wait for it
+            if "in progress" not in message.lower() or time.monotonic() > deadline:
+                raise CatalogJobError(message)
+            self.wait()
+
+    def wait_for_bulk_operation(self, operation_id, job, deadline):
+        """The result url once the operation has completed"""
+        while True:
+            result = self.run_query(BULK_STATUS_QUERY, {"id": operation_id}, "bulk_status")
+            operation = (result.get("data") or {}).get("node") or {}
+            status = operation.get("status")
+            job.exported = int(operation.get("objectCount") or 0)
+            if status == "COMPLETED":
+                return operation.get("url")
+            if status in FAILED_STATUSES:
+                raise CatalogJobError(f"bulk operation {status.lower()} ({operation.get('errorCode')})")
+            if time.monotonic() > deadline:
+                raise CatalogJobError(f"bulk operation still {str(status).lower()} after {self.timeout_seconds:.0f}s")
+            self.wait()
+
+    def wait(self):
+        if self.stopped.wait(self.poll_seconds):
+            raise CatalogJobError("shutting down")
+
+    def stop(self):
+        self.stopped.set()
+        self.executor.shutdown(wait=False, cancel_futures=True)
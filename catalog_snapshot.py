@@ -0,0 +1,478 @@
+# catalog_snapshot.py
+#
+# Compact on-disk snapshot of the product catalog (products, variants, SKUs)
+# that every worker opens with mmap and reads without copying, so N workers
+# share one page-cached copy and start without fetching the catalog.
+#
+# Layout (native byte order, every section 8-byte aligned):
+#
+#   header           magic, version, counts, catalog version, created_at
+#   section table    byte offset of each section below
+#   product columns  id, title, handle, status, productType (string ids),
+#                    first_variant, variant_count                  uint32
+#                    interior/exterior length, width, height
+#                    (inches, NaN if unknown)                      float64
+#   variant columns  product, id, sku, title (string ids)          uint32
+#                    price, cost (cents, -1 if unknown)            int64
+#                    inventory (INVENTORY_UNKNOWN if unknown)      int32
+#   sku order        variant indexes sorted by lower-cased SKU     uint32
+#   string offsets   start of each string in the blob (+ end)      uint32
+#   string blob      UTF-8
+#
+# A background refresher writes a new file next to the old one and swaps it
+# in with os.replace; readers notice the new inode and remap.
+#
+#   python -m catalog_snapshot build catalog.snap
+
+import os
+import sys
+import mmap
+import time
+import fcntl
+import math
+import struct
+import logging
+import threading
+from array import array
+
+from catalog_index import AXES, product_dimensions
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b"CATSNAP1"
+FORMAT_VERSION = 2
+HEADER = struct.Struct("=8sIIIIQd")  # magic, version, products, variants, strings, catalog_version, created_at
+INVENTORY_UNKNOWN = -(2 ** 31)
+
+PRODUCT_COLUMNS = [
+    ("p_id", "I"), ("p_title", "I"), ("p_handle", "I"), ("p_status", "I"), ("p_type", "I"),
+    ("p_first_variant", "I"), ("p_variant_count", "I"),
+] + [(f"p_{kind}_{axis}", "d") for kind in ("interior", "exterior") for axis in AXES]
+VARIANT_COLUMNS = [
+    ("v_product", "I"), ("v_id", "I"), ("v_sku", "I"), ("v_title", "I"),
+    ("v_price", "q"), ("v_cost", "q"), ("v_inventory", "i"),
+]
+SECTIONS = [name for name, _ in PRODUCT_COLUMNS + VARIANT_COLUMNS] + ["sku_order", "string_offsets", "string_blob"]
+SECTION_TABLE = struct.Struct("=" + "Q" * len(SECTIONS))
+
+
+def to_cents(value):
+    try:
+        return int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return -1
+
+
+def from_cents(cents):
+    return None if cents < 0 else f"{cents / 100:.2f}"
+
+
+def align(offset):
+    return (offset + 7) & ~7
+
+
+def write_snapshot(path, products, catalog_version=None):
+    """Write products (Shopify-shaped dicts with a flat "variants" list and a
+    metafields connection or parsed "dimensions") and atomically replace path"""
+    strings = {}
+    blob = bytearray()
+    offsets = array("I")
+
+    def string_id(value):
+        value = value or ""
+        if value not in strings:
+            strings[value] = len(offsets)
+            offsets.append(len(blob))
+            blob.extend(value.encode("utf-8"))
+        return strings[value]
+
+    columns = {name: array(code) for name, code in PRODUCT_COLUMNS + VARIANT_COLUMNS}
+    skus = []
+    for product in products:
+        variants = product.get("variants") or []
+        columns["p_id"].append(string_id(product.get("id")))
+        columns["p_title"].append(string_id(product.get("title")))
+        columns["p_handle"].append(string_id(product.get("handle")))
+        columns["p_status"].append(string_id(product.get("status")))
+        columns["p_type"].append(string_id(product.get("productType")))
+        columns["p_first_variant"].append(len(columns["v_id"]))
+        columns["p_variant_count"].append(len(variants))
+        dimensions = product.get("dimensions") or product_dimensions(product)
+        for kind in ("interior", "exterior"):
+            sides = dimensions.get(kind) or (math.nan,) * 3
+            for axis, side in zip(AXES, sides):
+                columns[f"p_{kind}_{axis}"].append(side)
+        for variant in variants:
+            product_index = len(columns["p_id"]) - 1
+            cost = ((variant.get("inventoryItem") or {}).get("unitCost") or {}).get("amount")
+            inventory = variant.get("inventoryQuantity")
+            columns["v_product"].append(product_index)
+            columns["v_id"].append(string_id(variant.get("id")))
+            columns["v_sku"].append(string_id(variant.get("sku")))
+            columns["v_title"].append(string_id(variant.get("title")))
+            columns["v_price"].append(to_cents(variant.get("price")))
+            columns["v_cost"].append(to_cents(cost))
+            columns["v_inventory"].append(INVENTORY_UNKNOWN if inventory is None else int(inventory))
+            skus.append(((variant.get("sku") or "").lower(), len(columns["v_id"]) - 1))
+    offsets.append(len(blob))
+
+    # Variants without a SKU sort first and never match a (non-empty) search
+    sku_order = array("I", [index for sku, index in sorted(skus)])
+    sections = [columns[name] for name, _ in PRODUCT_COLUMNS + VARIANT_COLUMNS] + [sku_order, offsets, bytes(blob)]
+
+    position = align(HEADER.size + SECTION_TABLE.size)
+    section_offsets = []
+    for section in sections:
+        section_offsets.append(position)
+        position = align(position + len(memoryview(section).cast("B")))
+
+    catalog_version = catalog_version or int(time.time() * 1000)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(HEADER.pack(MAGIC, FORMAT_VERSION, len(columns["p_id"]), len(columns["v_id"]),
+                            len(offsets) - 1, catalog_version, time.time()))
+        f.write(SECTION_TABLE.pack(*section_offsets))
+        for offset, section in zip(section_offsets, sections):
+            f.write(b"\0" * (offset - f.tell()))
+            f.write(memoryview(section).cast("B"))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, path)
+    return catalog_version
+
+
+class CatalogSnapshot:
+    """Read-only, zero-copy view of one snapshot file"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.inode = os.fstat(f.fileno()).st_ino
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = self.view = memoryview(self.mm)
+        magic, version, self.product_count, self.variant_count, self.string_count, \
+            self.catalog_version, self.created_at = HEADER.unpack_from(view, 0)
+        if magic != MAGIC or version != FORMAT_VERSION:
+            raise ValueError(f"{path} is not a version {FORMAT_VERSION} catalog snapshot")
+        section_offsets = SECTION_TABLE.unpack_from(view, HEADER.size)
+        lengths = {name: self.product_count for name, _ in PRODUCT_COLUMNS}
+        lengths.update({name: self.variant_count for name, _ in VARIANT_COLUMNS})
+        codes = dict(PRODUCT_COLUMNS + VARIANT_COLUMNS)
+        self.columns = {}
+        for name, offset in zip(SECTIONS, section_offsets):
+            if name in codes:
+                size = struct.calcsize(codes[name]) * lengths[name]
+                self.columns[name] = view[offset:offset + size].cast(codes[name])
+            elif name == "sku_order":
+                self.sku_order = view[offset:offset + 4 * self.variant_count].cast("I")
+            elif name == "string_offsets":
+                self.string_offsets = view[offset:offset + 4 * (self.string_count + 1)].cast("I")
+            else:
+                self.string_blob = view[offset:offset + self.string_offsets[self.string_count]]
+        self.sku_count = len(self.sku_order)
+        # Built once per mapping so lookups by id or title words do not decode every product
+        self.product_indexes = {}
+        self.title_words = {}
+        for index in range(self.product_count):
+            self.product_indexes[self.string(self.columns["p_id"][index])] = index
+            for word in set(self.string(self.columns["p_title"][index]).lower().split()):
+                self.title_words.setdefault(word, []).append(index)
+
+    def close(self):
+        """Unmap the file; only once nothing reads from this snapshot any more"""
+        for column in self.columns.values():
+            column.release()
+        for view in (self.sku_order, self.string_offsets, self.string_blob, self.view):
+            view.release()
+        self.mm.close()
+
+    def string(self, string_id):
+        start, end = self.string_offsets[string_id], self.string_offsets[string_id + 1]
+        return str(self.string_blob[start:end], "utf-8")
+
+    def variant(self, index):
+        c = self.columns
+        inventory = c["v_inventory"][index]
+        cost = from_cents(c["v_cost"][index])
+        return {
+            "id": self.string(c["v_id"][index]),
+            "sku": self.string(c["v_sku"][index]),
+            "title": self.string(c["v_title"][index]),
+            "price": from_cents(c["v_price"][index]),
+            "inventoryQuantity": None if inventory == INVENTORY_UNKNOWN else inventory,
+            "inventoryItem": {"unitCost": {"amount": cost}} if cost is not None else None,
+        }
+
+    def dimensions(self, index):
+        """{"interior": (l, w, h), "exterior": (l, w, h)} for the sides that are known"""
+        dimensions = {}
+        for kind in ("interior", "exterior"):
+            sides = tuple(self.columns[f"p_{kind}_{axis}"][index] for axis in AXES)
+            if not any(math.isnan(side) for side in sides):
+                dimensions[kind] = sides
+        return dimensions
+
+    def dimension_rows(self):
+        """Rows for CatalogIndex.load_dimensions covering every product"""
+        for index in range(self.product_count):
+            dimensions = self.dimensions(index)
+            if dimensions:
+                yield {"id": self.string(self.columns["p_id"][index]),
+                       "title": self.string(self.columns["p_title"][index]), **dimensions}
+
+    def product(self, index, with_variants=True):
+        c = self.columns
+        product = {
+            "id": self.string(c["p_id"][index]),
+            "title": self.string(c["p_title"][index]),
+            "handle": self.string(c["p_handle"][index]),
+            "status": self.string(c["p_status"][index]),
+            "productType": self.string(c["p_type"][index]),
+            "dimensions": self.dimensions(index),
+        }
+        if with_variants:
+            first = c["p_first_variant"][index]
+            product["variants"] = [self.variant(v) for v in range(first, first + c["p_variant_count"][index])]
+        return product
+
+    def find_variant_by_sku(self, sku):
+        """Binary search the SKU order for an exact (case-insensitive) match; returns a variant index"""
+        target = sku.lower()
+        low, high = 0, self.sku_count
+        while low < high:
+            middle = (low + high) // 2
+            index = self.sku_order[middle]
+            value = self.string(self.columns["v_sku"][index]).lower()
+            if value < target:
+                low = middle + 1
+            elif value > target:
+                high = middle
+            else:
+                return index
+        return None
+
+    def find_product_by_sku(self, sku):
+        variant_index = self.find_variant_by_sku(sku)
+        if variant_index is None:
+            return None
+        return self.columns["v_product"][variant_index]
+
+    def find_products_by_title(self, text, limit=10):
+        """Indexes of products whose title contains every word of text"""
+        words = text.lower().split()
+        if not words:
+            return []
+        matches = None
+        for word in words:
+            # A word without spaces is in a title exactly when it is in one of the title's words
+            indexes = set()
+            for title_word, postings in self.title_words.items():
+                if word in title_word:
+                    indexes.update(postings)
+            matches = indexes if matches is None else matches & indexes
+            if not matches:
+                return []
+        return sorted(matches)[:limit]
+
+    def find_product_by_id(self, gid):
+        return self.product_indexes.get(gid)
+
+
+class SharedSnapshot:
+    """The current snapshot at a path, remapped when a refresher swaps in a new file"""
+
+    def __init__(self, path, check_interval=5.0, on_swap=None):
+        self.path = path
+        self.check_interval = check_interval
+        self.on_swap = on_swap
+        self.snapshot = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+
+    def current(self):
+        """The mapped snapshot, or None if no snapshot file exists yet"""
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval and self.snapshot is not None:
+            return self.snapshot
+        with self.lock:
+            self.checked_at = now
+            try:
+                inode = os.stat(self.path).st_ino
+            except FileNotFoundError:
+                return self.snapshot
+            if self.snapshot is None or self.snapshot.inode != inode:
+                try:
+                    snapshot = CatalogSnapshot(self.path)
+                except (OSError, ValueError) as e:
+                    logger.warning("could not open catalog snapshot %s: %s", self.path, e)
+                    return self.snapshot
+                # The old mapping is left to the garbage collector: views of it may still be in use
+                self.snapshot = snapshot
+                logger.info("catalog snapshot %s mapped: %s products, %s variants",
+                            self.path, snapshot.product_count, snapshot.variant_count)
+                if self.on_swap:
+                    self.on_swap(snapshot)
+            return self.snapshot
+
+    def close(self):
+        with self.lock:
+            snapshot, self.snapshot = self.snapshot, None
+        if snapshot is not None:
+            try:
+                snapshot.close()
+            except BufferError:
+                # A caller still holds a view of it: the garbage collector unmaps it later
+                pass
+
+
+CATALOG_VARIANT_FIELDS = """
+              id
+              sku
+              title
+              price
+              inventoryQuantity
+              inventoryItem {
+                unitCost {
+                  amount
+                }
+              }"""
+
+CATALOG_PAGE_QUERY = """
+query CatalogPage($cursor: String) {
+  products(first: 8, after: $cursor) {
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+    edges {
+      node {
+        id
+        title
+        handle
+        status
+        productType
+        metafields(first: 20) {
+          edges {
+            node {
+              namespace
+              key
+              value
+            }
+          }
+        }
+        variants(first: 25) {
+          pageInfo {
+            hasNextPage
+            endCursor
+          }
+          edges {
+            node {""" + CATALOG_VARIANT_FIELDS + """
+            }
+          }
+        }
+      }
+    }
+  }
+}
+"""
+
+# Variants past a product's first 25, for products that have more
+CATALOG_VARIANT_PAGE_QUERY = """
+query CatalogVariants($id: ID!, $cursor: String) {
+  product(id: $id) {
+    variants(first: 100, after: $cursor) {
+      pageInfo {
+        hasNextPage
+        endCursor
+      }
+      edges {
+        node {""" + CATALOG_VARIANT_FIELDS + """
+        }
+      }
+    }
+  }
+}
+"""
+
+
+def fetch_catalog(run_query):
+    """Page through every product, and every variant of each, with run_query(query, variables); variants are flattened"""
+    products = []
+    cursor = None
+    while True:
+        result = run_query(CATALOG_PAGE_QUERY, {"cursor": cursor})
+        page = ((result.get("data") or {}).get("products")) or {}
+        for edge in page.get("edges", []):
+            node = edge["node"]
+            connection = node.get("variants") or {}
+            node["variants"] = [v["node"] for v in connection.get("edges", [])]
+            variant_page = connection.get("pageInfo") or {}
+            while variant_page.get("hasNextPage"):
+                more = run_query(CATALOG_VARIANT_PAGE_QUERY, {"id": node["id"], "cursor": variant_page.get("endCursor")})
+                connection = (((more.get("data") or {}).get("product")) or {}).get("variants") or {}
+                node["variants"].extend(v["node"] for v in connection.get("edges", []))
+                variant_page = connection.get("pageInfo") or {}
+            products.append(node)
+        page_info = page.get("pageInfo") or {}
+        if not page_info.get("hasNextPage"):
+            return products
+        cursor = page_info.get("endCursor")
+
+
+class SnapshotRefresher:
+    """Rebuilds the snapshot every interval. Workers race for a lock file so
+    only one of them fetches the catalog; the rest just remap the result."""
+
+    def __init__(self, path, interval, fetch_products):
+        self.path = path
+        self.interval = interval
+        self.fetch_products = fetch_products
+        self.stopped = threading.Event()
+
+    def refresh_once(self):
+        with open(f"{self.path}.lock", "w") as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return False
+            try:
+                if os.path.exists(self.path) and time.time() - os.path.getmtime(self.path) < self.interval / 2:
+                    return False
+                start = time.monotonic()
+                products = self.fetch_products()
+                version = write_snapshot(self.path, products)
+                logger.info("catalog snapshot %s written: %s products in %.1fs (version %s)",
+                            self.path, len(products), time.monotonic() - start, version)
+                return True
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                self.refresh_once()
+            except Exception as e:
+                logger.warning("catalog snapshot refresh failed: %s", e)
+            self.stopped.wait(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run, name="catalog-snapshot", daemon=True).start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+
+
+def main(argv=None):
+    argv = argv if argv is not None else sys.argv[1:]
+    if len(argv) != 2 or argv[0] != "build":
+        print("usage: python -m catalog_snapshot build <path>")
+        return 2
+    import chatbot_api
+    products = fetch_catalog(lambda query, variables: chatbot_api.run_shopify_query(query, variables, operation="catalog_page"))
+    version = write_snapshot(argv[1], products)
+    print(f"wrote {argv[1]}: {len(products)} products (version {version})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
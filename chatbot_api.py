@@ -1,29 +1,187 @@
 #Currently Testing
 
 import os
+import time
+import logging
+import threading
+import contextvars
 import requests
-from openai import OpenAI
 from dotenv import load_dotenv
+
+# Load environment variables (before the modules below read their settings)
+load_dotenv()
+
+from openai import OpenAI
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from model_router import ModelRouter, load_model_routes
+from resilience import call_upstream, RetryableUpstreamError, UpstreamUnavailable, DeadlineExceeded, upstream_failed, note_upstream_failure, SingleFlight, remaining_budget, request_budget, Overloaded
+from metrics import stage, traced, record_shopify_cost
+from query_log import request_key, record_upstream, replayed_response, replay_active, not_recorded
+from catalog_snapshot import SnapshotRefresher, fetch_catalog
+from catalog_index import UNIT_PATTERN, to_inches, product_dimensions, format_dimensions
+from catalog_jobs import CatalogJobQueue, CatalogAggregate
+from stores import Store, StoreRegistry, load_store_configs, use_store
+from vector_index import tokens as vector_tokens
+from prompts import (
+    PRODUCT_INTENT, COMPARISON_INTENT, STATUS_CATEGORY_INTENT, DATE_INTENT, VARIANT_INTENT, PRODUCT_ANSWER,
+    COMPARISON_FIELD_ANSWER, COMPARISON_ANSWER, COLOR_INTERIOR_MATCH, PELICAN_MATCH,
+)
+from accounting import SessionUsage, BudgetExceeded, track_usage, set_intent, check_shopify_budget, record_shopify_usage
+from session_models import ClarificationContext, ResolvedProduct, Product
+from shopify_decode import loads, dumps, decode_search, decode_product
 from typing import Dict
 import re
 
-# Load environment variables
-load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 SHOPIFY_ADMIN_API_TOKEN = os.getenv("SHOPIFY_ADMIN_API_TOKEN")
 SHOPIFY_STORE_URL = os.getenv("SHOPIFY_STORE_URL")
 
-# Initialize OpenAI client
-openai_client = OpenAI(api_key=OPENAI_API_KEY)
+# OpenAI client (OPENAI_BASE_URL points it at any OpenAI-compatible server). It is
+# created on first use or during startup warm-up rather than at import time.
+# Retries are handled by the resilience layer, so the client's own retries are disabled
+def create_openai_client():
+    return OpenAI(api_key=OPENAI_API_KEY, base_url=os.getenv("OPENAI_BASE_URL") or None, max_retries=0)
+
+
+# Per-call-site model selection with latency-aware fallback
+model_router = ModelRouter(create_openai_client, load_model_routes())
+
+logger = logging.getLogger(__name__)
+
+# Keep-alive connection pool per Shopify store
+SHOPIFY_POOL_SIZE = int(os.getenv("SHOPIFY_POOL_SIZE", "20"))
+SHOPIFY_TIMEOUT_SECONDS = float(os.getenv("SHOPIFY_TIMEOUT_SECONDS", "10"))
+
+# Product searches and details, per store; stale entries are still served while Shopify is unavailable
+PRODUCT_CACHE_TTL_SECONDS = float(os.getenv("PRODUCT_CACHE_TTL_SECONDS", "300"))
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "2000"))
+
+# NEW: Memory-mapped catalog snapshot shared by every worker (CATALOG_SNAPSHOT_PATH for
+# the default store, "snapshot_path" for others); answers exact SKU searches without
+# Shopify and is the last fallback while Shopify is unavailable
+CATALOG_SNAPSHOT_REFRESH_SECONDS = float(os.getenv("CATALOG_SNAPSHOT_REFRESH_SECONDS", "0"))
+# Selections a snapshot product can answer
+SNAPSHOT_SELECTIONS = frozenset({"variant_price", "unit_cost", "inventory"})
+
+# Answers to repeated questions, per store
+ANSWER_CACHE_TTL_SECONDS = float(os.getenv("ANSWER_CACHE_TTL_SECONDS", "600"))
+ANSWER_CACHE_MAX_ENTRIES = int(os.getenv("ANSWER_CACHE_MAX_ENTRIES", "5000"))
+
+
+# NEW: The stores served (see stores.py); everything below reads the current request's store
+def build_store(config, catalog_version):
+    store = Store(config, SHOPIFY_POOL_SIZE, PRODUCT_CACHE_TTL_SECONDS, PRODUCT_CACHE_MAX_ENTRIES,
+                  ANSWER_CACHE_TTL_SECONDS, ANSWER_CACHE_MAX_ENTRIES, catalog_version)
+    if store.snapshot:
+        store.snapshot.on_swap = lambda snapshot: on_snapshot_swap(store, snapshot)
+    return store
+
+
+# Catalog job results are kept process-wide, so an evicted store's are dropped with it
+stores = StoreRegistry(load_store_configs(), build_store, on_evict=lambda store: catalog_jobs.drop_store(store.name))
+
+
+def current_store():
+    return stores.current()
+
+
+def current_snapshot():
+    snapshot = current_store().snapshot
+    return snapshot.current() if snapshot else None
+
+
+def is_throttled(result):
+    errors = result.get("errors") or []
+    return isinstance(errors, list) and any(
+        error.get("extensions", {}).get("code") == "THROTTLED" for error in errors
+    )
+
+
+# Identical queries (same text and variables) in flight at once share one call
+shopify_flights = SingleFlight("shopify")
 
-# Shopify headers
-headers = {
-    "X-Shopify-Access-Token": SHOPIFY_ADMIN_API_TOKEN,
-    "Content-Type": "application/json"
-}
+
+# NEW: Send a GraphQL query to the Shopify Admin API with timeouts, retries and a circuit breaker
+def run_shopify_query(query, variables=None, operation="query"):
+    store = current_store()
+    payload = {"query": query}
+    if variables:
+        payload["variables"] = variables
+    body = dumps(payload)
+
+    def post(timeout):
+        try:
+            response = store.session.post(store.graphql_url, headers=store.headers, data=body, timeout=timeout)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise RetryableUpstreamError(str(e)) from e
+        if response.status_code == 429 or response.status_code >= 500:
+            raise RetryableUpstreamError(f"HTTP {response.status_code}")
+        result = loads(response.content)
+        # Every response sent is counted, retried and throttled ones included
+        record_shopify_usage(operation, result)
+        store.cost_bucket.update(operation, (result.get("extensions") or {}).get("cost") or {})
+        if is_throttled(result):
+            raise RetryableUpstreamError("THROTTLED")
+        return result
+
+    # Past the request's cost budget this raises BudgetExceeded and the caller falls back to cached or snapshot data
+    check_shopify_budget()
+    key = request_key(query, variables)
+    with stage(f"shopify_{operation}") as span:
+        result = replayed_response("shopify", key)
+        if result is None:
+            start = time.monotonic()
+            result = shopify_flights.do((store.name, key), lambda: call_shopify(store, operation, post))
+            record_upstream("shopify", key, result, time.monotonic() - start)
+        cost = record_shopify_cost(operation, result)
+        if cost:
+            span.set("requested_cost", cost.get("requestedQueryCost"))
+            span.set("actual_cost", cost.get("actualQueryCost"))
+    return result
+
+
+def call_shopify(store, operation, post):
+    # Wait for the store's cost bucket rather than be throttled
+    store.cost_bucket.acquire(operation)
+    return call_upstream(store.upstream, post, SHOPIFY_TIMEOUT_SECONDS)
+
+
+# NEW: Fresh per-conversation state; a pending clarification is a compact ClarificationContext
+def new_conversation_state():
+    return {
+        "awaiting_clarification": False,
+        "clarification": None,
+        "prefetched_details": {},
+        # ResolvedProduct the last answer was about, for follow-up questions
+        "last_resolved": None,
+        # Tokens and Shopify query cost spent by the conversation so far
+        "usage": SessionUsage(),
+    }
+
+
+def start_clarification(conversation_state, clarification):
+    conversation_state["awaiting_clarification"] = True
+    conversation_state["clarification"] = clarification
+
+
+def end_clarification(conversation_state):
+    conversation_state["awaiting_clarification"] = False
+    conversation_state["clarification"] = None
+
+
+def remember_resolved(conversation_state, product, variant, requested_info):
+    """Keep the product an answer was about, trimmed to its one variant"""
+    resolved = ResolvedProduct(
+        Product(product.id, product.title, product.image_url, product.dimensions, (variant,) if variant else ()),
+        requested_info,
+    )
+    conversation_state["last_resolved"] = resolved
+    return resolved
 
 
 # NEW: Check if input is product-related
+@traced("routing")
 def is_product_related_query(query):
     """Check if the query is actually asking about a product"""
     
@@ -109,28 +267,38 @@ def generate_general_response(query):
     return "I'm here to help you with product information! You can ask me about:\n• Product prices, costs, and inventory\n• Profit and margin calculations\n• Product comparisons\n• Finding products by category or status\n\nWhat product would you like to know about?"
 
 
-# Extract product intent
-def extract_product_intent(query):
-    prompt = f"""
-From the query below, extract:
-1. product_name_or_sku (string) - can be SKU, part number, P/N, or product title keywords
-2. requested_info (list of fields like price, cost, inventory, dimensions, profit, margin, markup)
-
-Note: SKU can also be referred to as "part number" or "P/N"
+# NEW: Words that are never part of a product name when extracting intent without the LLM
+INTENT_STOPWORDS = {
+    'what', 'whats', "what's", 'is', 'the', 'of', 'for', 'a', 'an', 'me', 'give', 'show', 'tell',
+    'about', 'how', 'much', 'many', 'does', 'do', 'i', 'need', 'want', 'find', 'search', 'and',
+    'please', 'can', 'you', 'its', 'it', 'this', 'that', 'on', 'in', 'with', 'product', 'item',
+    'sku', 'part', 'number', 'p/n', 'are', 'there', 'current', 'unit', 'per'
+}
 
-IMPORTANT: Only extract if this is clearly a product-related query. If the query is a greeting, general question, or doesn't mention any specific product, return null.
 
-Respond as JSON:
-{{"product_name_or_sku": "...", "requested_info": ["...", "..."]}}
+def fallback_product_intent(query):
+    """Keyword-based intent extraction used when the LLM is unavailable"""
+    requested_info = sorted(normalize_requested_fields([query]))
+    field_words = {alias for aliases in REQUESTED_FIELD_ALIASES.values() for alias in aliases}
+    words = re.findall(r"[A-Za-z0-9][-A-Za-z0-9/.']*", query)
+    name_words = [
+        word for word in words
+        if word.lower() not in INTENT_STOPWORDS and word.lower().rstrip('s') not in field_words
+    ]
+    if not name_words:
+        return None
+    return {"product_name_or_sku": " ".join(name_words), "requested_info": requested_info}
 
-If this is not a product query, respond with:
-{{"product_name_or_sku": null, "requested_info": []}}
 
-Query: "{query}"
-"""
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=300
-    )
+# Extract product intent
+@traced("extract_product_intent")
+def extract_product_intent(query):
+    try:
+        response = model_router.complete(
+            "intent_extraction", messages=PRODUCT_INTENT.messages(query=query), temperature=0
+        )
+    except UpstreamUnavailable:
+        return fallback_product_intent(query)
     try:
         result = eval(response.choices[0].message.content.strip())
         # Additional validation
@@ -142,24 +310,15 @@ Query: "{query}"
 
 
 # Extract comparison intent
+@traced("extract_comparison_intent")
 def extract_comparison_intent(query):
-    prompt = f"""
-From the query below, determine if this is a comparison query and extract:
-1. is_comparison (boolean)
-2. product1_name_or_sku (string)
-3. product2_name_or_sku (string)
-4. requested_info (list of fields like price, cost, inventory, dimensions, profit, margin)
-
-Look for keywords like "compare", "vs", "versus", "difference between", "and" connecting two products.
-
-Respond as JSON:
-{{"is_comparison": true/false, "product1_name_or_sku": "...", "product2_name_or_sku": "...", "requested_info": ["...", "..."]}}
-
-Query: "{query}"
-"""
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=300
-    )
+    try:
+        response = model_router.complete(
+            "intent_extraction", messages=COMPARISON_INTENT.messages(query=query), temperature=0
+        )
+    except UpstreamUnavailable:
+        # The manual comparison pattern in handle_user_input takes over
+        return None
     try:
         result = eval(response.choices[0].message.content.strip())
         return result
@@ -169,6 +328,7 @@ Query: "{query}"
 
 
 # ENHANCED: Extract status and category based queries
+@traced("extract_status_and_category_intent")
 def extract_status_and_category_intent(query):
     """Extract intent for status and category-based queries"""
     query_lower = query.lower()
@@ -233,27 +393,9 @@ def extract_status_and_category_intent(query):
     
     # Use GPT as fallback for complex queries
     if (is_status_query and not status_value) or (is_category_query and not category_value):
-        prompt = f"""
-From the query below, extract:
-1. status_value (one of: DRAFT, ACTIVE, ARCHIVED, or empty string if not mentioned)
-2. category_value (the product category/type mentioned, or empty string if not mentioned)
-
-Query: "{query}"
-
-Examples:
-- "Which products have status 'Draft' and are categorized as 'Uncategorized'?" 
-  -> status_value: "DRAFT", category_value: "Uncategorized"
-- "How many active wine products?"
-  -> status_value: "ACTIVE", category_value: "wine"
-- "List all draft products"
-  -> status_value: "DRAFT", category_value: ""
-
-Respond as JSON:
-{{"status_value": "...", "category_value": "..."}}
-"""
         try:
-            response = openai_client.chat.completions.create(
-                model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=200
+            response = model_router.complete(
+                "intent_extraction", messages=STATUS_CATEGORY_INTENT.messages(query=query), temperature=0
             )
             result = eval(response.choices[0].message.content.strip())
             if result.get("status_value"):
@@ -274,6 +416,7 @@ Respond as JSON:
         "is_combined_query": is_status_query and is_category_query
     }
 
+@traced("extract_date_intent")
 def extract_date_intent(query):
     """Extract date-based query intent"""
     query_lower = query.lower()
@@ -286,29 +429,9 @@ def extract_date_intent(query):
         return None
     
     # Use GPT to extract date information
-    prompt = f"""
-From the query below, extract:
-1. date_condition (one of: "after", "before", "on")
-2. date_value (in YYYY-MM-DD format)
-3. query_type (one of: "list", "count")
-
-Examples:
-- "List products created after August 1, 2024" -> date_condition: "after", date_value: "2024-08-01", query_type: "list"
-- "How many products were created before January 15, 2024?" -> date_condition: "before", date_value: "2024-01-15", query_type: "count"
-- "Show products created on December 1, 2023" -> date_condition: "on", date_value: "2023-12-01", query_type: "list"
-
-Query: "{query}"
-
-Respond as JSON:
-{{"date_condition": "...", "date_value": "...", "query_type": "..."}}
-"""
-    
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo", 
-            messages=[{"role": "user", "content": prompt}], 
-            temperature=0, 
-            max_tokens=200
+        response = model_router.complete(
+            "intent_extraction", messages=DATE_INTENT.messages(query=query), temperature=0
         )
         result = eval(response.choices[0].message.content.strip())
         return result
@@ -333,74 +456,17 @@ def fetch_inventory_item_details(inventory_item_id):
     }}
     """
     
-    response = requests.post(
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-        headers=headers,
-        json={"query": query}
-    )
-    
-    result = response.json()
+    result = run_shopify_query(query, operation="inventory_item")
     return result.get("data", {}).get("inventoryItem", {})
 
 
-# NEW: Calculate profit and margin
-def calculate_profit_and_margin(cost, price):
-    """Calculate profit and margin from cost and price"""
-    try:
-        cost_float = float(cost) if cost and cost != "N/A" else 0
-        price_float = float(price) if price and price != "N/A" else 0
-        
-        if cost_float == 0 or price_float == 0:
-            return {"profit": "N/A", "margin": "N/A"}
-        
-        profit = price_float - cost_float
-        margin = (profit / price_float) * 100
-        
-        return {
-            "profit": f"{profit:.2f}",
-            "margin": f"{margin:.2f}%"
-        }
-    except (ValueError, TypeError, ZeroDivisionError):
-        return {"profit": "N/A", "margin": "N/A"}
-
-
-def calculate_markup(cost, price):
-    """Calculate markup from cost and price (Price / Cost)"""
-    try:
-        cost_float = float(cost) if cost and cost != "N/A" else 0
-        price_float = float(price) if price and price != "N/A" else 0
-        
-        if cost_float == 0:
-            return {"markup": "N/A"}
-        
-        markup = price_float / cost_float
-        
-        return {"markup": f"{markup:.2f}"}
-    except (ValueError, TypeError, ZeroDivisionError):
-        return {"markup": "N/A"}
-
-
-
 # Clarify which variant and what info
+@traced("extract_variant_intent")
 def extract_variant_intent(user_input, variants):
     variant_titles = [v["node"]["title"] for v in variants]
     variant_list_str = "\n".join(f"- {title}" for title in variant_titles)
-    prompt = f"""
-You are helping identify which variant the user means and what info they want.
-
-Variants:
-{variant_list_str}
-
-User query: "{user_input}"
-
-Return JSON like:
-{{"matched_variant_title": "exact title", "requested_info": ["cost", "price", "profit", "margin"]}}
-
-If uncertain, return:
-{{"matched_variant_title": null, "requested_info": []}}
-"""
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo", messages=[{"role": "user", "content": prompt}], temperature=0, max_tokens=300
+    response = model_router.complete(
+        "variant_matching", messages=VARIANT_INTENT.messages(variants=variant_list_str, query=user_input), temperature=0
     )
     try:
         return eval(response.choices[0].message.content.strip())
@@ -447,13 +513,7 @@ def search_products_by_criteria(status=None, category=None):
     
     # print(f"GraphQL Query: {query}")  # Debug print
     
-    response = requests.post(
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-        headers=headers,
-        json={"query": query}
-    )
-    
-    result = response.json()
+    result = run_shopify_query(query, operation="products_by_criteria")
     # print(f"API Response: {result}")  # Debug print
     
     return result
@@ -493,19 +553,13 @@ def search_products_by_date(date_condition, date_value):
     
     # print(f"Date GraphQL Query: {query}")  # Debug print
     
-    response = requests.post(
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-        headers=headers,
-        json={"query": query}
-    )
-    
-    result = response.json()
+    result = run_shopify_query(query, operation="products_by_date")
     # print(f"Date API Response: {result}")  # Debug print
     
     return result
 
 # Search Shopify products with fuzzy matching
-def search_products(query_string):
+def search_products_from_shopify(query_string):
     query = f"""
     {{
       products(first: 10, query: "title:{query_string} OR sku:{query_string} OR tag:{query_string}") {{
@@ -519,12 +573,7 @@ def search_products(query_string):
       }}
     }}
     """
-    response = requests.post(
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-        headers=headers,
-        json={"query": query}
-    )
-    result = response.json()
+    result = run_shopify_query(query, operation="search")
     products = result.get("data", {}).get("products", {}).get("edges", [])
     
     if not products:
@@ -551,21 +600,314 @@ def search_products(query_string):
         }}
         """
         
-        response = requests.post(
-            f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-            headers=headers,
-            json={"query": fuzzy_query}
-        )
-        result = response.json()
+        result = run_shopify_query(fuzzy_query, operation="search_fuzzy")
     
     return result
 
 
-# UPDATED: Fetch product details by GID with inventory item information
-def fetch_product_details_by_gid(gid):
-    query = f"""
-    {{
-      product(id: "{gid}") {{
+# NEW: Search results and product details built from the catalog snapshot
+def snapshot_search_result(snapshot, product_indexes):
+    edges = []
+    for index in product_indexes:
+        product = snapshot.product(index, with_variants=False)
+        edges.append({"node": {"id": product["id"], "title": product["title"], "handle": product["handle"]}})
+    return {"data": {"products": {"edges": edges}}}
+
+
+def snapshot_product_result(gid):
+    snapshot = current_snapshot()
+    index = snapshot.find_product_by_id(gid) if snapshot else None
+    if index is None:
+        return None
+    product = snapshot.product(index)
+    product["variants"] = {"edges": [{"node": variant} for variant in product["variants"]]}
+    return {"data": {"product": product}}
+
+
+def start_catalog_snapshot_refreshers():
+    """Rebuild each store's snapshot in the background every CATALOG_SNAPSHOT_REFRESH_SECONDS"""
+    if CATALOG_SNAPSHOT_REFRESH_SECONDS <= 0:
+        return []
+
+    def fetcher(name):
+        def fetch_products():
+            with use_store(stores.get(name)):
+                return fetch_catalog(lambda query, variables: run_shopify_query(query, variables, operation="catalog_page"))
+        return fetch_products
+
+    return [
+        SnapshotRefresher(config.snapshot_path, CATALOG_SNAPSHOT_REFRESH_SECONDS, fetcher(name)).start()
+        for name, config in stores.configs.items() if config.snapshot_path
+    ]
+
+
+# NEW: Serve repeated searches from cache, and stale results while Shopify is unavailable
+def search_products(query_string):
+    search_results_cache = current_store().search_results
+    cached = search_results_cache.get(query_string)
+    if cached is not None:
+        return cached
+    snapshot = current_snapshot()
+    if snapshot:
+        product_index = snapshot.find_product_by_sku(query_string.strip())
+        if product_index is not None:
+            return snapshot_search_result(snapshot, [product_index])
+    try:
+        result = search_products_from_shopify(query_string)
+    except UpstreamUnavailable:
+        stale = search_results_cache.get(query_string, allow_stale=True)
+        if stale is None and snapshot:
+            matches = snapshot.find_products_by_title(query_string)
+            if matches:
+                logger.warning("Shopify unavailable, searching the catalog snapshot for %r", query_string)
+                return snapshot_search_result(snapshot, matches)
+        if stale is None:
+            raise
+        logger.warning("Shopify unavailable, serving cached search for %r", query_string)
+        return stale
+    if VECTOR_SEARCH and needs_vector_search(query_string, result.get("data", {}).get("products", {}).get("edges")):
+        result = vector_search_result(query_string) or result
+    if result.get("data", {}).get("products", {}).get("edges"):
+        search_results_cache.set(query_string, result)
+    return result
+
+
+# NEW: Descriptive queries ("waterproof case that fits a DJI drone") name no title
+# or SKU. When exact and fuzzy search find nothing, or only products sharing some
+# of their words, they are answered from the store's local vector index over
+# title, productType, tags and description (see vector_index.py)
+VECTOR_SEARCH = os.getenv("VECTOR_SEARCH", "1") == "1"
+VECTOR_SEARCH_TOP_K = int(os.getenv("VECTOR_SEARCH_TOP_K", "5"))
+VECTOR_SEARCH_MIN_SCORE = float(os.getenv("VECTOR_SEARCH_MIN_SCORE", "0.15"))
+# Matches scoring within this fraction of the best one are offered together for clarification
+VECTOR_SEARCH_RELATIVE_SCORE = float(os.getenv("VECTOR_SEARCH_RELATIVE_SCORE", "0.9"))
+VECTOR_SEARCH_MIN_WORDS = 3
+VECTOR_INDEX_REFRESH_SECONDS = float(os.getenv("VECTOR_INDEX_REFRESH_SECONDS", "3600"))
+
+CATALOG_TEXT_QUERY = """
+query CatalogText($cursor: String) {
+  products(first: 100, after: $cursor) {
+    pageInfo {
+      hasNextPage
+      endCursor
+    }
+    edges {
+      node {
+        id
+        title
+        handle
+        productType
+        tags
+        description
+      }
+    }
+  }
+}
+"""
+
+
+def needs_vector_search(query_string, edges):
+    """Nothing was found, or a descriptive query (several words, no model number) only matched some of its words"""
+    if not edges:
+        return True
+    words = vector_tokens(query_string)
+    if len(words) < VECTOR_SEARCH_MIN_WORDS or any(char.isdigit() for word in words for char in word):
+        return False
+    return not any(all(word in (edge["node"].get("title") or "").lower() for word in words) for edge in edges)
+
+
+@traced("vector_search")
+def vector_search_result(query_string):
+    """A search result from the vector index, or None when it has nothing close enough"""
+    if not ensure_vector_index():
+        return None
+    matches = current_store().vector_index.search(
+        [query_string], k=VECTOR_SEARCH_TOP_K, min_score=VECTOR_SEARCH_MIN_SCORE
+    )[0]
+    if not matches:
+        return None
+    best = matches[0][1]
+    edges = [{"node": payload} for _, score, payload in matches if score >= best * VECTOR_SEARCH_RELATIVE_SCORE]
+    logger.info("vector search for %r: %s (best score %.2f)", query_string, [e["node"]["title"] for e in edges], best)
+    return {"data": {"products": {"edges": edges}}}
+
+
+def product_text_fields(product):
+    """The weighted text a product is indexed by"""
+    tags = product.get("tags") or []
+    return [
+        (product.get("title") or "", 2.0),
+        (product.get("productType") or "", 1.5),
+        (" ".join(tags), 1.5),
+        (product.get("description") or "", 1.0),
+    ]
+
+
+def fetch_catalog_text():
+    products = []
+    cursor = None
+    while True:
+        result = run_shopify_query(CATALOG_TEXT_QUERY, {"cursor": cursor}, operation="catalog_text_page")
+        page = (result.get("data") or {}).get("products") or {}
+        products.extend(edge["node"] for edge in page.get("edges", []))
+        page_info = page.get("pageInfo") or {}
+        if not page_info.get("hasNextPage"):
+            return products
+        cursor = page_info.get("endCursor")
+
+
+def load_vector_index(store):
+    with use_store(store):
+        products = fetch_catalog_text()
+    store.vector_index.load(
+        (p["id"], product_text_fields(p), {"id": p["id"], "title": p.get("title"), "handle": p.get("handle")})
+        for p in products
+    )
+    logger.info("store %s: vector index loaded, %s products", store.name, len(products))
+
+
+# Per-store indexes too big to build inside a request are loaded in a thread
+BACKGROUND_LOAD_RETRY_SECONDS = 300
+background_load_lock = threading.Lock()
+# (what, store name) -> when loading it in the background started, while it loads and after it failed;
+# by name, so an evicted store is not kept alive by it
+background_load_attempts = {}
+
+
+def start_background_load(what, store, load):
+    """Run load(store) in a thread unless one for the same store is running or failed
+    less than BACKGROUND_LOAD_RETRY_SECONDS ago"""
+    key = (what, store.name)
+    now = time.monotonic()
+    with background_load_lock:
+        started = background_load_attempts.get(key)
+        if started is not None and now - started <= BACKGROUND_LOAD_RETRY_SECONDS:
+            return
+        background_load_attempts[key] = now
+    threading.Thread(target=run_background_load, args=(what, store, load), name=what, daemon=True).start()
+
+
+def run_background_load(what, store, load):
+    try:
+        load(store)
+    except Exception as e:
+        # Tried again BACKGROUND_LOAD_RETRY_SECONDS after it started
+        logger.warning("store %s: loading the %s failed: %s", store.name, what, e)
+        return
+    with background_load_lock:
+        background_load_attempts.pop((what, store.name), None)
+
+
+def ensure_vector_index():
+    """True once the store's vector index is loaded; it is (re)loaded in the background
+    when missing or older than VECTOR_INDEX_REFRESH_SECONDS, never inside a request"""
+    store = current_store()
+    loaded_at = store.vector_index.loaded_at
+    if loaded_at is None or time.monotonic() - loaded_at > VECTOR_INDEX_REFRESH_SECONDS:
+        start_background_load("vector-index", store, load_vector_index)
+    return loaded_at is not None
+
+
+# NEW: Map each requested field to the parts of the product query it needs
+PRODUCT_FIELD_SELECTIONS = {
+    "price": {"variant_price"},
+    "cost": {"unit_cost"},
+    "profit": {"variant_price", "unit_cost"},
+    "margin": {"variant_price", "unit_cost"},
+    "markup": {"variant_price", "unit_cost"},
+    "inventory": {"inventory"},
+    "dimensions": {"metafields"},
+    "image_url": {"images"},
+}
+
+ALL_PRODUCT_SELECTIONS = frozenset().union(*PRODUCT_FIELD_SELECTIONS.values())
+
+# Words the intent extractor uses for the fields above
+REQUESTED_FIELD_ALIASES = {
+    "price": ["price", "pricing"],
+    "cost": ["cost"],
+    "profit": ["profit"],
+    "margin": ["margin"],
+    "markup": ["markup", "mark up", "mark-up"],
+    "inventory": ["inventory", "stock", "quantity", "qty"],
+    "dimensions": ["dimension", "size", "measurement", "length", "width", "height"],
+    "image_url": ["image", "picture", "photo"],
+}
+
+
+def normalize_requested_fields(requested_info):
+    """Map free-form requested_info entries onto the known field names"""
+    fields = set()
+    for item in requested_info or []:
+        item_lower = str(item).lower().strip()
+        for field, aliases in REQUESTED_FIELD_ALIASES.items():
+            if any(alias in item_lower for alias in aliases):
+                fields.add(field)
+    return fields
+
+
+def product_query_selections(requested_info):
+    """Work out which optional parts of the product query are needed"""
+    fields = normalize_requested_fields(requested_info)
+    # Nothing recognisable was asked for, so fetch everything like before
+    if not fields:
+        return ALL_PRODUCT_SELECTIONS
+    selections = set()
+    for field in fields:
+        selections |= PRODUCT_FIELD_SELECTIONS[field]
+    return frozenset(selections)
+
+
+def build_variant_fields(selections):
+    """Variant fields for the given selections, indented for the variants connection"""
+    variant_fields = ["id", "sku", "title", """selectedOptions {
+                name
+                value
+              }"""]
+    if "variant_price" in selections:
+        variant_fields.append("price")
+    if "inventory" in selections:
+        variant_fields.append("inventoryQuantity")
+    if "unit_cost" in selections:
+        variant_fields.append("""inventoryItem {
+                id
+                unitCost {
+                  amount
+                  currencyCode
+                }
+                tracked
+              }""")
+    return "\n              ".join(variant_fields)
+
+
+def build_product_fields(selections):
+    """Product fields for the given selections, shared by the single and batched queries"""
+    variant_block = build_variant_fields(selections)
+
+    optional_blocks = []
+    if "metafields" in selections:
+        optional_blocks.append("""metafields(first: 20) {
+          edges {
+            node {
+              namespace
+              key
+              value
+            }
+          }
+        }""")
+    if "images" in selections:
+        optional_blocks.append("""images(first: 1) {
+          edges {
+            node {
+              url
+              altText
+            }
+          }
+        }""")
+    optional_block = "\n        ".join(optional_blocks)
+
+    return f"""
+        id
         title
         handle
         createdAt
@@ -574,108 +916,364 @@ def fetch_product_details_by_gid(gid):
         productType
         tags
         onlineStoreUrl
-        metafields(first: 20) {{
-          edges {{
-            node {{
-              namespace
-              key
-              value
-            }}
-          }}
-        }}
         variants(first: 10) {{
+          pageInfo {{
+            hasNextPage
+            endCursor
+          }}
           edges {{
             node {{
-              id
-              sku
-              title
-              price
-              inventoryQuantity
-              inventoryItem {{
-                id
-                unitCost {{
-                  amount
-                  currencyCode
-                }}
-                tracked
-              }}
+              {variant_block}
             }}
           }}
         }}
-        images(first: 1) {{
+        {optional_block}
+"""
+
+
+def build_product_details_query(selections):
+    """Compose the product details query for the given selections"""
+    return f"""
+    query ProductDetails($id: ID!) {{
+      product(id: $id) {{{build_product_fields(selections)}      }}
+    }}
+    """
+
+
+def build_product_nodes_query(selections):
+    """The product details query for several products at once"""
+    return f"""
+    query ProductNodes($ids: [ID!]!) {{
+      nodes(ids: $ids) {{
+      ... on Product {{{build_product_fields(selections)}      }}
+      }}
+    }}
+    """
+
+
+def estimate_product_query_cost(selections, variant_pages=0):
+    """Estimate Shopify's requested query cost for a product details query
+    and `variant_pages` follow-up pages of variants.
+
+    Objects cost 1 and connections cost 2 plus `first` times the cost of
+    each node, which is how Shopify calculates the requested cost.
+    """
+    variant_node_cost = 1
+    if "unit_cost" in selections:
+        variant_node_cost += 2  # inventoryItem + unitCost
+    # product + variants connection + pageInfo
+    cost = 1 + 2 + 10 * variant_node_cost + 1
+    if "metafields" in selections:
+        cost += 2 + 20
+    if "images" in selections:
+        cost += 2 + 1
+    cost += variant_pages * (1 + 2 + VARIANT_PAGE_SIZE * variant_node_cost + 1)
+    return cost
+
+
+# Cache the composed query text so identical selections send identical queries
+PRODUCT_QUERY_CACHE = {}
+
+def get_product_details_query(selections):
+    query = PRODUCT_QUERY_CACHE.get(selections)
+    if query is None:
+        query = build_product_details_query(selections)
+        PRODUCT_QUERY_CACHE[selections] = query
+    return query
+
+
+# NEW: Variants past the first page are fetched in pages of VARIANT_PAGE_SIZE
+VARIANT_PAGE_SIZE = int(os.getenv("VARIANT_PAGE_SIZE", "50"))
+
+
+def get_variant_page_query(selections):
+    key = ("variant_page", selections)
+    query = PRODUCT_QUERY_CACHE.get(key)
+    if query is None:
+        query = f"""
+    query ProductVariants($id: ID!, $cursor: String) {{
+      product(id: $id) {{
+        variants(first: {VARIANT_PAGE_SIZE}, after: $cursor) {{
+          pageInfo {{
+            hasNextPage
+            endCursor
+          }}
           edges {{
             node {{
-              url
-              altText
+              {build_variant_fields(selections)}
             }}
           }}
         }}
       }}
     }}
     """
-    response = requests.post(
-        f"https://{SHOPIFY_STORE_URL}/admin/api/2023-07/graphql.json",
-        headers=headers,
-        json={"query": query}
-    )
-    return response.json()
+        PRODUCT_QUERY_CACHE[key] = query
+    return query
+
+
+def fetch_remaining_variants(gid, selections, product):
+    """Append every further page of variants to the product's variants connection.
+    Returns the cost Shopify reported for each page fetched"""
+    costs = []
+    variants = product.get("variants") or {}
+    page_info = variants.get("pageInfo") or {}
+    if page_info.get("hasNextPage"):
+        # Extend a copy: the first page may be a shared (coalesced or replayed) response
+        variants = product["variants"] = {**variants, "edges": list(variants.get("edges", []))}
+    while page_info.get("hasNextPage"):
+        page = run_shopify_query(
+            get_variant_page_query(selections), {"id": gid, "cursor": page_info.get("endCursor")},
+            operation="product_variants"
+        )
+        costs.append((page.get("extensions") or {}).get("cost") or {})
+        connection = ((page.get("data") or {}).get("product") or {}).get("variants") or {}
+        variants["edges"].extend(connection.get("edges", []))
+        page_info = connection.get("pageInfo") or {}
+    variants["pageInfo"] = page_info
+    return costs
+
+
+def resolve_variant(product, text):
+    """The Variant of a Product named in text (by its options or SKU codes), or None"""
+    # The store's catalog index keeps variant identities and option attributes for every product fetched
+    catalog_index = current_store().catalog_index
+    entry = catalog_index.get(product.id) or catalog_index.index_product(product.as_node())
+    variant_id = catalog_index.resolve_variant_id_in(entry, text)
+    return next((v for v in product.variants if v.id == variant_id), None)
+
+
+# NEW: Parsed dimensions ("Interior: 12 x 8 x 4 in; Exterior: ...") for answers
+def dimensions_summary(dimensions):
+    parts = [
+        f"{kind.capitalize()}: {format_dimensions(dimensions[kind])}"
+        for kind in ("interior", "exterior") if dimensions.get(kind)
+    ]
+    return "; ".join(parts) or "N/A"
 
 
-# UPDATED: Generate GPT response with inventory item data
-def generate_ai_response(user_query, product_data, requested_info=None):
-    info_str = ", ".join(requested_info) if requested_info else "all relevant fields"
-    
-    prompt = f"""
-User asked: "{user_query}"
+# NEW: The product data every answer prompt is built from, for a Product and one of its Variants
+def product_answer_data(product, variant=None):
+    return {
+        "title": product.title,
+        "variant": variant.as_node() if variant else {},
+        "cost": (variant.cost if variant else None) or "N/A",
+        "profit": variant.profit if variant else "N/A",
+        "margin": variant.margin if variant else "N/A",
+        "markup": variant.markup if variant else "N/A",
+        "image_url": product.image_url or "N/A",
+        "dimensions": dimensions_summary(product.dimensions)
+    }
 
-Product Data:
-{product_data}
 
-RESPONSE FORMAT REQUIREMENTS:
-1. For numerical values: Provide exact figures with relevant units:
-   - Price/Cost: Include currency symbol (e.g., $25.99)
-   - Dimensions: Include units (e.g., 750ml, 12.5cm)
-   - Percentages: Include % symbol (e.g., 15.5%)
-   - Inventory: Include "units" (e.g., 50 units)
+# A new snapshot carries parsed dimensions for the whole catalog, and may change any answer
+def on_snapshot_swap(store, snapshot):
+    store.catalog_index.load_dimensions(snapshot.dimension_rows())
+    # Every worker swaps in the new file itself
+    store.catalog_version.bump(shared=False)
+
+
+# NEW: Drop everything the current store has cached about a product that was created, updated or deleted;
+# given the webhook's product payload, its vector index row is replaced (or dropped) in place
+def invalidate_product(gid, webhook_product=None):
+    store = current_store()
+    if webhook_product is not None and store.vector_index.loaded_at is not None:
+        update_vector_index(store.vector_index, gid, webhook_product)
+    store.product_details.pop(gid)
+    store.catalog_index.forget(gid)
+    # Any search may now match differently
+    store.search_results.clear()
+    version = store.catalog_version.bump()
+    logger.info("store %s: product %s changed, catalog version %s", store.name, gid, version)
+
+def update_vector_index(index, gid, webhook_product):
+    # products/delete payloads carry only the id
+    if not webhook_product.get("title"):
+        index.remove(gid)
+        return
+    # Webhooks use REST field names
+    tags = webhook_product.get("tags") or ""
+    product = {
+        "title": webhook_product["title"],
+        "productType": webhook_product.get("product_type"),
+        "tags": tags.split(",") if isinstance(tags, str) else tags,
+        "description": webhook_product.get("body_html"),
+    }
+    index.upsert(gid, product_text_fields(product), {"id": gid, "title": product["title"], "handle": webhook_product.get("handle")})
+
+
+def ensure_dimension_index():
+    """True once dimensions for every product are loaded: from the snapshot when there
+    is one (parsed once per load), otherwise by paging the catalog in the background
+    when missing or stale, never inside a request"""
+    catalog_index = current_store().catalog_index
+    snapshot = current_snapshot()
+    if snapshot is not None:
+        if catalog_index.dimensions_loaded_at is None:
+            catalog_index.load_dimensions(snapshot.dimension_rows())
+        return True
+    if catalog_index.dimensions_stale():
+        start_background_load("dimension-index", current_store(), load_dimension_index)
+    return catalog_index.dimensions_loaded_at is not None
 
-2. For categorical data: Reference exact terms or values from the dataset:
-   - Product status: Use exact status (e.g., ACTIVE, DRAFT, ARCHIVED)
-   - Categories: Use exact category names from productType or tags
 
-3. Missing Data: If a value is absent in the dataset, clearly state "information unavailable" (not "N/A")
+def load_dimension_index(store):
+    with use_store(store):
+        products = fetch_catalog(lambda query, variables: run_shopify_query(query, variables, operation="catalog_page"))
+    store.catalog_index.load_dimensions(
+        {"id": p["id"], "title": p.get("title"), **product_dimensions(p)} for p in products
+    )
+    # Size answers given before (including "still loading") are out of date
+    store.catalog_version.bump(shared=False)
+    logger.info("store %s: dimension index loaded, %s products", store.name, len(products))
 
-4. Error Handling: If data is missing or unavailable for a requested field, indicate this clearly without making assumptions
 
-5. Stick to what is explicitly provided - avoid assumptions where data is incomplete
+# UPDATED: Fetch only the product details needed for the requested fields
+def fetch_product_details_by_gid(gid, requested_info=None):
+    selections = product_query_selections(requested_info)
 
-Field definitions:
-- 'price' = customer-facing selling price from variant
-- 'cost' = internal cost from inventory item  
-- 'profit' = calculated profit (price - cost)
-- 'margin' = calculated margin percentage ((profit/price) * 100)
-- 'markup' = calculated markup (price / cost)
-- 'inventory' = stock quantity
-- 'dimensions' = product dimensions in order: length, width, height
-- 'image_url' = main product image URL
+    # The cache holds (selections, result); any cached superset of the fields will do
+    cached = current_store().product_details.get(gid)
+    if cached is not None and selections <= cached[0]:
+        return cached[1]
 
-Respond using only: {info_str}. 
+    # Batch queries send their fetches together as nodes queries
+    batcher = _details_batcher.get()
+    if batcher is not None:
+        return batcher.fetch(gid, selections)
 
-For missing fields, state "unavailable" clearly.
-If 'image_url' is requested, return the direct image URL only once without markdown or formatting.
-Use factual, precise language with exact values and appropriate units.
-"""
-    
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.1,  # Lower temperature for more consistent formatting
-        max_tokens=500
+    # Concurrent requests for the same product and fields share one fetch, variant pages included
+    return product_detail_flights.do(
+        (current_store().name, gid, selections), lambda: fetch_product_details(gid, selections)
+    )
+
+
+product_detail_flights = SingleFlight("product_details")
+
+
+def fetch_product_details(gid, selections):
+    store = current_store()
+    query = get_product_details_query(selections)
+    try:
+        result = run_shopify_query(query, {"id": gid}, operation="product_details")
+    except UpstreamUnavailable:
+        stale = store.product_details.get(gid, allow_stale=True)
+        if (stale is None or not selections <= stale[0]) and selections <= SNAPSHOT_SELECTIONS:
+            snapshot_result = snapshot_product_result(gid)
+            if snapshot_result is not None:
+                logger.warning("Shopify unavailable, serving snapshot details for %s", gid)
+                return snapshot_result
+        if stale is None or not selections <= stale[0]:
+            raise
+        logger.warning("Shopify unavailable, serving cached details for %s", gid)
+        return stale[1]
+    costs = [result.get("extensions", {}).get("cost", {})]
+    product = result.get("data", {}).get("product")
+    if product:
+        costs += fetch_remaining_variants(gid, selections, product)
+        store.catalog_index.index_product(product)
+        store.product_details.set(gid, (selections, result))
+
+    # Requested and actual costs are Shopify's own, summed over the variant pages;
+    # "saved" compares the estimates for these fields and for every field, over the same pages
+    variant_pages = len(costs) - 1
+    logger.info(
+        "fetch_product_details_by_gid %s: fields=%s pages=%s requested cost=%s actual cost=%s saved~%s",
+        gid, sorted(selections), len(costs), reported_cost(costs, "requestedQueryCost"),
+        reported_cost(costs, "actualQueryCost"),
+        estimate_product_query_cost(ALL_PRODUCT_SELECTIONS, variant_pages)
+        - estimate_product_query_cost(selections, variant_pages)
     )
+    return result
+
+
+def reported_cost(costs, field):
+    """Total of a cost field Shopify reported for each page, None if any page lacks it"""
+    values = [cost.get(field) for cost in costs]
+    return None if None in values else sum(values)
+
+
+# NEW: Plain-text answers used when the LLM is unavailable
+ANSWER_FIELD_ORDER = ["price", "cost", "profit", "margin", "markup", "inventory", "dimensions", "image_url"]
+
+
+def product_field_values(product_data):
+    """Display values for each answer field, "unavailable" when missing"""
+    variant = product_data.get("variant") or {}
+
+    def money(value):
+        try:
+            return f"${float(value):.2f}"
+        except (TypeError, ValueError):
+            return "unavailable"
+
+    def present(value):
+        return value if value not in (None, "", "N/A") else "unavailable"
+
+    inventory = variant.get("inventoryQuantity")
+    return {
+        "price": money(variant.get("price")),
+        "cost": money(product_data.get("cost")),
+        "profit": money(product_data.get("profit")),
+        "margin": present(product_data.get("margin")),
+        "markup": present(product_data.get("markup")),
+        "inventory": f"{inventory} units" if inventory is not None else "unavailable",
+        "dimensions": present(product_data.get("dimensions")),
+        "image_url": present(product_data.get("image_url")),
+    }
+
+
+def answer_fields(requested_info):
+    fields = normalize_requested_fields(requested_info)
+    return [field for field in ANSWER_FIELD_ORDER if field in fields] or ANSWER_FIELD_ORDER[:6]
+
+
+def product_display_title(product_data):
+    title = product_data.get("title") or "This product"
+    variant_title = (product_data.get("variant") or {}).get("title")
+    if variant_title and variant_title != "Default Title":
+        title = f"{title} ({variant_title})"
+    return title
+
+
+def format_product_answer(product_data, requested_info=None):
+    values = product_field_values(product_data)
+    lines = [f"{product_display_title(product_data)}:"]
+    for field in answer_fields(requested_info):
+        lines.append(f"{field.replace('_', ' ').capitalize()}: {values[field]}")
+    return "\n".join(lines)
+
+
+def format_comparison_answer(product1_data, product2_data, requested_info=None):
+    values1 = product_field_values(product1_data)
+    values2 = product_field_values(product2_data)
+    title1 = product_display_title(product1_data)
+    title2 = product_display_title(product2_data)
+    lines = []
+    for field in answer_fields(requested_info):
+        label = field.replace('_', ' ')
+        lines.append(f"{title1} {label} is {values1[field]}, while {title2} {label} is {values2[field]}.")
+    return "\n".join(lines)
+
+
+# UPDATED: Generate GPT response with inventory item data
+@traced("answer_generation")
+def generate_ai_response(user_query, product_data, requested_info=None):
+    info_str = ", ".join(requested_info) if requested_info else "all relevant fields"
+
+    try:
+        response = model_router.complete(
+            "answer_generation",
+            messages=PRODUCT_ANSWER.messages(fields=info_str, query=user_query, product_data=product_data),
+            temperature=0.1  # Lower temperature for more consistent formatting
+        )
+    except UpstreamUnavailable:
+        return format_product_answer(product_data, requested_info)
     return response.choices[0].message.content.strip()
 
 
 
 # UPDATED: Generate comparison response with inventory item data
+@traced("comparison_generation")
 def generate_comparison_response(user_query, product1_data, product2_data, requested_info=None):
     info_str = ", ".join(requested_info) if requested_info else "all relevant fields"
     
@@ -741,78 +1339,25 @@ def generate_comparison_response(user_query, product1_data, product2_data, reque
         product1_title = product1_data.get('title', 'Product 1')
         product2_title = product2_data.get('title', 'Product 2')
         
-        # Create a focused prompt following strict response format
-        prompt = f"""
-        User asked: "{user_query}"
-        
-        Product 1: {product1_title}
-        {specific_field_requested.capitalize()}: {product1_value}
-        
-        Product 2: {product2_title}
-        {specific_field_requested.capitalize()}: {product2_value}
-        
-        RESPONSE FORMAT REQUIREMENTS:
-        1. For numerical values: Provide exact figures with relevant units (e.g., price in dollars, dimensions in cm)
-        2. For categorical data: Reference exact terms or values from the dataset
-        3. Missing Data: If a value is absent, clearly state "unavailable" or "information unavailable"
-        4. Error Handling: If data is missing, indicate this clearly without making assumptions
-        5. Stick to what is explicitly provided in the data
-        
-        IMPORTANT: The user is asking ONLY about {specific_field_requested} comparison.
-        
-        Response format:
-        - If both values are available: "{product1_title} {specific_field_requested} is [exact value with units], while {product2_title} {specific_field_requested} is [exact value with units]."
-        - If one value is unavailable: "{product1_title} {specific_field_requested} is [value/unavailable], while {product2_title} {specific_field_requested} is [value/unavailable]."
-        - If both values are unavailable: "{specific_field_requested.capitalize()} information is unavailable for both products."
-        
-        For price/cost values: Include currency symbol (e.g., $25.99)
-        For percentage values: Include % symbol (e.g., 15.5%)
-        For inventory: Include units (e.g., 50 units)
-        
-        DO NOT mention any other fields. Use only normal text without markdown formatting.
-        """
+        # A focused prompt following strict response format
+        messages = COMPARISON_FIELD_ANSWER.messages(
+            field=specific_field_requested, query=user_query, label=specific_field_requested.capitalize(),
+            title1=product1_title, value1=product1_value, title2=product2_title, value2=product2_value,
+        )
     else:
-        # Original prompt for general comparisons with strict format requirements
-        prompt = f"""
-        User asked: "{user_query}"
-        
-        Product 1 Data:
-        {product1_data}
-        
-        Product 2 Data:
-        {product2_data}
-        
-        RESPONSE FORMAT REQUIREMENTS:
-        1. For numerical values: Provide exact figures with relevant units (e.g., price in dollars, cost in dollars, dimensions in cm)
-        2. For categorical data: Reference exact terms or values from the dataset
-        3. Missing Data: If a value is absent, clearly state "unavailable" or "information unavailable"
-        4. Error Handling: If data is missing, indicate this clearly without making assumptions
-        5. Stick to what is explicitly provided in the data
-        
-        Field definitions:
-        - 'price' = customer-facing selling price from variant (include $ symbol)
-        - 'cost' = internal cost from inventory item (include $ symbol)
-        - 'profit' = calculated profit (price - cost) (include $ symbol)
-        - 'margin' = calculated margin percentage ((profit/price) * 100) (include % symbol)
-        - 'inventory' = stock quantity (include "units" if applicable)
-        
-        Compare these two products focusing on: {info_str}. 
-        
-        For each field:
-        - Provide exact values with appropriate units
-        - If data is missing, state "unavailable" 
-        - Do not make assumptions about missing data
-        - Use clear, factual language
-        
-        Format: Use normal text without special characters, markdown, asterisks, underscores, or formatting symbols.
-        """
-    
-    response = openai_client.chat.completions.create(
-        model="gpt-3.5-turbo",
-        messages=[{"role": "user", "content": prompt}],
-        temperature=0.1,  # Lower temperature for more consistent formatting
-        max_tokens=500
-    )
+        # The prompt for general comparisons with strict format requirements
+        messages = COMPARISON_ANSWER.messages(
+            fields=info_str, query=user_query, product1_data=product1_data, product2_data=product2_data
+        )
+
+    try:
+        response = model_router.complete(
+            "comparison",
+            messages=messages,
+            temperature=0.1  # Lower temperature for more consistent formatting
+        )
+    except UpstreamUnavailable:
+        return format_comparison_answer(product1_data, product2_data, requested_info)
     
     return response.choices[0].message.content.strip()
 
@@ -966,163 +1511,469 @@ def process_date_query(intent, user_input):
         return f"Products created {date_condition} {date_value}:\n" + "\n".join(product_list)
 
 
+# NEW: Speculative prefetch. SKUs and model numbers are usually visible in the raw
+# text, so their Shopify search and detail fetch start while the LLM is still
+# extracting the intent; the results are used only if the LLM picks the same identifier
+SPECULATIVE_PREFETCH = os.getenv("SPECULATIVE_PREFETCH", "1") == "1"
+speculation_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="speculative")
+# Queries answered from product lists, where identifiers are dates rather than products
+LIST_QUERY_PATTERN = re.compile(r"\b(created|after|before|since|status|draft|active|archived|category|how many)\b")
+
+_speculation = contextvars.ContextVar("speculation", default=None)
+
+
+def speculative_identifiers(user_input, limit=2):
+    """Identifier tokens (the pattern is_product_related_query uses) that contain a digit"""
+    if LIST_QUERY_PATTERN.search(user_input.lower()) or extract_dimension_intent(user_input):
+        return []
+    identifiers = []
+    for token in re.findall(r'\b[A-Z0-9]{2,}[-A-Z0-9]*\b', user_input.upper()):
+        if re.search(r"\d", token) and not re.fullmatch(r"\d{4}-\d{2}(-\d{2})?", token) and token not in identifiers:
+            identifiers.append(token)
+    return identifiers[:limit]
+
+
+class SpeculativePrefetch:
+    def __init__(self, user_input):
+        # Field guess for the detail fetch; a later request for more fields just fetches again
+        requested_info = (fallback_product_intent(user_input) or {}).get("requested_info")
+        self.futures = {}
+        for identifier in speculative_identifiers(user_input):
+            context = contextvars.copy_context()
+            self.futures[identifier] = speculation_executor.submit(context.run, self.prefetch, identifier, requested_info)
+
+    @staticmethod
+    def prefetch(identifier, requested_info):
+        with stage("speculative_prefetch"):
+            result = search_products(identifier)
+            edges = result.get("data", {}).get("products", {}).get("edges", [])
+            if len(edges) != 1:
+                return result, None
+            gid = edges[0]["node"]["id"]
+            selections = product_query_selections(requested_info)
+            return result, (gid, selections, fetch_product_details_by_gid(gid, requested_info))
+
+    def _result(self, identifier):
+        future = self.futures.get(identifier.strip().upper())
+        if future is None:
+            return None
+        try:
+            return future.result(timeout=remaining_budget())
+        except Exception:
+            # The normal path will make (and report) the call itself
+            return None
+
+    def search_result(self, product_name_or_sku):
+        prefetched = self._result(product_name_or_sku)
+        return prefetched[0] if prefetched else None
+
+    def details(self, gid, requested_info):
+        # Only finished prefetches: the search for this product has already waited for its own
+        for identifier, future in self.futures.items():
+            prefetched = self._result(identifier) if future.done() else None
+            if prefetched and prefetched[1]:
+                prefetched_gid, selections, details = prefetched[1]
+                if prefetched_gid == gid and product_query_selections(requested_info) <= selections:
+                    return details
+        return None
+
+    def discard(self):
+        for future in self.futures.values():
+            future.cancel()
+
+
+@contextmanager
+def speculative_prefetch(user_input):
+    # A batch's lookups were prefetched for the whole batch
+    if _details_batcher.get() is not None:
+        yield _speculation.get()
+        return
+    speculation = SpeculativePrefetch(user_input) if SPECULATIVE_PREFETCH else None
+    token = _speculation.set(speculation)
+    try:
+        yield speculation
+    finally:
+        _speculation.reset(token)
+        if speculation:
+            speculation.discard()
+
+
+def search_products_speculated(product_name_or_sku):
+    speculation = _speculation.get()
+    result = speculation.search_result(product_name_or_sku) if speculation else None
+    return result if result is not None else search_products(product_name_or_sku)
+
+
+def fetch_product_details_speculated(gid, requested_info):
+    speculation = _speculation.get()
+    details = speculation.details(gid, requested_info) if speculation else None
+    return details if details is not None else fetch_product_details_by_gid(gid, requested_info)
+
+
+# NEW: While the user answers a clarification prompt, fetch every candidate's
+# details in one batched nodes query and attach them to the conversation
+CLARIFICATION_PREFETCH = os.getenv("CLARIFICATION_PREFETCH", "1") == "1"
+CLARIFICATION_PREFETCH_MAX_PRODUCTS = 10
+
+
+def get_product_nodes_query(selections):
+    key = ("nodes", selections)
+    query = PRODUCT_QUERY_CACHE.get(key)
+    if query is None:
+        query = build_product_nodes_query(selections)
+        PRODUCT_QUERY_CACHE[key] = query
+    return query
+
+
+def fetch_product_details_batch(gids, requested_info=None):
+    """Details for several products in one query, each shaped like fetch_product_details_by_gid's result"""
+    return fetch_product_nodes(gids, product_query_selections(requested_info))
+
+
+def fetch_product_nodes(gids, selections):
+    store = current_store()
+    result = run_shopify_query(get_product_nodes_query(selections), {"ids": gids}, operation="product_nodes")
+    details = {}
+    for node in (result.get("data") or {}).get("nodes") or []:
+        if not node:
+            continue
+        fetch_remaining_variants(node["id"], selections, node)
+        store.catalog_index.index_product(node)
+        product_result = {"data": {"product": node}}
+        store.product_details.set(node["id"], (selections, product_result))
+        details[node["id"]] = product_result
+    return details
+
+
+def prefetch_clarification_candidates(conversation_state):
+    # A replayed conversation fetches on the follow-up turn, as recorded, and nobody answers a batch query's prompt
+    if not CLARIFICATION_PREFETCH or replay_active() or _details_batcher.get() is not None:
+        return
+    clarification = conversation_state["clarification"]
+    gids = [p.id for p in clarification.candidates][:CLARIFICATION_PREFETCH_MAX_PRODUCTS]
+    requested_info = clarification.requested_info
+    # gid -> (selections, details)
+    prefetched = conversation_state["prefetched_details"] = {}
+    selections = product_query_selections(requested_info)
+
+    def prefetch():
+        # Outlives the request: the request's store (held until done) and usage, but a budget
+        # of its own, and left out of the query log (the follow-up turn records what it uses)
+        with use_store(current_store()), request_budget(), not_recorded():
+            try:
+                details = fetch_product_details_batch(gids, requested_info)
+            except Exception as e:
+                logger.info("clarification prefetch failed: %s", e)
+                return
+            prefetched.update((gid, (selections, result)) for gid, result in details.items())
+
+    speculation_executor.submit(contextvars.copy_context().run, prefetch)
+
+
+def prefetched_product_details(conversation_state, gid, requested_info):
+    """Details fetched while the user was answering, recorded as if fetched now so replays still match"""
+    prefetched = (conversation_state.get("prefetched_details") or {}).get(gid)
+    selections = product_query_selections(requested_info)
+    # Prefetched for the fields of the original question; a follow-up asking for others fetches them
+    if prefetched is None or not selections <= prefetched[0]:
+        return None
+    details = prefetched[1]
+    record_upstream("shopify", request_key(get_product_details_query(selections), {"id": gid}), details, 0)
+    return details
+
+
+# NEW: /chat/batch answers many stateless questions at once. Their product detail
+# fetches are collected and sent together as nodes queries
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_QUERIES = int(os.getenv("BATCH_MAX_QUERIES", "100"))
+BATCH_NODES_MAX_IDS = int(os.getenv("BATCH_NODES_MAX_IDS", "25"))
+BATCH_LOOKUP_WINDOW_SECONDS = float(os.getenv("BATCH_LOOKUP_WINDOW_SECONDS", "0.1"))
+batch_executor = ThreadPoolExecutor(max_workers=BATCH_CONCURRENCY, thread_name_prefix="batch")
+
+_details_batcher = contextvars.ContextVar("details_batcher", default=None)
+
+
+class DetailsBatcher:
+    """Collects the product detail fetches of a batch's workers.
+
+    Pending fetches go out as nodes queries (one for every max_ids products,
+    with the union of the requested fields) as soon as every unfinished
+    worker is waiting on one, or once the oldest has waited `window` seconds.
+    All `workers` count from the start, so callers that get going first do
+    not flush before the workers still queued behind them can join.
+    """
+
+    class Fetch:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, workers, window=BATCH_LOOKUP_WINDOW_SECONDS, max_ids=BATCH_NODES_MAX_IDS):
+        self.window = window
+        self.max_ids = max_ids
+        self.lock = threading.Lock()
+        # gid -> (selections, Fetch)
+        self.pending = {}
+        self.timer = None
+        # Workers not finished yet, started or not
+        self.active = workers
+        self.waiting = 0
+        # Timer flushes run outside the batch's request, so they need its store
+        self.store = current_store()
+
+    @contextmanager
+    def worker(self):
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.active -= 1
+                # Whoever is left may now all be waiting
+                pending = self._take() if self.pending and self.waiting >= self.active else None
+            if pending:
+                self._send(pending)
+
+    def fetch(self, gid, selections):
+        with self.lock:
+            queued = self.pending.get(gid)
+            if queued is None:
+                fetch = self.Fetch()
+                self.pending[gid] = (selections, fetch)
+            else:
+                fetch = queued[1]
+                self.pending[gid] = (queued[0] | selections, fetch)
+            self.waiting += 1
+            pending = None
+            if self.waiting >= self.active or len(self.pending) >= self.max_ids:
+                pending = self._take()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.window, self._flush)
+                self.timer.daemon = True
+                self.timer.start()
+        try:
+            if pending:
+                self._send(pending)
+            remaining = remaining_budget()
+            if not fetch.done.wait(None if remaining is None else max(0.0, remaining)):
+                note_upstream_failure()
+                raise DeadlineExceeded("request budget ran out waiting for a batched product lookup")
+        finally:
+            with self.lock:
+                self.waiting -= 1
+        if fetch.error is not None:
+            raise fetch.error
+        return fetch.result
+
+    def _take(self):
+        pending, self.pending = self.pending, {}
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+        return pending
+
+    def _flush(self):
+        with self.lock:
+            self.timer = None
+            pending = self._take()
+        if pending:
+            # Runs on the timer thread, outside any request
+            with use_store(self.store), request_budget():
+                self._send(pending)
+
+    def _send(self, pending):
+        gids = list(pending)
+        selections = frozenset().union(*(queued[0] for queued in pending.values()))
+        for start in range(0, len(gids), self.max_ids):
+            chunk = gids[start:start + self.max_ids]
+            try:
+                details = fetch_product_nodes(chunk, selections)
+            except Exception as e:
+                for gid in chunk:
+                    pending[gid][1].error = e
+                    pending[gid][1].done.set()
+                continue
+            for gid in chunk:
+                pending[gid][1].result = details.get(gid) or {"data": {"product": None}}
+                pending[gid][1].done.set()
+
+
+class BatchPrefetch:
+    """The lookups a whole batch will probably make, done up front: a search for
+    every identifier in its questions, then one nodes query per max_ids single
+    matches. The batch's questions read it like a SpeculativePrefetch."""
+
+    def __init__(self, queries, max_ids=BATCH_NODES_MAX_IDS):
+        identifiers = {}
+        selections = set()
+        for query in queries:
+            for identifier in speculative_identifiers(query):
+                identifiers.setdefault(identifier, None)
+            selections |= product_query_selections((fallback_product_intent(query) or {}).get("requested_info"))
+        self.selections = frozenset(selections)
+        contexts = [contextvars.copy_context() for _ in identifiers]
+        self.searches = dict(zip(identifiers, batch_executor.map(
+            lambda context, identifier: context.run(self.search, identifier), contexts, identifiers
+        )))
+
+        gids = []
+        for result in self.searches.values():
+            edges = (result or {}).get("data", {}).get("products", {}).get("edges", [])
+            if len(edges) == 1 and edges[0]["node"]["id"] not in gids:
+                gids.append(edges[0]["node"]["id"])
+        self.product_details = {}
+        for start in range(0, len(gids), max_ids):
+            try:
+                self.product_details.update(fetch_product_nodes(gids[start:start + max_ids], self.selections))
+            except UpstreamUnavailable as e:
+                # The questions will look these up themselves
+                logger.info("batch prefetch of product details failed: %s", e)
+
+    @staticmethod
+    def search(identifier):
+        try:
+            return search_products(identifier)
+        except UpstreamUnavailable:
+            return None
+
+    def search_result(self, product_name_or_sku):
+        return self.searches.get(product_name_or_sku.strip().upper())
+
+    def details(self, gid, requested_info):
+        if product_query_selections(requested_info) <= self.selections:
+            return self.product_details.get(gid)
+        return None
+
+
+def answer_batch(queries):
+    """Answers to stateless questions, in order; repeated (normalized) questions are answered once"""
+    keys = [normalize_query(query) or query.strip() for query in queries]
+    unique = {}
+    for key, query in zip(keys, queries):
+        unique.setdefault(key, query)
+    set_intent("batch")
+    prefetch = BatchPrefetch(list(unique.values())) if SPECULATIVE_PREFETCH else None
+    batcher = DetailsBatcher(workers=len(unique))
+
+    def answer(query):
+        _details_batcher.set(batcher)
+        _speculation.set(prefetch)
+        # Each question has its own budgets and is accounted under its own intent
+        with batcher.worker(), request_budget(), track_usage():
+            return handle_user_input_with_pelican_support(query, new_conversation_state())
+
+    futures = {key: batch_executor.submit(contextvars.copy_context().run, answer, query) for key, query in unique.items()}
+    answers = {}
+    for key, future in futures.items():
+        try:
+            answers[key] = future.result()
+        except Exception as e:
+            logger.warning("batch query %r failed: %s", unique[key], e)
+            answers[key] = "Sorry, I couldn't answer that question."
+    return [answers[key] for key in keys]
+
+
 # UPDATED: Process single product with inventory item data
 def process_single_product(product_name_or_sku, requested_info, user_input, conversation_state: Dict) -> str:
-    results = search_products(product_name_or_sku)
-    products = results.get("data", {}).get("products", {}).get("edges", [])
+    results = search_products_speculated(product_name_or_sku)
+    products = decode_search(results)
 
     if not products:
         return "No product matched your query."
     elif len(products) > 1:
-        conversation_state["awaiting_clarification"] = True
-        conversation_state["clarification_type"] = "color_interior_specs"
-        conversation_state["clarification_data"] = products
-        conversation_state["original_query"] = user_input
-        conversation_state["original_requested_info"] = requested_info
+        start_clarification(conversation_state, ClarificationContext(
+            "color_interior_specs", user_input, requested_info, candidates=tuple(products)
+        ))
+        prefetch_clarification_candidates(conversation_state)
         return "I found multiple products matching your search. Could you please specify the color and interior option you're looking for?"
     else:
-        product = products[0]["node"]
-        gid = product["id"]
-        details = fetch_product_details_by_gid(gid)
-        product_info = details["data"]["product"]
-
-        variants = product_info.get("variants", {}).get("edges", [])
+        product = decode_product(fetch_product_details_speculated(products[0].id, requested_info))
+        if product is None:
+            return "No product matched your query."
+
+        variants = product.variants
+        # A query that already names the colour and interior needs no clarification
+        resolved_variant = resolve_variant(product, user_input) if len(variants) > 1 else None
+        if resolved_variant:
+            variants = (resolved_variant,)
         if len(variants) > 1:
-            conversation_state["awaiting_clarification"] = True
-            conversation_state["clarification_type"] = "variant_color_interior"
-            conversation_state["clarification_data"] = variants
-            conversation_state["original_product"] = product_info
-            conversation_state["original_query"] = user_input
-            conversation_state["original_requested_info"] = requested_info
+            start_clarification(conversation_state, ClarificationContext(
+                "variant_color_interior", user_input, requested_info, product=product
+            ))
             return "This product has multiple variants. Could you please specify the color and interior option you're looking for?"
         else:
-            variant = variants[0]["node"] if variants else {}
-            cost = variant.get("inventoryItem", {}).get("unitCost", {}).get("amount", "N/A")
-            price = variant.get("price", "N/A")
-
-            profit_margin_data = calculate_profit_and_margin(cost, price)
-            markup_data = calculate_markup(cost, price)
-            images = product_info.get("images", {}).get("edges", [])
-            image_url = images[0]["node"]["url"] if images else "N/A"
-
-            enhanced_product_data = {
-                "title": product_info.get("title"),
-                "variant": variant,
-                "cost": cost,
-                "profit": profit_margin_data["profit"],
-                "margin": profit_margin_data["margin"],
-                "markup": markup_data["markup"],
-                "image_url": image_url
-            }
+            variant = variants[0] if variants else None
+            remember_resolved(conversation_state, product, variant, requested_info)
+            return generate_ai_response(user_input, product_answer_data(product, variant), requested_info)
 
-            return generate_ai_response(user_input, enhanced_product_data, requested_info)
 
 
+# NEW: Colour and interior words mapped to the codes used in Pelican titles and SKUs
+TITLE_MATCH_CODES = {
+    'yellow': 'ylw', 'orange': 'od', 'black': 'blk', 'clear': 'clr', 'transparent': 'clr',
+    'foam': 'f', 'dividers': 'div', 'divider': 'div', 'padded': 'pd', 'empty': 'nf'
+}
 
-def handle_color_interior_clarification(user_input, products):
-    """Handle clarification for any products based on color and interior specifications"""
-    
-    product_titles = [p["node"]["title"] for p in products]
-    product_list_str = "\n".join(f"- {title}" for title in product_titles)
-    
-    prompt = f"""
-The user is looking for a product and specified: "{user_input}"
 
-Available products:
-{product_list_str}
+def match_title_locally(user_input, product_titles):
+    """Match a colour/interior reply to a title without the LLM: every word must appear in exactly one title"""
+    text = re.sub(r"\b(no|without) foam\b", "empty", user_input.lower())
+    words = [
+        word for word in re.findall(r"[a-z0-9]+", text)
+        if word not in INTENT_STOPWORDS and word not in ('color', 'colour', 'interior', 'option')
+    ]
+    if not words:
+        return {"matched_product_title": None, "confidence": "low"}
 
-Find the product that best matches the user's specification. Look for the color or other specifications mentioned by the user in the product titles.
+    matches = []
+    for title in product_titles:
+        title_tokens = set(re.findall(r"[a-z0-9]+", title.lower()))
+        if all(word in title_tokens or TITLE_MATCH_CODES.get(word) in title_tokens for word in words):
+            matches.append(title)
 
-Be flexible with matching:
-- Match colors regardless of case (Red = red = RED)
-- Look for common abbreviations (Red = R, Blue = BLU, etc.)
-- If user only mentions a color, match any product with that color
-- If user mentions color + other specs, try to match both
+    if len(matches) == 1:
+        return {"matched_product_title": matches[0], "confidence": "high"}
+    return {"matched_product_title": None, "confidence": "low"}
 
-Return JSON:
-{{"matched_product_title": "exact title from the list", "confidence": "high"}}
 
-If no clear match, return:
-{{"matched_product_title": null, "confidence": "low"}}
-"""
+@traced("clarification_matching")
+def handle_color_interior_clarification(user_input, products):
+    """Handle clarification for any products based on color and interior specifications"""
     
+    product_titles = [p["node"]["title"] for p in products]
+    product_list_str = "\n".join(f"- {title}" for title in product_titles)
+
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo", 
-            messages=[{"role": "user", "content": prompt}], 
-            temperature=0, 
-            max_tokens=300
+        response = model_router.complete(
+            "variant_matching",
+            messages=COLOR_INTERIOR_MATCH.messages(products=product_list_str, query=user_input),
+            temperature=0,
         )
         result = eval(response.choices[0].message.content.strip())
         return result
+    except UpstreamUnavailable:
+        return match_title_locally(user_input, product_titles)
     except:
         return {"matched_product_title": None, "confidence": "low"}
 
 
 
+@traced("clarification_matching")
 def handle_pelican_clarification(user_input, products):
     """Handle clarification for Pelican products based on color and interior specifications"""
     
     # Use GPT to match user's color/interior specification to available products
     product_titles = [p["node"]["title"] for p in products]
     product_list_str = "\n".join(f"- {title}" for title in product_titles)
-    
-    prompt = f"""
-        The user is looking for a Pelican product and specified: "{user_input}"
-
-        Available Pelican products:
-        {product_list_str}
-
-        Your task is to find the best matching product **ONLY if** the user's specified color and interior **both exist in the product title or SKU**.
-
-        DO NOT try to guess or offer a similar product. If no product contains the actual color or interior mentioned by the user (e.g., "purple" or "velvet"), respond with:
-        {"matched_product_title": null, "confidence": "low"}
-
-        Examples:
-        - If user says "purple" and no product has "purple", return null.
-        - If user says "yellow with foam" and no product has both "yellow" and "foam", return null.
-
-        Return only:
-        {"matched_product_title": "...", "confidence": "high"}  — if match is exact
-        {"matched_product_title": null, "confidence": "low"}  — if no exact match
-
-
-        Color mappings:
-        - Yellow/Yellow color = YLW
-        - Orange/Orange color = OD  
-        - Black/Black color = BLK
-        - Clear/Transparent = CLR
-        - Red/Red color = RED
-
-        Interior options:
-        - No Foam/Empty/Without foam = NFc
-        - Foam/With foam = F
-        - Dividers/With dividers = DIV
-        - Padded/Padded dividers = PD
-
-        Look for these patterns in the product SKUs and titles.
 
-        Examples:
-        - "black empty" should match products with "BLK" and "NF" 
-        - "yellow with foam" should match products with "YLW" and "F"
-        - "orange dividers" should match products with "OD" and "DIV"
-
-        Return JSON like:
-        {{"matched_product_title": "exact title from the list", "confidence": "high/medium/low"}}
-
-        IMPORTANT: If no product contains the actual color or interior option mentioned by the user, do not guess. Always return null with "low" confidence.
-
-        """
-    
     try:
-        response = openai_client.chat.completions.create(
-            model="gpt-3.5-turbo", 
-            messages=[{"role": "user", "content": prompt}], 
-            temperature=0, 
-            max_tokens=300
+        response = model_router.complete(
+            "variant_matching", messages=PELICAN_MATCH.messages(products=product_list_str, query=user_input), temperature=0
         )
         result = eval(response.choices[0].message.content.strip())
         return result
+    except UpstreamUnavailable:
+        return match_title_locally(user_input, product_titles)
     except:
         return {"matched_product_title": None, "confidence": "low"}
 
@@ -1134,13 +1985,11 @@ def process_comparison(product1_name, product2_name, requested_info, user_input)
     # print(f"Searching for product2: {product2_name}")  # Debug print
     
     # Search for first product
-    results1 = search_products(product1_name)
-    products1 = results1.get("data", {}).get("products", {}).get("edges", [])
+    products1 = decode_search(search_products_speculated(product1_name))
     # print(f"Products1 found: {len(products1)}")  # Debug print
     
     # Search for second product
-    results2 = search_products(product2_name)
-    products2 = results2.get("data", {}).get("products", {}).get("edges", [])
+    products2 = decode_search(search_products_speculated(product2_name))
     # print(f"Products2 found: {len(products2)}")  # Debug print
 
     if not products1:
@@ -1148,60 +1997,226 @@ def process_comparison(product1_name, product2_name, requested_info, user_input)
     if not products2:
         return f"No product found for '{product2_name}'. Please check the spelling or try a different search term."
 
-    # Get first product from each search (taking the first match)
-    product1 = products1[0]["node"]
-    product2 = products2[0]["node"]
-    
-    # print(f"Product1: {product1['title']}")  # Debug print
-    # print(f"Product2: {product2['title']}")  # Debug print
-    
-    # Fetch details for both products
-    details1 = fetch_product_details_by_gid(product1["id"])
-    details2 = fetch_product_details_by_gid(product2["id"])
-    
-    product1_info = details1["data"]["product"]
-    product2_info = details2["data"]["product"]
+    # Fetch details for the first match of each search
+    product1 = decode_product(fetch_product_details_speculated(products1[0].id, requested_info))
+    product2 = decode_product(fetch_product_details_speculated(products2[0].id, requested_info))
+    if product1 is None:
+        return f"No product found for '{product1_name}'. Please check the spelling or try a different search term."
+    if product2 is None:
+        return f"No product found for '{product2_name}'. Please check the spelling or try a different search term."
 
-    # Helper function to extract cost, profit, and margin
-    def extract_financial_data(product_info):
-        variants = product_info.get("variants", {}).get("edges", [])
-        variant = variants[0]["node"] if variants else {}
-        
-        # Extract cost from inventory item
-        cost = "N/A"
-        if variant.get("inventoryItem") and variant["inventoryItem"].get("unitCost"):
-            cost = variant["inventoryItem"]["unitCost"]["amount"]
-        
-        # Calculate profit and margin
-        price = variant.get("price", "N/A")
-        profit_margin_data = calculate_profit_and_margin(cost, price)
-        markup_data = calculate_markup(cost, price)
-        
-        return {
-            "title": product_info.get("title"),
-            "variant": variant,
-            "cost": cost,
-            "profit": profit_margin_data["profit"],
-            "margin": profit_margin_data["margin"],
-            "markup": markup_data["markup"]
-        }
+    # Each product's variant is resolved from its own part of the query ("1510 black vs 1535 yellow")
+    split_at = user_input.lower().find(product2_name.lower())
+    product1_text = user_input[:split_at] if split_at > 0 else user_input
+    product2_text = user_input[split_at:] if split_at > 0 else user_input
 
-    # Get financial data for both products
-    product1_data = extract_financial_data(product1_info)
-    product2_data = extract_financial_data(product2_info)
+    def comparison_data(product, text):
+        variant = resolve_variant(product, text) or (product.variants[0] if product.variants else None)
+        return product_answer_data(product, variant)
+
+    product1_data = comparison_data(product1, product1_text)
+    product2_data = comparison_data(product2, product2_text)
 
     # Generate comparison response
     answer = generate_comparison_response(user_input, product1_data, product2_data, requested_info)
     return answer
 
 
+# NEW: Dimension range and nearest-size queries, answered locally from the catalog index
+DIMENSION_AXIS_WORDS = {
+    "length": "length", "long": "length", "longer": "length",
+    "width": "width", "wide": "width", "wider": "width",
+    "height": "height", "high": "height", "higher": "height", "tall": "height", "taller": "height",
+    "depth": "height", "deep": "height", "deeper": "height",
+}
+DIMENSION_NUMBER = r"(\d+(?:\.\d+)?)\s*" + UNIT_PATTERN + "?"
+DIMENSION_AT_LEAST = r"(?:over|above|more than|greater than|bigger than|larger than|at least|(?:longer|wider|taller|deeper|higher) than|>=?)"
+DIMENSION_AT_MOST = r"(?:under|below|less than|smaller than|at most|up to|(?:shorter|narrower|shallower) than|<=?)"
+
+
+def extract_dimension_intent(user_input):
+    """Dimension query intent without the LLM, or None if the query is not one"""
+    text = user_input.lower()
+    kind = "exterior" if re.search(r"\b(exterior|outside|external|outer)\b", text) else "interior"
+
+    size = re.search(
+        DIMENSION_NUMBER + r"\s*(?:x|×|by)\s*" + DIMENSION_NUMBER + r"\s*(?:x|×|by)\s*" + DIMENSION_NUMBER, text
+    )
+    if size and re.search(r"\b(closest|nearest|similar|fits?|hold|size)\b", text):
+        numbers, units = size.groups()[0::2], size.groups()[1::2]
+        default_unit = next((unit for unit in reversed(units) if unit), "in")
+        return {
+            "type": "nearest",
+            "kind": kind,
+            "target": tuple(to_inches(n, u or default_unit) for n, u in zip(numbers, units)),
+            "must_fit": bool(re.search(r"\b(fits?|hold)\b", text)),
+        }
+
+    axis = next((DIMENSION_AXIS_WORDS[w] for w in re.findall(r"[a-z]+", text) if w in DIMENSION_AXIS_WORDS), None)
+    if not axis:
+        return None
+    between = re.search(r"between\s+" + DIMENSION_NUMBER + r"\s+(?:and|to|-)\s+" + DIMENSION_NUMBER, text)
+    if between:
+        low, low_unit, high, high_unit = between.groups()
+        unit = high_unit or low_unit
+        return {"type": "range", "kind": kind, "axis": axis,
+                "min": to_inches(low, low_unit or unit), "max": to_inches(high, unit)}
+    at_least = re.search(DIMENSION_AT_LEAST + r"\s+" + DIMENSION_NUMBER, text)
+    at_most = re.search(DIMENSION_AT_MOST + r"\s+" + DIMENSION_NUMBER, text)
+    if not (at_least or at_most):
+        return None
+    return {
+        "type": "range", "kind": kind, "axis": axis,
+        "min": to_inches(*at_least.groups()) if at_least else None,
+        "max": to_inches(*at_most.groups()) if at_most else None,
+    }
+
+
+def process_dimension_query(dimension_intent):
+    if not ensure_dimension_index():
+        return "Product dimensions are still being loaded, please ask again in a minute."
+    catalog_index = current_store().catalog_index
+    kind = dimension_intent["kind"]
+
+    if dimension_intent["type"] == "nearest":
+        target = format_dimensions(dimension_intent["target"])
+        rows = catalog_index.nearest_size(kind, dimension_intent["target"], must_fit=dimension_intent["must_fit"])
+        if not rows:
+            return f"No products have {kind} dimensions that fit {target}."
+        if dimension_intent["must_fit"]:
+            heading = f"Smallest products with {kind} dimensions that fit {target}:"
+        else:
+            heading = f"Products with {kind} dimensions closest to {target}:"
+        return heading + "\n" + "\n".join(f"• {row['title']} ({format_dimensions(row[kind])})" for row in rows)
+
+    axis, minimum, maximum = dimension_intent["axis"], dimension_intent["min"], dimension_intent["max"]
+    rows = catalog_index.filter_by_dimension(kind, axis, minimum, maximum)
+    if minimum is not None and maximum is not None:
+        condition = f"between {round(minimum, 2):g} and {round(maximum, 2):g} in"
+    elif minimum is not None:
+        condition = f"of at least {round(minimum, 2):g} in"
+    else:
+        condition = f"of at most {round(maximum, 2):g} in"
+    if not rows:
+        return f"No products have an {kind} {axis} {condition}."
+    product_list = [f"• {row['title']} ({kind.capitalize()}: {format_dimensions(row[kind])})" for row in rows[:15]]
+    shown = f"Showing first 15 of {len(rows)} products" if len(rows) > 15 else f"Found {len(rows)} products"
+    return f"{shown} with an {kind} {axis} {condition}:\n" + "\n".join(product_list)
+
+
+# NEW: Catalog-wide aggregates ("how many archived products are there in total",
+# "average margin of every active Pelican case") run as background bulk operation
+# jobs; the chat answer is the job id, or the result once one exists for this catalog version
+CATALOG_JOB_WORKERS = int(os.getenv("CATALOG_JOB_WORKERS", "1"))
+CATALOG_JOB_MAX_PENDING = int(os.getenv("CATALOG_JOB_MAX_PENDING", "20"))
+CATALOG_JOB_POLL_SECONDS = float(os.getenv("CATALOG_JOB_POLL_SECONDS", "2"))
+CATALOG_JOB_TIMEOUT_SECONDS = float(os.getenv("CATALOG_JOB_TIMEOUT_SECONDS", "1800"))
+
+
+def download_bulk_results(url):
+    """Stream the lines of a bulk operation's JSONL result (a signed URL, so no Shopify headers)"""
+    with current_store().session.get(url, stream=True, timeout=SHOPIFY_TIMEOUT_SECONDS) as response:
+        response.raise_for_status()
+        yield from response.iter_lines(chunk_size=64 * 1024)
+
+
+catalog_jobs = CatalogJobQueue(
+    lambda query, variables, operation: run_shopify_query(query, variables, operation=operation),
+    download_bulk_results,
+    workers=CATALOG_JOB_WORKERS,
+    max_pending=CATALOG_JOB_MAX_PENDING,
+    poll_seconds=CATALOG_JOB_POLL_SECONDS,
+    timeout_seconds=CATALOG_JOB_TIMEOUT_SECONDS,
+    # A job runs against the store it was asked of
+    enter=lambda version: use_store(stores.get(version[0])),
+)
+
+CATALOG_AGGREGATE_METRICS = [
+    ("count", r"how many|count|number of"),
+    ("average", r"average|avg|mean"),
+    ("total", r"total|sum"),
+    ("min", r"lowest|minimum|min|cheapest|smallest"),
+    ("max", r"highest|maximum|max|most expensive|largest|biggest"),
+]
+CATALOG_WIDE_PATTERN = re.compile(r"\b(all|every|entire|whole|across|catalog|in total|overall)\b")
+# Date and category questions keep their own handlers
+CATALOG_AGGREGATE_EXCLUDED = re.compile(r"\b(created|after|before|since|category|categorized|type)\b")
+CATALOG_STATUS_WORDS = {"active": "ACTIVE", "draft": "DRAFT", "archived": "ARCHIVED"}
+CATALOG_AGGREGATE_WORDS = INTENT_STOPWORDS | {
+    "all", "every", "entire", "whole", "across", "catalog", "total", "overall", "store", "shop", "our",
+    "products", "items", "variants", "variant", "count", "average", "avg", "mean", "sum", "lowest",
+    "minimum", "min", "cheapest", "smallest", "highest", "maximum", "max", "most", "expensive",
+    "largest", "biggest", "we", "have", "has", "be", "by", "which", "status",
+}
+
+
+def extract_catalog_aggregate_intent(user_input):
+    """A CatalogAggregate for a catalog-wide count or aggregate, or None if the query is not one"""
+    text = user_input.lower()
+    if not CATALOG_WIDE_PATTERN.search(text) or CATALOG_AGGREGATE_EXCLUDED.search(text):
+        return None
+    metric = next((metric for metric, words in CATALOG_AGGREGATE_METRICS if re.search(r"\b(" + words + r")\b", text)), None)
+    if metric is None:
+        return None
+    fields = normalize_requested_fields([text]) - {"dimensions", "image_url"}
+    if "cheapest" in text or "most expensive" in text:
+        fields.add("price")
+    if metric == "count":
+        field = None
+    elif len(fields) == 1:
+        field = fields.pop()
+    else:
+        return None
+
+    status = next((value for word, value in CATALOG_STATUS_WORDS.items() if re.search(r"\b" + word + r"\b", text)), None)
+    field_words = {alias for aliases in REQUESTED_FIELD_ALIASES.values() for alias in aliases}
+    name_words = []
+    for word in re.findall(r"[a-z0-9][a-z0-9-]*", text):
+        if word in CATALOG_AGGREGATE_WORDS or word in CATALOG_STATUS_WORDS or word.rstrip("s") in field_words:
+            continue
+        # Title terms match as substrings, so "cases" becomes "case" to match "Hard Case"
+        name_words.append(word[:-1] if len(word) > 3 and word.endswith("s") else word)
+
+    conditions = ([f"status:{status}"] if status else []) + [f"title:*{word}*" for word in name_words]
+    description = f"{status.lower()} products" if status else "products"
+    if name_words:
+        description += f" matching '{' '.join(name_words)}'"
+    return CatalogAggregate(metric, field, " AND ".join(conditions), description)
+
+
+def process_catalog_aggregate_query(aggregate, user_input):
+    try:
+        # Results are per store and catalog version
+        store = current_store()
+        job, result = catalog_jobs.submit(aggregate, user_input, (store.name, store.catalog_version.current))
+    except Overloaded:
+        return "Too many catalog-wide questions are being worked on right now. Please try again in a few minutes."
+    if result is not None:
+        return result["answer"]
+    return (f"This needs the whole catalog, so it is being worked out in the background (job {job.id}). "
+            f"Check GET /jobs/{job.id} for the result.")
+
+
 # ENHANCED: Enhanced input handler with status and category query support
 def handle_user_input(user_input,conversation_state):
     """Enhanced input handler with date, status and category query support"""
+
+    # Dimension queries need no LLM call
+    dimension_intent = extract_dimension_intent(user_input)
+    if dimension_intent:
+        set_intent("dimension")
+        return process_dimension_query(dimension_intent)
+
+    # Catalog-wide counts and aggregates run as background jobs
+    catalog_aggregate = extract_catalog_aggregate_intent(user_input)
+    if catalog_aggregate:
+        set_intent("catalog_aggregate")
+        return process_catalog_aggregate_query(catalog_aggregate, user_input)
     
     # Check for date-based queries first
     date_intent = extract_date_intent(user_input)
     if date_intent:
+        set_intent("date")
         # print(f"Date intent detected: {date_intent}")  # Debug print
         answer = process_date_query(date_intent, user_input)
         return answer
@@ -1214,6 +2229,7 @@ def handle_user_input(user_input,conversation_state):
         (status_category_intent.get("is_status_query", False) or 
          status_category_intent.get("is_category_query", False))):
         
+        set_intent("status_category")
         # print(f"Processing status/category query")  # Debug print
         answer = process_status_and_category_query(status_category_intent, user_input)
         return answer
@@ -1241,6 +2257,7 @@ def handle_user_input(user_input,conversation_state):
     
     if (comparison_intent and comparison_intent.get("is_comparison", False)) or is_comparison_manual:
         # Handle comparison
+        set_intent("comparison")
         answer = process_comparison(
             comparison_intent["product1_name_or_sku"],
             comparison_intent["product2_name_or_sku"],
@@ -1250,6 +2267,7 @@ def handle_user_input(user_input,conversation_state):
         return answer
     else:
         # Handle single product query (existing functionality)
+        set_intent("single_product")
         intent = extract_product_intent(user_input)
         if not intent:
             return "Sorry, I couldn't understand your question."
@@ -1262,186 +2280,224 @@ def handle_user_input(user_input,conversation_state):
             )
             return answer
 
+UPSTREAM_UNAVAILABLE_MESSAGE = "Product data is temporarily unavailable. Please try again in a moment."
+BUDGET_EXCEEDED_MESSAGE = "This question needs more product data than one request may use. Please ask about fewer products or fields."
+
+
+# NEW: Answers to repeated questions (the store's answers cache), keyed on the normalized query and the catalog version
+
+QUERY_SYNONYMS = {
+    "colour": "color", "grey": "gray", "pricing": "price", "prices": "price",
+    "qty": "inventory", "quantity": "inventory", "stock": "inventory",
+    "dimension": "dimensions", "size": "dimensions", "measurements": "dimensions",
+    "versus": "vs", "compared": "compare", "products": "product", "items": "product",
+}
+QUERY_FILLER_WORDS = {
+    "what", "whats", "is", "are", "the", "a", "an", "of", "for", "please", "me", "tell",
+    "show", "give", "can", "could", "you", "i", "do", "does", "we", "have", "s",
+}
+
+
+def normalize_query(user_input):
+    """Fold case, punctuation, whitespace, synonyms and filler words so rephrasings share a key"""
+    tokens = re.findall(r"[a-z0-9]+(?:[-./][a-z0-9]+)*", user_input.lower())
+    tokens = [QUERY_SYNONYMS.get(token, token) for token in tokens]
+    return " ".join(token for token in tokens if token not in QUERY_FILLER_WORDS)
+
+
+# NEW: Follow-ups about the product the last answer was about ("and its margin?",
+# "how about inventory?"): only field names and filler, no product identifier
+FOLLOWUP_WORDS = INTENT_STOPWORDS | {
+    "also", "plus", "then", "too", "again", "same", "one", "it's", "that's", "they", "them",
+    "their", "what", "was", "be", "would", "which", "now", "ok", "okay", "like", "s",
+}
+FOLLOWUP_ALIASES = sorted(
+    (alias for aliases in REQUESTED_FIELD_ALIASES.values() for alias in aliases), key=len, reverse=True
+)
+
+
+def followup_requested_info(user_input, conversation_state):
+    """Fields asked about in a follow-up on the last resolved product, or None if the input is not one"""
+    if conversation_state.get("last_resolved") is None:
+        return None
+    requested_info = sorted(normalize_requested_fields([user_input]))
+    if not requested_info:
+        return None
+    text = user_input.lower()
+    for alias in FOLLOWUP_ALIASES:
+        text = re.sub(r"\b" + re.escape(alias) + r"\w*", " ", text)
+    if any(word not in FOLLOWUP_WORDS for word in re.findall(r"[a-z0-9][a-z0-9'/.-]*", text)):
+        return None
+    return requested_info
+
+
+@traced("followup")
+def process_followup(requested_info, user_input, conversation_state):
+    """Answer from the last resolved product: no search and no intent extraction"""
+    resolved = conversation_state["last_resolved"]
+    product, variant = resolved.product, resolved.variant
+    # A field its details were not fetched for: fetch all of them by id, since more follow-ups tend to come
+    if not product_query_selections(requested_info) <= product_query_selections(resolved.requested_info):
+        refreshed = decode_product(fetch_product_details_by_gid(product.id))
+        if refreshed is not None:
+            variant_id = variant.id if variant else None
+            variant = next((v for v in refreshed.variants if v.id == variant_id), None)
+            product = refreshed
+            remember_resolved(conversation_state, product, variant, ())
+    return generate_ai_response(user_input, product_answer_data(product, variant), requested_info)
+
+
 def handle_user_input_with_pelican_support(user_input: str, conversation_state: Dict) -> str:
-    if conversation_state["awaiting_clarification"]:
-        if conversation_state["clarification_type"] == "color_interior_specs":
-            products = conversation_state["clarification_data"]
-            clarification_result = handle_color_interior_clarification(user_input, products)
-
-            if clarification_result["matched_product_title"] and clarification_result["confidence"] == 'high':
-                matched_product = next((p for p in products if p["node"]["title"] == clarification_result["matched_product_title"]), None)
-
-                if not matched_product:
-                    conversation_state.update({
-                        "awaiting_clarification": False,
-                        "clarification_type": "",
-                        "clarification_data": [],
-                        "original_query": "",
-                        "original_requested_info": []
-                    })
-                    return "Product with the specified color and interior combination is unavailable."
-
-                gid = matched_product["node"]["id"]
-                details = fetch_product_details_by_gid(gid)
-                product_info = details["data"]["product"]
-                variants = product_info.get("variants", {}).get("edges", [])
-
-                if len(variants) > 1:
-                    variant_products = [{"node": {"title": v["node"]["title"]}} for v in variants]
-                    variant_clarification = handle_color_interior_clarification(user_input, variant_products)
+    # Replies to a clarification and follow-ups depend on the conversation, so only fresh questions are cached.
+    # Catalog-wide aggregates have their own per-catalog-version results (see catalog_jobs)
+    store = current_store()
+    cache_key = None
+    if (not conversation_state["awaiting_clarification"] and followup_requested_info(user_input, conversation_state) is None
+            and extract_catalog_aggregate_intent(user_input) is None):
+        normalized = normalize_query(user_input)
+        cache_key = (store.catalog_version.current, normalized) if normalized else None
+    if cache_key:
+        cached = store.answers.get(cache_key)
+        if cached is not None:
+            set_intent("cached")
+            answer, resolves, resolved = cached
+            if resolves:
+                conversation_state["last_resolved"] = resolved
+            elif is_product_related_query(user_input):
+                # As in route_user_input: a product question not about a single product ends the follow-ups
+                conversation_state["last_resolved"] = None
+            return answer
 
-                    if variant_clarification.get("matched_product_title") and variant_clarification.get("confidence") == "high":
-                        matched_variant = next((v for v in variants if v["node"]["title"] == variant_clarification["matched_product_title"]), None)
-                        if matched_variant:
-                            selected_variant = matched_variant["node"]
-                            cost = selected_variant.get("inventoryItem", {}).get("unitCost", {}).get("amount", "N/A")
-                            price = selected_variant.get("price", "N/A")
-
-                            profit_margin_data = calculate_profit_and_margin(cost, price)
-                            markup_data = calculate_markup(cost, price)
-                            images = product_info.get("images", {}).get("edges", [])
-                            image_url = images[0]["node"]["url"] if images else "N/A"
-
-                            enhanced_product_data = {
-                                "title": product_info.get("title"),
-                                "variant": selected_variant,
-                                "cost": cost,
-                                "profit": profit_margin_data["profit"],
-                                "margin": profit_margin_data["margin"],
-                                "markup": markup_data["markup"],
-                                "image_url": image_url
-                            }
-
-                            original_query = conversation_state["original_query"]
-                            original_requested_info = conversation_state["original_requested_info"]
-
-                            conversation_state.update({
-                                "awaiting_clarification": False,
-                                "clarification_type": "",
-                                "clarification_data": [],
-                                "original_query": "",
-                                "original_requested_info": []
-                            })
-
-                            return generate_ai_response(original_query, enhanced_product_data, original_requested_info)
-
-                    conversation_state.update({
-                        "awaiting_clarification": True,
-                        "clarification_type": "variant_color_interior",
-                        "clarification_data": variants,
-                        "original_product": product_info
-                    })
-                    return "This product has multiple variants. Could you please specify the color and interior option you're looking for?"
+    previous_resolved = conversation_state["last_resolved"]
+    try:
+        answer = route_user_input(user_input, conversation_state)
+    except BudgetExceeded as e:
+        logger.warning("Answering without upstream data: %s", e)
+        return BUDGET_EXCEEDED_MESSAGE
+    except UpstreamUnavailable as e:
+        logger.warning("Answering without upstream data: %s", e)
+        return UPSTREAM_UNAVAILABLE_MESSAGE
+
+    # Questions that asked for a clarification, and answers built around a failed upstream call, are not reused.
+    # The product an answer was about is cached with it, so follow-ups to a cached answer still work
+    if cache_key and not conversation_state["awaiting_clarification"] and not upstream_failed():
+        resolved = conversation_state["last_resolved"]
+        store.answers.set(cache_key, (answer, resolved is not previous_resolved, resolved))
+    return answer
+
+
+# NEW: Answer a reply to a colour/interior clarification prompt (None if the clarification type is unknown)
+def handle_clarification_reply(user_input: str, conversation_state: Dict):
+    clarification = conversation_state["clarification"]
+    if clarification is None:
+        return None
 
+    if clarification.kind == "color_interior_specs":
+        products = clarification.candidates
+        candidate_products = [{"node": {"title": p.title}} for p in products]
+        clarification_result = handle_color_interior_clarification(user_input, candidate_products)
+
+        if clarification_result["matched_product_title"] and clarification_result["confidence"] == 'high':
+            matched_product = next((p for p in products if p.title == clarification_result["matched_product_title"]), None)
+
+            if not matched_product:
+                end_clarification(conversation_state)
+                return "Product with the specified color and interior combination is unavailable."
+
+            gid = matched_product.id
+            requested_info = clarification.requested_info
+            details = prefetched_product_details(conversation_state, gid, requested_info)
+            conversation_state["prefetched_details"] = {}
+            if details is None:
+                details = fetch_product_details_by_gid(gid, requested_info)
+            product = decode_product(details)
+            variants = product.variants if product else ()
+
+            if len(variants) > 1:
+                resolved_variant = resolve_variant(product, user_input)
+                if resolved_variant:
+                    variant_clarification = {"matched_product_title": resolved_variant.title, "confidence": "high"}
                 else:
-                    variant = variants[0]["node"] if variants else {}
-                    cost = variant.get("inventoryItem", {}).get("unitCost", {}).get("amount", "N/A")
-                    price = variant.get("price", "N/A")
-                    profit_margin_data = calculate_profit_and_margin(cost, price)
-                    markup_data = calculate_markup(cost, price)
-                    images = product_info.get("images", {}).get("edges", [])
-                    image_url = images[0]["node"]["url"] if images else "N/A"
-
-                    enhanced_product_data = {
-                        "title": product_info.get("title"),
-                        "variant": variant,
-                        "cost": cost,
-                        "profit": profit_margin_data["profit"],
-                        "margin": profit_margin_data["margin"],
-                        "markup": markup_data["markup"],
-                        "image_url": image_url
-                    }
-
-                    original_query = conversation_state["original_query"]
-                    original_requested_info = conversation_state["original_requested_info"]
-
-                    conversation_state.update({
-                        "awaiting_clarification": False,
-                        "clarification_type": "",
-                        "clarification_data": [],
-                        "original_query": "",
-                        "original_requested_info": []
-                    })
-
-                    return generate_ai_response(original_query, enhanced_product_data, original_requested_info)
-
-            conversation_state.update({
-                "awaiting_clarification": False,
-                "clarification_type": "",
-                "clarification_data": [],
-                "original_query": "",
-                "original_requested_info": []
-            })
-            return "Product with the specified color and interior combination is unavailable."
-
-        if conversation_state["clarification_type"] == "variant_color_interior":
-            variants = conversation_state["clarification_data"]
-            variant_products = [{"node": {"title": v["node"]["title"]}} for v in variants]
+                    variant_products = [{"node": {"title": v.title}} for v in variants]
+                    variant_clarification = handle_color_interior_clarification(user_input, variant_products)
+
+                if variant_clarification.get("matched_product_title") and variant_clarification.get("confidence") == "high":
+                    matched_variant = next((v for v in variants if v.title == variant_clarification["matched_product_title"]), None)
+                    if matched_variant:
+                        end_clarification(conversation_state)
+                        remember_resolved(conversation_state, product, matched_variant, clarification.requested_info)
+                        return generate_ai_response(
+                            clarification.query, product_answer_data(product, matched_variant), clarification.requested_info
+                        )
+
+                start_clarification(conversation_state, ClarificationContext(
+                    "variant_color_interior", clarification.query, clarification.requested_info, product=product
+                ))
+                return "This product has multiple variants. Could you please specify the color and interior option you're looking for?"
+
+            elif product:
+                variant = variants[0] if variants else None
+                end_clarification(conversation_state)
+                remember_resolved(conversation_state, product, variant, clarification.requested_info)
+                return generate_ai_response(clarification.query, product_answer_data(product, variant), clarification.requested_info)
+
+        end_clarification(conversation_state)
+        return "Product with the specified color and interior combination is unavailable."
+
+    if clarification.kind == "variant_color_interior":
+        product = clarification.product
+        variants = product.variants
+        resolved_variant = resolve_variant(product, user_input)
+        if resolved_variant:
+            clarification_result = {"matched_product_title": resolved_variant.title, "confidence": "high"}
+        else:
+            variant_products = [{"node": {"title": v.title}} for v in variants]
             clarification_result = handle_color_interior_clarification(user_input, variant_products)
 
-            matched_title = clarification_result.get("matched_product_title", "")
-            confidence = clarification_result.get("confidence", "")
-
-            if matched_title and confidence == 'high':
-                matched_variant = next((v for v in variants if v["node"]["title"] == matched_title), None)
-
-                if not matched_variant:
-                    conversation_state.update({
-                        "awaiting_clarification": False,
-                        "clarification_type": "",
-                        "clarification_data": [],
-                        "original_query": "",
-                        "original_requested_info": [],
-                        "original_product": None
-                    })
-                    return "Variant with the specified color and interior combination is unavailable."
-
-                selected_variant = matched_variant["node"]
-                product = conversation_state["original_product"]
-                cost = selected_variant.get("inventoryItem", {}).get("unitCost", {}).get("amount", "N/A")
-                price = selected_variant.get("price", "N/A")
-                profit_margin_data = calculate_profit_and_margin(cost, price)
-                markup_data = calculate_markup(cost, price)
-                images = product.get("images", {}).get("edges", [])
-                image_url = images[0]["node"]["url"] if images else "N/A"
-
-                enhanced_product_data = {
-                    "title": product.get("title"),
-                    "variant": selected_variant,
-                    "cost": cost,
-                    "profit": profit_margin_data["profit"],
-                    "margin": profit_margin_data["margin"],
-                    "markup": markup_data["markup"],
-                    "image_url": image_url
-                }
+        matched_title = clarification_result.get("matched_product_title", "")
+        confidence = clarification_result.get("confidence", "")
+
+        if matched_title and confidence == 'high':
+            matched_variant = next((v for v in variants if v.title == matched_title), None)
+
+            if not matched_variant:
+                end_clarification(conversation_state)
+                return "Variant with the specified color and interior combination is unavailable."
+
+            end_clarification(conversation_state)
+            remember_resolved(conversation_state, product, matched_variant, clarification.requested_info)
+            return generate_ai_response(
+                clarification.query, product_answer_data(product, matched_variant), clarification.requested_info
+            )
+
+        end_clarification(conversation_state)
+        return "Variant with the specified color and interior combination is unavailable."
 
-                original_query = conversation_state["original_query"]
-                original_requested_info = conversation_state["original_requested_info"]
-
-                conversation_state.update({
-                    "awaiting_clarification": False,
-                    "clarification_type": "",
-                    "clarification_data": [],
-                    "original_query": "",
-                    "original_requested_info": [],
-                    "original_product": None
-                })
-
-                return generate_ai_response(original_query, enhanced_product_data, original_requested_info)
-
-            conversation_state.update({
-                "awaiting_clarification": False,
-                "clarification_type": "",
-                "clarification_data": [],
-                "original_query": "",
-                "original_requested_info": [],
-                "original_product": None
-            })
-            return "Variant with the specified color and interior combination is unavailable."
+    return None
+
+
+def route_user_input(user_input: str, conversation_state: Dict) -> str:
+    if conversation_state["awaiting_clarification"]:
+        set_intent("clarification")
+        with stage("clarification_handling"):
+            answer = handle_clarification_reply(user_input, conversation_state)
+        if answer is not None:
+            return answer
+
+    followup_info = followup_requested_info(user_input, conversation_state)
+    if followup_info:
+        set_intent("followup")
+        return process_followup(followup_info, user_input, conversation_state)
 
     if not is_product_related_query(user_input):
+        set_intent("general")
         return generate_general_response(user_input)
 
-    return handle_user_input(user_input,conversation_state)
+    # A new product question; only an answer about a single product is followed up on
+    conversation_state["last_resolved"] = None
+
+    # Start the Shopify lookups the query probably needs while the LLM works out the intent
+    with speculative_prefetch(user_input):
+        return handle_user_input(user_input,conversation_state)
 
 
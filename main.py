@@ -1,11 +1,43 @@
 # main.py
 
-from fastapi import FastAPI, Request
+import os
+import hmac
+import json
+import base64
+import hashlib
+import logging
+import threading
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, Request, Response, Header
+from fastapi.responses import JSONResponse
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from chatbot_api import handle_user_input_with_pelican_support
+from typing import List, Optional
+from chatbot_api import handle_user_input_with_pelican_support, new_conversation_state, start_catalog_snapshot_refreshers, invalidate_product, answer_batch, BATCH_MAX_QUERIES, BATCH_CONCURRENCY, catalog_jobs, stores
+from stores import use_store, UnknownStore
+from resilience import request_budget, AdmissionController, Overloaded
+from cache import TTLCache
+from metrics import trace_request, render_metrics
+from accounting import track_usage
+import query_log
+from warmup import WarmupStatus, run_warmup
 
-app = FastAPI()
+logger = logging.getLogger(__name__)
+
+warmup_status = WarmupStatus()
+
+# Warm connection pools and prefetch hot products in the background; /ready
+# reports 503 until that is done so the load balancer never sends cold traffic
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    threading.Thread(target=run_warmup, args=(warmup_status,), name="warmup", daemon=True).start()
+    refreshers = start_catalog_snapshot_refreshers()
+    yield
+    for refresher in refreshers:
+        refresher.stop()
+    catalog_jobs.stop()
+
+app = FastAPI(lifespan=lifespan)
 
 # CORS settings (allow frontend or any client to call this API)
 app.add_middleware(
@@ -16,23 +48,151 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Define a global conversation state dictionary
-conversation_state = {
-    "awaiting_clarification": False,
-    "clarification_type": "",
-    "clarification_data": [],
-    "original_query": "",
-    "original_requested_info": [],
-    "original_product": None,
-}
+# Bound the /chat requests being served; a short queue absorbs small bursts
+# and the rest are turned away at once instead of slowing everyone down
+admission = AdmissionController(
+    max_in_flight=int(os.getenv("MAX_IN_FLIGHT_REQUESTS", "16")),
+    max_queue=int(os.getenv("ADMISSION_QUEUE_SIZE", "16")),
+    queue_timeout=float(os.getenv("ADMISSION_QUEUE_TIMEOUT_SECONDS", "2")),
+)
+
+@app.exception_handler(Overloaded)
+def overloaded_handler(request: Request, exc: Overloaded):
+    return JSONResponse(
+        status_code=exc.status_code,
+        content={"response": str(exc)},
+        headers={"Retry-After": str(exc.retry_after)},
+    )
+
+# Requests name their store by a /stores/{store}/... path or the X-Store
+# header; neither means the default store (see stores.py)
+def resolve_store(store=None, x_store=None):
+    return stores.get(store or x_store)
+
+@app.exception_handler(UnknownStore)
+def unknown_store_handler(request: Request, exc: UnknownStore):
+    return JSONResponse(status_code=404, content={"error": f"unknown store {exc.args[0]!r}"})
+
+# Conversation state per store and session (requests without a session_id share "default");
+# idle sessions expire and the least recently used are evicted past MAX_SESSIONS
+sessions = TTLCache(
+    float(os.getenv("SESSION_TTL_SECONDS", "1800")),
+    max_entries=int(os.getenv("MAX_SESSIONS", "10000")),
+    name="sessions",
+)
+
+
+def session_state(store, session_id):
+    key = (store.name, session_id)
+    state = sessions.get(key)
+    if state is None:
+        state = new_conversation_state()
+    # Setting it again restarts the idle timer
+    sessions.set(key, state)
+    return state
 
 # Request model
 class ChatQuery(BaseModel):
     query: str
+    session_id: Optional[str] = None
 
 # API route
 @app.post("/chat")
-def chat_endpoint(payload: ChatQuery):
+@app.post("/stores/{store}/chat")
+def chat_endpoint(payload: ChatQuery, http_response: Response, store: Optional[str] = None,
+                  x_store: Optional[str] = Header(None)):
+    shop = resolve_store(store, x_store)
     user_query = payload.query
-    response = handle_user_input_with_pelican_support(user_query, conversation_state)
+    session_id = payload.session_id or "default"
+    conversation_state = session_state(shop, session_id)
+    # Every Shopify/OpenAI call made for this request shares one time budget, and
+    # its tokens and query cost are counted against the request's budgets
+    with use_store(shop), admission.admit(), trace_request("chat") as request_trace, request_budget(), query_log.capture(
+        session_id, user_query, conversation_state["awaiting_clarification"]
+    ) as captured, track_usage(conversation_state["usage"]) as usage:
+        response = handle_user_input_with_pelican_support(user_query, conversation_state)
+        if captured:
+            captured.finish(response, request_trace.stage_totals())
+    http_response.headers.update({**usage.headers(), **conversation_state["usage"].headers()})
     return {"response": response}
+
+# Many independent questions at once (e.g. a daily price and stock report):
+# identical ones are answered once and product lookups are batched
+class ChatBatchQuery(BaseModel):
+    queries: List[str]
+
+@app.post("/chat/batch")
+@app.post("/stores/{store}/chat/batch")
+def chat_batch_endpoint(payload: ChatBatchQuery, http_response: Response, store: Optional[str] = None,
+                        x_store: Optional[str] = Header(None)):
+    shop = resolve_store(store, x_store)
+    if len(payload.queries) > BATCH_MAX_QUERIES:
+        return JSONResponse(status_code=400, content={"error": f"at most {BATCH_MAX_QUERIES} queries per batch"})
+    # A batch takes an admission slot for each question it works on at once
+    weight = min(len(payload.queries), BATCH_CONCURRENCY)
+    with use_store(shop), admission.admit(weight), trace_request("chat_batch"), track_usage() as usage:
+        responses = answer_batch(payload.queries)
+    http_response.headers.update(usage.headers())
+    return {"responses": responses}
+
+# Status and result of a background job started for a catalog-wide question
+@app.get("/jobs/{job_id}")
+@app.get("/stores/{store}/jobs/{job_id}")
+def job_endpoint(job_id: str, store: Optional[str] = None, x_store: Optional[str] = Header(None)):
+    shop = resolve_store(store, x_store)
+    job = catalog_jobs.get(job_id)
+    # A job's catalog version is (store name, version); other stores' jobs are not shown
+    if job is None or job.catalog_version[0] != shop.name:
+        return JSONResponse(status_code=404, content={"error": "unknown or expired job"})
+    return job.as_dict()
+
+# Shopify product webhooks (products/create, products/update, products/delete)
+# invalidate cached product data and bump the catalog version of the store
+# named by X-Shopify-Shop-Domain
+SHOPIFY_WEBHOOK_SECRET = os.getenv("SHOPIFY_WEBHOOK_SECRET")
+# Unsigned webhooks would let anyone flush caches; only for local testing
+SHOPIFY_WEBHOOK_ALLOW_UNSIGNED = os.getenv("SHOPIFY_WEBHOOK_ALLOW_UNSIGNED", "0") == "1"
+
+@app.post("/webhooks/products")
+async def product_webhook(request: Request):
+    body = await request.body()
+    if SHOPIFY_WEBHOOK_SECRET:
+        expected = base64.b64encode(hmac.new(SHOPIFY_WEBHOOK_SECRET.encode(), body, hashlib.sha256).digest()).decode()
+        if not hmac.compare_digest(expected, request.headers.get("X-Shopify-Hmac-Sha256", "")):
+            return JSONResponse(status_code=401, content={"error": "invalid webhook signature"})
+    elif not SHOPIFY_WEBHOOK_ALLOW_UNSIGNED:
+        return JSONResponse(status_code=401, content={"error": "webhooks are not accepted: SHOPIFY_WEBHOOK_SECRET is not set"})
+    try:
+        product = json.loads(body)
+    except ValueError:
+        return JSONResponse(status_code=400, content={"error": "invalid JSON"})
+    domain = request.headers.get("X-Shopify-Shop-Domain")
+    name = stores.by_domain(domain) if domain else None
+    # With a single store every webhook is for it, whatever domain it was configured under
+    if name is None and domain and len(stores.configs) > 1:
+        return JSONResponse(status_code=404, content={"error": f"no store for shop {domain}"})
+    gid = product.get("admin_graphql_api_id") or f"gid://shopify/Product/{product.get('id')}"
+    logger.info("webhook %s for %s", request.headers.get("X-Shopify-Topic", "products"), gid)
+    # A store that is not active has no product caches to drop, but its catalog version
+    # (kept across eviction) still moves on, so answers kept under the old one are not reused
+    store = stores.peek(name)
+    if store is not None:
+        with use_store(store):
+            invalidate_product(gid, product)
+    else:
+        stores.catalog_version(name).bump()
+    catalog_jobs.drop_store(name or stores.default)
+    return {"status": "ok"}
+
+# Readiness probe for the load balancer
+@app.get("/ready")
+def ready_endpoint(response: Response):
+    if not warmup_status.ready:
+        response.status_code = 503
+    return warmup_status.as_dict()
+
+# Prometheus metrics: stage latency histograms, upstream errors, cache hit ratios
+@app.get("/metrics")
+def metrics_endpoint():
+    body, content_type = render_metrics()
+    return Response(content=body, media_type=content_type)
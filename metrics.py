@@ -0,0 +1,282 @@
+# metrics.py
+#
+# Per-stage latency tracing and Prometheus metrics. Each traced stage is
+# observed in a histogram and appended to the current request's trace so a
+# request can be shown as a waterfall. When OTEL_TRACING=1 and the
+# opentelemetry package is installed, stages are also emitted as spans.
+
+import os
+import time
+import logging
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+
+from prometheus_client import Counter, Gauge, Histogram, CONTENT_TYPE_LATEST, generate_latest
+
+logger = logging.getLogger(__name__)
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+OTEL_TRACING = os.getenv("OTEL_TRACING", "0") == "1" and otel_trace is not None
+tracer = otel_trace.get_tracer("shopify_bot_api") if OTEL_TRACING else None
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 16, 32)
+
+REQUEST_SECONDS = Histogram(
+    "chatbot_request_seconds", "Time to answer a /chat request", ["endpoint"], buckets=LATENCY_BUCKETS
+)
+STAGE_SECONDS = Histogram(
+    "chatbot_stage_seconds", "Time spent in each pipeline stage", ["stage"], buckets=LATENCY_BUCKETS
+)
+SHOPIFY_QUERY_COST = Histogram(
+    "chatbot_shopify_query_cost", "Shopify GraphQL query cost per call", ["operation", "kind"],
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000)
+)
+UPSTREAM_ERRORS = Counter(
+    "chatbot_upstream_errors_total", "Failed upstream calls", ["upstream", "kind"]
+)
+CACHE_REQUESTS = Counter(
+    "chatbot_cache_requests_total", "Cache lookups", ["cache", "result"]
+)
+CACHE_HIT_RATIO = Gauge(
+    "chatbot_cache_hit_ratio", "Cache hits divided by lookups since start", ["cache"]
+)
+LLM_HEDGE_EVENTS = Counter(
+    "chatbot_llm_hedge_events_total", "Hedged LLM calls (eligible, hedged, hedge_wins, primary_wins)", ["event"]
+)
+LLM_HEDGE_WIN_RATE = Gauge(
+    "chatbot_llm_hedge_win_rate", "Fraction of hedged LLM calls won by the second attempt"
+)
+ADMISSION_EVENTS = Counter(
+    "chatbot_admission_total", "/chat admission decisions (admitted, queued, rejected_queue_full, rejected_timeout)", ["result"]
+)
+REQUESTS_IN_FLIGHT = Gauge(
+    "chatbot_requests_in_flight", "/chat requests being served"
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "chatbot_upstream_concurrency_limit", "Adaptive concurrency limit per upstream", ["upstream"]
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "chatbot_upstream_in_flight", "Upstream calls in flight", ["upstream"]
+)
+COALESCED_CALLS = Counter(
+    "chatbot_coalesced_calls_total", "Callers that shared an identical in-flight call instead of making their own", ["kind"]
+)
+
+LLM_TOKENS = Counter(
+    "chatbot_llm_tokens_total", "OpenAI tokens used, by request intent, call site and kind (prompt, completion, cached_prompt)",
+    ["intent", "call_site", "kind"]
+)
+SHOPIFY_COST = Counter(
+    "chatbot_shopify_cost_total", "Shopify query cost, by request intent, operation and kind (requested, actual)",
+    ["intent", "operation", "kind"]
+)
+REQUEST_TOKENS = Histogram(
+    "chatbot_request_llm_tokens", "OpenAI tokens per request", ["intent"],
+    buckets=(0, 100, 250, 500, 1000, 2000, 4000, 8000, 16000)
+)
+REQUEST_SHOPIFY_COST = Histogram(
+    "chatbot_request_shopify_cost", "Shopify actual query cost per request", ["intent"],
+    buckets=(0, 1, 5, 10, 25, 50, 100, 250, 500, 1000, 2000)
+)
+PROMPT_TOKENS = Counter(
+    "chatbot_llm_prompt_tokens_total", "OpenAI prompt tokens by prompt (name@version) and kind (total, cached)",
+    ["prompt", "kind"]
+)
+PROMPT_CACHE_RATIO = Gauge(
+    "chatbot_llm_prompt_cache_ratio", "Share of prompt tokens served from the provider's prompt cache, by prompt", ["prompt"]
+)
+BUDGET_EXCEEDED = Counter(
+    "chatbot_budget_exceeded_total", "Requests that spent a per-request budget (tokens, shopify_cost) and took cheaper paths", ["budget"]
+)
+
+_cache_counts = {}
+_cache_counts_lock = threading.Lock()
+
+
+def record_cache_lookup(cache, hit):
+    CACHE_REQUESTS.labels(cache=cache, result="hit" if hit else "miss").inc()
+    with _cache_counts_lock:
+        hits, total = _cache_counts.get(cache, (0, 0))
+        hits, total = hits + (1 if hit else 0), total + 1
+        _cache_counts[cache] = (hits, total)
+    CACHE_HIT_RATIO.labels(cache=cache).set(hits / total)
+
+
+_prompt_counts = {}
+
+
+def record_prompt_tokens(prompt, prompt_tokens, cached_tokens):
+    PROMPT_TOKENS.labels(prompt=prompt, kind="total").inc(prompt_tokens)
+    PROMPT_TOKENS.labels(prompt=prompt, kind="cached").inc(cached_tokens)
+    with _cache_counts_lock:
+        cached, total = _prompt_counts.get(prompt, (0, 0))
+        cached, total = cached + cached_tokens, total + prompt_tokens
+        _prompt_counts[prompt] = (cached, total)
+    if total:
+        PROMPT_CACHE_RATIO.labels(prompt=prompt).set(cached / total)
+
+
+def record_upstream_error(upstream, kind):
+    UPSTREAM_ERRORS.labels(upstream=upstream, kind=kind).inc()
+
+
+def record_admission(result):
+    ADMISSION_EVENTS.labels(result=result).inc()
+
+
+def record_coalesced(kind):
+    COALESCED_CALLS.labels(kind=kind).inc()
+
+
+def record_concurrency(upstream, limit, in_flight):
+    UPSTREAM_CONCURRENCY_LIMIT.labels(upstream=upstream).set(limit)
+    UPSTREAM_IN_FLIGHT.labels(upstream=upstream).set(in_flight)
+
+
+def record_shopify_cost(operation, result):
+    """Observe requested/actual cost from a GraphQL response's extensions"""
+    cost = (result.get("extensions") or {}).get("cost") or {}
+    for kind in ("requestedQueryCost", "actualQueryCost"):
+        if cost.get(kind) is not None:
+            SHOPIFY_QUERY_COST.labels(operation=operation, kind=kind).observe(cost[kind])
+    return cost
+
+
+def record_request_usage(usage):
+    """Observe one request's tokens and query cost (an accounting.RequestUsage) under its intent"""
+    for call_site, (prompt_tokens, completion_tokens, cached_tokens) in usage.llm.items():
+        LLM_TOKENS.labels(intent=usage.intent, call_site=call_site, kind="prompt").inc(prompt_tokens)
+        LLM_TOKENS.labels(intent=usage.intent, call_site=call_site, kind="completion").inc(completion_tokens)
+        LLM_TOKENS.labels(intent=usage.intent, call_site=call_site, kind="cached_prompt").inc(cached_tokens)
+    for operation, (requested, actual) in usage.shopify.items():
+        SHOPIFY_COST.labels(intent=usage.intent, operation=operation, kind="requested").inc(requested)
+        SHOPIFY_COST.labels(intent=usage.intent, operation=operation, kind="actual").inc(actual)
+    REQUEST_TOKENS.labels(intent=usage.intent).observe(usage.tokens)
+    REQUEST_SHOPIFY_COST.labels(intent=usage.intent).observe(usage.actual_cost)
+
+
+def record_budget_exceeded(budget):
+    BUDGET_EXCEEDED.labels(budget=budget).inc()
+
+
+# Spans recorded for the request being served: list of dicts
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class RequestTrace:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.spans = []
+        self.lock = threading.Lock()
+
+    def add(self, span):
+        with self.lock:
+            self.spans.append(span)
+
+    def stage_totals(self):
+        """Total seconds per stage name"""
+        totals = {}
+        with self.lock:
+            for span in self.spans:
+                totals[span["stage"]] = totals.get(span["stage"], 0.0) + span["seconds"]
+        return totals
+
+    def waterfall(self):
+        """One line per span: offset from request start, duration and attributes"""
+        lines = []
+        with self.lock:
+            spans = sorted(self.spans, key=lambda span: span["offset"])
+        for span in spans:
+            attributes = " ".join(f"{k}={v}" for k, v in span["attributes"].items())
+            lines.append(f"{span['offset'] * 1000:8.1f}ms +{span['seconds'] * 1000:8.1f}ms  {span['stage']} {attributes}".rstrip())
+        return "\n".join(lines)
+
+
+@contextmanager
+def trace_request(endpoint="chat"):
+    """Collect the stages of one request and observe its total latency"""
+    request_trace = RequestTrace()
+    token = _current_trace.set(request_trace)
+    try:
+        if tracer is not None:
+            with tracer.start_as_current_span(f"request {endpoint}"):
+                yield request_trace
+        else:
+            yield request_trace
+    finally:
+        _current_trace.reset(token)
+        REQUEST_SECONDS.labels(endpoint=endpoint).observe(time.monotonic() - request_trace.started)
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("request %s waterfall:\n%s", endpoint, request_trace.waterfall())
+
+
+def current_trace():
+    return _current_trace.get()
+
+
+class Stage:
+    """Handle yielded by stage() so callers can attach attributes such as query cost"""
+
+    def __init__(self, name, attributes, span=None):
+        self.name = name
+        self.attributes = attributes
+        self.span = span
+
+    def set(self, key, value):
+        self.attributes[key] = value
+        if self.span is not None:
+            self.span.set_attribute(key, value)
+
+
+@contextmanager
+def stage(name, **attributes):
+    """Time a pipeline stage"""
+    request_trace = _current_trace.get()
+    start = time.monotonic()
+    if tracer is not None:
+        with tracer.start_as_current_span(name, attributes=attributes) as span:
+            handle = Stage(name, attributes, span)
+            try:
+                yield handle
+            finally:
+                _finish_stage(handle, start, request_trace)
+    else:
+        handle = Stage(name, attributes)
+        try:
+            yield handle
+        finally:
+            _finish_stage(handle, start, request_trace)
+
+
+def _finish_stage(handle, start, request_trace):
+    seconds = time.monotonic() - start
+    STAGE_SECONDS.labels(stage=handle.name).observe(seconds)
+    if request_trace is not None:
+        request_trace.add({
+            "stage": handle.name,
+            "offset": start - request_trace.started,
+            "seconds": seconds,
+            "attributes": handle.attributes,
+        })
+
+
+def traced(name):
+    """Decorator form of stage()"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def render_metrics():
+    """Prometheus text exposition of every metric, with its content type"""
+    return generate_latest(), CONTENT_TYPE_LATEST
@@ -0,0 +1,315 @@
+# model_router.py
+#
+# Routes each LLM call site to a primary model and diverts to a fallback
+# model when the primary's rolling p95 latency degrades or it errors.
+
+import os
+import json
+import time
+import threading
+import logging
+import contextvars
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+from openai.types.chat import ChatCompletion
+
+from resilience import call_upstream, CircuitOpenError, DeadlineExceeded, RetryBudget, SingleFlight
+from metrics import LLM_HEDGE_EVENTS, LLM_HEDGE_WIN_RATE
+from query_log import request_key, record_upstream, replayed_response
+from accounting import check_llm_budget, record_llm_usage, separate_usage, current_usage
+from prompts import prompt_key
+
+logger = logging.getLogger(__name__)
+
+# Errors worth retrying; anything else (bad request, auth) fails immediately
+RETRYABLE_OPENAI_ERRORS = (
+    openai.APITimeoutError,
+    openai.APIConnectionError,
+    openai.RateLimitError,
+    openai.InternalServerError,
+)
+
+# Hedged (duplicated) requests are opt-in and capped to this fraction of extra calls
+LLM_HEDGING = os.getenv("LLM_HEDGING", "0") == "1"
+HEDGE_MAX_EXTRA_RATIO = float(os.getenv("HEDGE_MAX_EXTRA_RATIO", "0.05"))
+
+# Call site -> models, token limit and timeout (seconds). "hedge" only
+# applies to temperature-0 calls, which are idempotent.
+DEFAULT_MODEL_ROUTES = {
+    "intent_extraction": {
+        "primary": "gpt-3.5-turbo",
+        "fallback": "gpt-4o-mini",
+        "max_tokens": 300,
+        "timeout": 10,
+        "p95_threshold": 4.0,
+        "hedge": LLM_HEDGING,
+    },
+    "variant_matching": {
+        "primary": "gpt-3.5-turbo",
+        "fallback": "gpt-4o-mini",
+        "max_tokens": 300,
+        "timeout": 10,
+        "p95_threshold": 4.0,
+    },
+    "answer_generation": {
+        "primary": "gpt-3.5-turbo",
+        "fallback": "gpt-4o-mini",
+        "max_tokens": 500,
+        "timeout": 20,
+        "p95_threshold": 8.0,
+    },
+    "comparison": {
+        "primary": "gpt-3.5-turbo",
+        "fallback": "gpt-4o-mini",
+        "max_tokens": 500,
+        "timeout": 20,
+        "p95_threshold": 8.0,
+    },
+}
+
+
+def load_model_routes(path=None):
+    """Load routes, letting a JSON file (MODEL_ROUTES_FILE) override the defaults per call site"""
+    routes = {site: dict(route) for site, route in DEFAULT_MODEL_ROUTES.items()}
+    path = path or os.getenv("MODEL_ROUTES_FILE")
+    if path:
+        with open(path) as f:
+            overrides = json.load(f)
+        for site, route in overrides.items():
+            routes.setdefault(site, {}).update(route)
+    return routes
+
+
+class LatencyTracker:
+    """Rolling latency samples per model, limited by age and count"""
+
+    def __init__(self, window_seconds=300, max_samples=200, min_samples=20):
+        self.window_seconds = window_seconds
+        self.max_samples = max_samples
+        self.min_samples = min_samples
+        self.samples = {}
+        self.lock = threading.Lock()
+
+    def record(self, model, seconds):
+        with self.lock:
+            samples = self.samples.setdefault(model, deque(maxlen=self.max_samples))
+            samples.append((time.monotonic(), seconds))
+
+    def percentile(self, model, pct):
+        """Return the pct percentile latency, or None if there are too few recent samples"""
+        cutoff = time.monotonic() - self.window_seconds
+        with self.lock:
+            samples = self.samples.get(model)
+            if not samples:
+                return None
+            while samples and samples[0][0] < cutoff:
+                samples.popleft()
+            values = sorted(seconds for _, seconds in samples)
+        if len(values) < self.min_samples:
+            return None
+        index = min(len(values) - 1, int(round(pct / 100 * (len(values) - 1))))
+        return values[index]
+
+    def p95(self, model):
+        return self.percentile(model, 95)
+
+    def p90(self, model):
+        return self.percentile(model, 90)
+
+
+class HedgeStats:
+    """Counts hedged calls and which attempt won"""
+
+    def __init__(self):
+        self.eligible = 0
+        self.hedged = 0
+        self.hedge_wins = 0
+        self.primary_wins = 0
+        self.lock = threading.Lock()
+
+    def record(self, name):
+        with self.lock:
+            setattr(self, name, getattr(self, name) + 1)
+        LLM_HEDGE_EVENTS.labels(event=name).inc()
+        LLM_HEDGE_WIN_RATE.set(self.win_rate())
+
+    def win_rate(self):
+        with self.lock:
+            return self.hedge_wins / self.hedged if self.hedged else 0.0
+
+
+class HedgeRace:
+    """The attempts of one hedged call: the first to succeed wins, later ones are ignored,
+    and it fails only once every attempt has"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.attempts = 1
+        self.failures = 0
+        self.winner = None
+        self.result = None
+        self.error = None
+        self.lock = threading.Lock()
+
+    def add_attempt(self):
+        """Count another attempt, unless the race is already decided"""
+        with self.lock:
+            if self.done.is_set():
+                return False
+            self.attempts += 1
+            return True
+
+    def finish(self, name, result, usage):
+        with self.lock:
+            if self.done.is_set():
+                return
+            self.winner, self.result = name, result
+            # Called from the attempt's copy of the request context
+            request_usage = current_usage()
+            if request_usage is not None:
+                request_usage.add_usage(usage)
+            self.done.set()
+
+    def fail(self, error):
+        with self.lock:
+            self.failures += 1
+            self.error = error
+            if self.failures >= self.attempts:
+                self.done.set()
+
+
+class ModelRouter:
+    """Send chat completions to the model configured for each call site"""
+
+    def __init__(self, client_factory, routes=None, tracker=None):
+        self.client_factory = client_factory
+        self._client = None
+        self._client_lock = threading.Lock()
+        self.routes = routes or load_model_routes()
+        self.tracker = tracker or LatencyTracker()
+        # Starts empty: hedges are only earned by calls, so a burst after startup cannot hedge every call
+        self.hedge_budget = RetryBudget(ratio=HEDGE_MAX_EXTRA_RATIO, min_per_second=0, max_tokens=5, initial_tokens=0)
+        self.flights = SingleFlight("llm")
+        self.hedge_stats = HedgeStats()
+        self.hedge_executor = ThreadPoolExecutor(max_workers=16, thread_name_prefix="llm-hedge")
+
+    @property
+    def client(self):
+        """The OpenAI client, created on first use"""
+        if self._client is None:
+            with self._client_lock:
+                if self._client is None:
+                    self._client = self.client_factory()
+        return self._client
+
+    def choose_model(self, call_site):
+        route = self.routes[call_site]
+        primary_p95 = self.tracker.p95(route["primary"])
+        if route.get("fallback") and primary_p95 is not None and primary_p95 > route["p95_threshold"]:
+            logger.info(
+                "%s: %s p95 %.2fs over %.2fs, using %s",
+                call_site, route["primary"], primary_p95, route["p95_threshold"], route["fallback"]
+            )
+            return route["fallback"]
+        return route["primary"]
+
+    def _create(self, call_site, model, route, messages, temperature):
+        def create(timeout):
+            start = time.monotonic()
+            try:
+                response = self.client.chat.completions.create(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=route["max_tokens"],
+                    timeout=timeout,
+                )
+            except Exception:
+                # Count failures as slow calls so a failing model also gets diverted
+                self.tracker.record(model, max(time.monotonic() - start, timeout))
+                raise
+            self.tracker.record(model, time.monotonic() - start)
+            record_llm_usage(call_site, response, prompt_key(messages))
+            return response
+
+        return call_upstream("openai", create, route["timeout"], retry_on=RETRYABLE_OPENAI_ERRORS)
+
+    def complete(self, call_site, messages, temperature=0):
+        """Run a chat completion for a call site, falling back once on error"""
+        # Past the request's token budget this raises BudgetExceeded and the caller takes its no-LLM path
+        check_llm_budget()
+        key = request_key(call_site, messages, temperature)
+        recorded = replayed_response("llm", key)
+        if recorded is not None:
+            return ChatCompletion.model_validate(recorded)
+
+        start = time.monotonic()
+        route = self.routes[call_site]
+        # Identical prompts in flight at once share one completion
+        if route.get("hedge") and temperature == 0:
+            response = self.flights.do(key, lambda: self._complete_hedged(call_site, route, messages, temperature))
+        else:
+            response = self.flights.do(key, lambda: self._complete_with_fallback(call_site, route, messages, temperature))
+        record_upstream("llm", key, response.model_dump(), time.monotonic() - start)
+        return response
+
+    def _complete_with_fallback(self, call_site, route, messages, temperature):
+        model = self.choose_model(call_site)
+        try:
+            return self._create(call_site, model, route, messages, temperature)
+        except (CircuitOpenError, DeadlineExceeded):
+            # The fallback shares the upstream and the request budget, so it would fail too
+            raise
+        except Exception as e:
+            fallback = route.get("fallback")
+            if not fallback or model == fallback:
+                raise
+            logger.warning("%s: %s failed (%s), retrying on %s", call_site, model, e, fallback)
+            return self._create(call_site, fallback, route, messages, temperature)
+
+    def _attempt(self, race, name, call_site, route, messages, temperature):
+        # Runs in a copy of the caller's context, so it keeps the request deadline; its usage
+        # is counted for the request only if it wins
+        if race.done.is_set():
+            return
+        with separate_usage() as usage:
+            try:
+                result = self._complete_with_fallback(call_site, route, messages, temperature)
+            except Exception as e:
+                race.fail(e)
+                return
+        race.finish(name, result, usage)
+
+    def _complete_hedged(self, call_site, route, messages, temperature):
+        """Fire a second attempt if the first is slower than the rolling p90, and take whichever returns first"""
+        self.hedge_stats.record("eligible")
+        self.hedge_budget.deposit()
+        hedge_after = self.tracker.p90(self.choose_model(call_site))
+        if hedge_after is None:
+            return self._complete_with_fallback(call_site, route, messages, temperature)
+
+        # The primary gets a thread of its own, so hedge-eligible calls are not bounded by the
+        # hedge executor; only hedges, which are rare, queue for it
+        race = HedgeRace()
+        context = contextvars.copy_context()
+        threading.Thread(
+            target=context.run, args=(self._attempt, race, "primary", call_site, route, messages, temperature),
+            name="llm-primary", daemon=True,
+        ).start()
+        hedge = None
+        if not race.done.wait(hedge_after) and self.hedge_budget.try_spend() and race.add_attempt():
+            self.hedge_stats.record("hedged")
+            hedge = self.hedge_executor.submit(
+                contextvars.copy_context().run, self._attempt, race, "hedge", call_site, route, messages, temperature
+            )
+        race.done.wait()
+        if hedge is not None:
+            # Never sent if it is still queued; if it is running, its answer and usage are ignored
+            hedge.cancel()
+        if race.winner is None:
+            raise race.error
+        if hedge is not None:
+            self.hedge_stats.record("hedge_wins" if race.winner == "hedge" else "primary_wins")
+        return race.result
@@ -0,0 +1,179 @@
+# query_log.py
+#
+# Append-only capture of /chat traffic for deterministic replay. Each line
+# is one request: session, turn, query, answer, per-stage timings and every
+# upstream response (Shopify GraphQL payloads and LLM completions) keyed by
+# a hash of the request that produced it. Paths ending in .gz are written as
+# multi-member gzip so the log stays compact and appendable.
+#
+# Recording is enabled by setting QUERY_LOG_PATH. bench/replay.py serves
+# upstream calls back from the log with replaying().
+
+import os
+import gzip
+import json
+import time
+import hashlib
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from resilience import UpstreamUnavailable
+
+QUERY_LOG_PATH = os.getenv("QUERY_LOG_PATH")
+
+
+class ReplayMiss(UpstreamUnavailable):
+    """The replayed request made an upstream call that is not in the log"""
+
+
+def request_key(*parts):
+    """Stable hash of an upstream request (query + variables, or prompt + model settings)"""
+    encoded = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return hashlib.sha1(encoded.encode()).hexdigest()[:20]
+
+
+def open_log(path, mode):
+    if path.endswith(".gz"):
+        return gzip.open(path, mode + "t", encoding="utf-8")
+    return open(path, mode, encoding="utf-8")
+
+
+class QueryLogWriter:
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.turns = {}
+
+    def next_turn(self, session):
+        with self.lock:
+            self.turns[session] = self.turns.get(session, 0) + 1
+            return self.turns[session]
+
+    def append(self, entry):
+        line = json.dumps(entry, separators=(",", ":"), default=str)
+        with self.lock:
+            with open_log(self.path, "a") as f:
+                f.write(line + "\n")
+
+
+def read_log(path):
+    with open_log(path, "r") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+writer = QueryLogWriter(QUERY_LOG_PATH) if QUERY_LOG_PATH else None
+
+# Upstream events captured for the request being recorded
+_recording = contextvars.ContextVar("query_log_recording", default=None)
+# Recorded entry being replayed
+_replaying = contextvars.ContextVar("query_log_replaying", default=None)
+
+
+class CapturedRequest:
+    def __init__(self, session, query, awaiting_clarification):
+        self.entry = {
+            "ts": time.time(),
+            "session": session,
+            "turn": writer.next_turn(session) if writer else 0,
+            "query": query,
+            "awaiting_clarification": awaiting_clarification,
+            "upstream": [],
+        }
+
+    def finish(self, answer, stages):
+        self.entry["answer"] = answer
+        self.entry["stages"] = {stage: round(seconds, 6) for stage, seconds in stages.items()}
+
+
+@contextmanager
+def capture(session, query, awaiting_clarification=False):
+    """Record one request if QUERY_LOG_PATH is set; yields the capture (or None)"""
+    if writer is None:
+        yield None
+        return
+    captured = CapturedRequest(session, query, awaiting_clarification)
+    token = _recording.set(captured.entry["upstream"])
+    try:
+        yield captured
+    finally:
+        _recording.reset(token)
+        if "answer" in captured.entry:
+            writer.append(captured.entry)
+
+
+@contextmanager
+def not_recorded():
+    """Leave the upstream calls made inside this block out of the request's recording"""
+    token = _recording.set(None)
+    try:
+        yield
+    finally:
+        _recording.reset(token)
+
+
+def record_upstream(kind, key, response, seconds):
+    events = _recording.get()
+    if events is not None:
+        events.append({"kind": kind, "key": key, "ms": round(seconds * 1000, 1), "response": response})
+
+
+class ReplaySource:
+    """Serves a recorded request's upstream responses, in order per key.
+
+    Keys missing from the request itself fall back to any response recorded
+    for the same key elsewhere in the log, so a pipeline that moves a call
+    between turns still replays.
+    """
+
+    def __init__(self, entry, global_index=None, delay=True):
+        self.queues = {}
+        for event in entry.get("upstream", []):
+            self.queues.setdefault((event["kind"], event["key"]), []).append(event)
+        self.global_index = global_index or {}
+        self.delay = delay
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def take(self, kind, key):
+        with self.lock:
+            queue = self.queues.get((kind, key))
+            event = queue.pop(0) if queue else self.global_index.get((kind, key))
+            if event is None:
+                self.misses += 1
+        if event is None:
+            raise ReplayMiss(f"{kind} request {key} is not in the query log")
+        if self.delay:
+            time.sleep(event["ms"] / 1000)
+        return event["response"]
+
+
+def build_global_index(entries):
+    index = {}
+    for entry in entries:
+        for event in entry.get("upstream", []):
+            index.setdefault((event["kind"], event["key"]), event)
+    return index
+
+
+@contextmanager
+def replaying(source):
+    token = _replaying.set(source)
+    try:
+        yield source
+    finally:
+        _replaying.reset(token)
+
+
+def replay_active():
+    return _replaying.get() is not None
+
+
+def replayed_response(kind, key):
+    """The recorded response when replaying (raises ReplayMiss if absent), otherwise None"""
+    source = _replaying.get()
+    if source is None:
+        return None
+    return source.take(kind, key)
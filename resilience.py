@@ -0,0 +1,534 @@
+# resilience.py
+#
+# Deadlines, retry budgets, circuit breakers and adaptive concurrency limits
+# for upstream calls (Shopify Admin API and OpenAI), and admission control
+# for incoming requests, and coalescing of identical in-flight calls.
+# Upstreams named "shopify:<store>" get a breaker and concurrency limit of
+# their own, so one store's outage or throttling does not hold back the rest.
+
+import os
+import math
+import time
+import random
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+from metrics import record_upstream_error, record_admission, record_concurrency, record_coalesced, REQUESTS_IN_FLIGHT
+
+logger = logging.getLogger(__name__)
+
+REQUEST_BUDGET_SECONDS = float(os.getenv("REQUEST_BUDGET_SECONDS", "30"))
+MIN_CALL_TIMEOUT_SECONDS = 0.5
+
+
+class UpstreamUnavailable(Exception):
+    """An upstream call could not be made or did not succeed in time"""
+
+
+class CircuitOpenError(UpstreamUnavailable):
+    pass
+
+
+class DeadlineExceeded(UpstreamUnavailable):
+    pass
+
+
+class ConcurrencyWaitTimeout(DeadlineExceeded):
+    """No upstream concurrency slot came free within the call's timeout"""
+
+
+class RetryableUpstreamError(Exception):
+    """Raised by call functions for responses worth retrying (5xx, 429, throttling)"""
+
+
+class Overloaded(Exception):
+    """The server is at capacity; the client should retry after retry_after seconds"""
+
+    def __init__(self, message, status_code, retry_after):
+        super().__init__(message)
+        self.status_code = status_code
+        self.retry_after = retry_after
+
+
+# Absolute deadline (time.monotonic) of the request being served, if any
+_request_deadline = contextvars.ContextVar("request_deadline", default=None)
+# Upstream calls that failed during the request being served: a one-item list
+_request_failures = contextvars.ContextVar("request_failures", default=None)
+
+
+@contextmanager
+def request_budget(seconds=None):
+    """Give every upstream call made inside this block a share of one overall time budget"""
+    token = _request_deadline.set(time.monotonic() + (seconds or REQUEST_BUDGET_SECONDS))
+    failures_token = _request_failures.set([0])
+    try:
+        yield
+    finally:
+        _request_failures.reset(failures_token)
+        _request_deadline.reset(token)
+
+
+def note_upstream_failure():
+    failures = _request_failures.get()
+    if failures is not None:
+        failures[0] += 1
+
+
+def upstream_failed():
+    """Whether an upstream call failed during this request, i.e. its answer may be degraded"""
+    failures = _request_failures.get()
+    return bool(failures and failures[0])
+
+
+def remaining_budget():
+    deadline = _request_deadline.get()
+    if deadline is None:
+        return None
+    return deadline - time.monotonic()
+
+
+def call_timeout(cap):
+    """Timeout for the next call: the per-call cap, shortened to what is left of the request budget"""
+    remaining = remaining_budget()
+    if remaining is None:
+        return cap
+    if remaining < MIN_CALL_TIMEOUT_SECONDS:
+        note_upstream_failure()
+        raise DeadlineExceeded("request budget exhausted")
+    return min(cap, remaining)
+
+
+class RetryBudget:
+    """Token bucket that limits retries to a fraction of overall calls.
+
+    Every call deposits `ratio` tokens and every retry spends one, so
+    retries cannot multiply load during an outage. `min_per_second`
+    keeps a trickle of retries available when traffic is low. The bucket
+    starts with `initial_tokens`, full by default.
+    """
+
+    def __init__(self, ratio=0.1, min_per_second=1.0, max_tokens=10.0, initial_tokens=None):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_tokens = max_tokens
+        self.tokens = max_tokens if initial_tokens is None else initial_tokens
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.max_tokens, self.tokens + (now - self.last_refill) * self.min_per_second)
+        self.last_refill = now
+
+    def deposit(self):
+        with self.lock:
+            self._refill()
+            self.tokens = min(self.max_tokens, self.tokens + self.ratio)
+
+    def try_spend(self):
+        with self.lock:
+            self._refill()
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return True
+            return False
+
+
+class CircuitBreaker:
+    """Opens after consecutive failures, then lets a single probe through after reset_timeout"""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def is_open(self):
+        with self.lock:
+            return self.state == self.OPEN and time.monotonic() - self.opened_at < self.reset_timeout
+
+    def record_success(self):
+        with self.lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    logger.warning("circuit %s opened after %s failures", self.name, self.failures)
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+    def record_aborted(self):
+        """The call let through ended without a verdict on the upstream (e.g. a
+        non-retryable error); a probe that did so re-opens the breaker, as
+        otherwise it would stay half-open and refuse every call"""
+        with self.lock:
+            if self.state == self.HALF_OPEN:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+
+retry_budget = RetryBudget(
+    ratio=float(os.getenv("RETRY_BUDGET_RATIO", "0.1")),
+    min_per_second=float(os.getenv("RETRY_BUDGET_MIN_PER_SECOND", "1")),
+)
+
+breakers = {
+    "shopify": CircuitBreaker("shopify"),
+    "openai": CircuitBreaker("openai"),
+}
+
+
+upstream_registry_lock = threading.Lock()
+
+
+def base_upstream(upstream):
+    """"shopify" for "shopify:<store>": the upstream whose settings it shares"""
+    return upstream.partition(":")[0]
+
+
+def get_breaker(upstream):
+    breaker = breakers.get(upstream)
+    if breaker is None:
+        with upstream_registry_lock:
+            breaker = breakers.setdefault(upstream, CircuitBreaker(upstream))
+    return breaker
+
+
+def forget_upstream(upstream):
+    """Drop the breaker and concurrency limit of a "shopify:<store>" upstream whose store was evicted"""
+    if upstream in DEFAULT_CONCURRENCY_MAX:
+        return
+    with upstream_registry_lock:
+        breakers.pop(upstream, None)
+        concurrency_limits.pop(upstream, None)
+
+
+class AdaptiveConcurrencyLimit:
+    """Concurrency limit for one upstream that follows its observed latency.
+
+    The limit is scaled by baseline/recent latency, so it shrinks once calls
+    take longer than the no-load baseline (they are queuing upstream), and
+    gains sqrt(limit) headroom while latency stays flat. Throttling and
+    failed calls cut it by a third.
+    """
+
+    def __init__(self, name, initial, min_limit, max_limit, smoothing=0.2):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.smoothing = smoothing
+        self.in_flight = 0
+        self.baseline = None
+        self.recent = None
+        self.cond = threading.Condition()
+        record_concurrency(name, self.limit, 0)
+
+    @contextmanager
+    def slot(self, timeout):
+        """Hold one of the upstream's slots, waiting at most timeout seconds for one"""
+        deadline = time.monotonic() + timeout
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise ConcurrencyWaitTimeout(f"no {self.name} concurrency slot free within {timeout:.1f}s")
+                self.cond.wait(remaining)
+            self.in_flight += 1
+            record_concurrency(self.name, self.limit, self.in_flight)
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= 1
+                record_concurrency(self.name, self.limit, self.in_flight)
+                self.cond.notify()
+
+    def record_latency(self, seconds):
+        with self.cond:
+            self.recent = seconds if self.recent is None else self.recent + (seconds - self.recent) * self.smoothing
+            # The baseline follows new lows at once and drifts slowly towards recent latency
+            if self.baseline is None or seconds < self.baseline:
+                self.baseline = seconds
+            else:
+                self.baseline += (self.recent - self.baseline) * 0.01
+            gradient = max(0.5, min(1.0, self.baseline / self.recent)) if self.recent > 0 else 1.0
+            # Only grow when the limit is actually being used
+            headroom = math.sqrt(self.limit) if self.in_flight + 1 >= self.limit / 2 else 0
+            target = self.limit * gradient + headroom
+            self.limit = max(self.min_limit, min(self.max_limit, self.limit + (target - self.limit) * self.smoothing))
+            record_concurrency(self.name, self.limit, self.in_flight)
+            self.cond.notify_all()
+
+    def record_overload(self):
+        with self.cond:
+            self.limit = max(self.min_limit, self.limit * 0.67)
+            record_concurrency(self.name, self.limit, self.in_flight)
+
+
+def concurrency_limit_from_env(name, default_max):
+    base = base_upstream(name)
+    max_limit = int(os.getenv(f"{base.upper()}_CONCURRENCY_MAX", str(default_max)))
+    min_limit = int(os.getenv(f"{base.upper()}_CONCURRENCY_MIN", "2"))
+    return AdaptiveConcurrencyLimit(name, initial=max(min_limit, max_limit // 2), min_limit=min_limit, max_limit=max_limit)
+
+
+DEFAULT_CONCURRENCY_MAX = {"shopify": 20, "openai": 32}
+
+concurrency_limits = {
+    "shopify": concurrency_limit_from_env("shopify", DEFAULT_CONCURRENCY_MAX["shopify"]),
+    "openai": concurrency_limit_from_env("openai", DEFAULT_CONCURRENCY_MAX["openai"]),
+}
+
+
+def get_concurrency_limit(upstream):
+    limit = concurrency_limits.get(upstream)
+    if limit is None:
+        with upstream_registry_lock:
+            limit = concurrency_limits.get(upstream)
+            if limit is None:
+                limit = concurrency_limits[upstream] = concurrency_limit_from_env(
+                    upstream, DEFAULT_CONCURRENCY_MAX[base_upstream(upstream)]
+                )
+    return limit
+
+
+class CostBucket:
+    """Client-side view of a Shopify store's query-cost bucket, kept from the
+    throttleStatus of its responses. A query waits until the bucket should
+    hold what the same operation last cost, instead of being sent only to
+    come back THROTTLED; the wait is capped by the request budget."""
+
+    def __init__(self, name):
+        self.name = name
+        self.maximum = None
+        self.available = None
+        self.restore_rate = None
+        self.updated_at = None
+        # operation -> requestedQueryCost of its last response
+        self.expected = {}
+        self.lock = threading.Lock()
+
+    def _estimate(self, now):
+        restored = self.available + (now - self.updated_at) * self.restore_rate
+        return min(self.maximum, restored) if self.maximum else restored
+
+    def acquire(self, operation):
+        with self.lock:
+            needed = self.expected.get(operation)
+            if needed is None or self.available is None:
+                return
+            now = time.monotonic()
+            available = self._estimate(now)
+            delay = max(0.0, (needed - available) / self.restore_rate) if self.restore_rate else 0.0
+            remaining = remaining_budget()
+            if remaining is not None and delay > remaining - MIN_CALL_TIMEOUT_SECONDS:
+                # Not worth waiting for: send it and let the retry path handle a THROTTLED answer
+                delay = 0.0
+            # Spend the points now so concurrent queries wait behind this one
+            self.available, self.updated_at = available - needed, now
+        if delay:
+            logger.info("%s cost bucket low, waiting %.2fs for %s", self.name, delay, operation)
+            time.sleep(delay)
+
+    def update(self, operation, cost):
+        """Take in the cost extensions of a response"""
+        throttle = cost.get("throttleStatus") or {}
+        with self.lock:
+            if cost.get("requestedQueryCost") is not None:
+                self.expected[operation] = cost["requestedQueryCost"]
+            if throttle.get("currentlyAvailable") is not None:
+                self.maximum = throttle.get("maximumAvailable")
+                self.available = throttle["currentlyAvailable"]
+                self.restore_rate = throttle.get("restoreRate") or 50.0
+                self.updated_at = time.monotonic()
+
+
+class SingleFlight:
+    """Concurrent callers with the same key share one call and its result (or exception).
+
+    Callers that join an in-flight call wait at most for what is left of
+    their own request budget. Results are shared, so callers must not
+    modify them.
+    """
+
+    class Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error = None
+
+    def __init__(self, kind):
+        self.kind = kind
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, fn):
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = self.Call()
+        if leader:
+            try:
+                call.result = fn()
+            except BaseException as e:
+                call.error = e
+                raise
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+            return call.result
+
+        record_coalesced(self.kind)
+        remaining = remaining_budget()
+        if not call.done.wait(None if remaining is None else max(0.0, remaining)):
+            note_upstream_failure()
+            raise DeadlineExceeded(f"request budget ran out waiting for a shared {self.kind} call")
+        if call.error is not None:
+            if isinstance(call.error, UpstreamUnavailable):
+                note_upstream_failure()
+            raise call.error
+        return call.result
+
+
+class AdmissionController:
+    """Bounds requests in flight; a few more may wait briefly for a slot.
+
+    A full wait queue is rejected at once with 429, and a request that waits
+    longer than queue_timeout gets 503. Both carry a Retry-After estimated
+    from recent service times.
+    """
+
+    def __init__(self, max_in_flight, max_queue, queue_timeout):
+        self.max_in_flight = max_in_flight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.in_flight = 0
+        self.waiting = 0
+        self.service_seconds = 1.0
+        self.cond = threading.Condition()
+
+    def retry_after(self):
+        return max(1, math.ceil(self.service_seconds * (self.waiting + 1) / self.max_in_flight))
+
+    @contextmanager
+    def admit(self, weight=1):
+        """Hold weight of the in-flight slots (a batch takes one per worker it runs at once)"""
+        weight = max(1, min(weight, self.max_in_flight))
+        with self.cond:
+            if self.in_flight + weight > self.max_in_flight:
+                if self.waiting >= self.max_queue:
+                    record_admission("rejected_queue_full")
+                    raise Overloaded("Too many requests, please retry shortly.", 429, self.retry_after())
+                record_admission("queued")
+                self.waiting += 1
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while self.in_flight + weight > self.max_in_flight:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            record_admission("rejected_timeout")
+                            raise Overloaded("The service is busy, please retry shortly.", 503, self.retry_after())
+                        self.cond.wait(remaining)
+                finally:
+                    self.waiting -= 1
+            self.in_flight += weight
+            record_admission("admitted")
+            REQUESTS_IN_FLIGHT.set(self.in_flight)
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.in_flight -= weight
+                self.service_seconds += (time.monotonic() - start - self.service_seconds) * 0.1
+                REQUESTS_IN_FLIGHT.set(self.in_flight)
+                # Waiters need different numbers of slots, so each checks for itself
+                self.cond.notify_all()
+
+
+def backoff_delay(attempt, base=0.2, cap=2.0):
+    """Full-jitter exponential backoff"""
+    return random.uniform(0, min(cap, base * (2 ** attempt)))
+
+
+def call_upstream(upstream, fn, timeout_cap, max_retries=2, retry_on=(RetryableUpstreamError,)):
+    """Call fn(timeout) with a deadline-derived timeout, jittered retries and the upstream's breaker.
+
+    Raises CircuitOpenError without calling when the breaker is open, and
+    UpstreamUnavailable once retries or the request budget run out.
+    """
+    breaker = get_breaker(upstream)
+    limit = get_concurrency_limit(upstream)
+    retry_budget.deposit()
+    attempt = 0
+    while True:
+        # Fail fast without taking a slot; allow() itself comes last, below
+        if breaker.is_open():
+            note_upstream_failure()
+            record_upstream_error(upstream, "circuit_open")
+            raise CircuitOpenError(f"{upstream} circuit is open")
+        try:
+            with limit.slot(call_timeout(timeout_cap)):
+                # Time spent waiting for a slot comes out of the call's own timeout
+                timeout = call_timeout(timeout_cap)
+                # Only once nothing but the call itself can fail: a call allow() lets
+                # through may be a half-open probe, which must end in a verdict
+                if not breaker.allow():
+                    note_upstream_failure()
+                    record_upstream_error(upstream, "circuit_open")
+                    raise CircuitOpenError(f"{upstream} circuit is open")
+                start = time.monotonic()
+                try:
+                    result = fn(timeout)
+                except retry_on:
+                    raise
+                except BaseException:
+                    breaker.record_aborted()
+                    raise
+                limit.record_latency(time.monotonic() - start)
+        except ConcurrencyWaitTimeout:
+            note_upstream_failure()
+            record_upstream_error(upstream, "concurrency_wait")
+            raise
+        except retry_on as e:
+            record_upstream_error(upstream, type(e).__name__)
+            breaker.record_failure()
+            limit.record_overload()
+            remaining = remaining_budget()
+            delay = backoff_delay(attempt)
+            if (attempt >= max_retries
+                    or (remaining is not None and remaining - delay < MIN_CALL_TIMEOUT_SECONDS)
+                    or not retry_budget.try_spend()):
+                note_upstream_failure()
+                raise UpstreamUnavailable(f"{upstream} call failed: {e}") from e
+            logger.info("%s call failed (%s), retry %s in %.2fs", upstream, e, attempt + 1, delay)
+            time.sleep(delay)
+            attempt += 1
+            continue
+        breaker.record_success()
+        return result
@@ -0,0 +1,287 @@
+# session_models.py
+#
+# Compact product records and per-conversation state. Shopify payloads are
+# decoded into these slotted classes (see shopify_decode), which keep only
+# what answers and clarifications use; a pending clarification and the last
+# resolved product serialize to a small binary form for an external session
+# store.
+#
+# Binary layout (native byte order, like the catalog snapshot): every
+# string and every number of the context, in a fixed walk order, goes into
+# one column, so decoding is a handful of C-level calls rather than one
+# unpack per field.
+#
+#   header    format version (B), string, None and number counts (I)
+#   lengths   length of each string in characters (0 for None)    int32
+#   nones     positions of the strings that are None               int32
+#   numbers   counts, flags, price/cost in cents (-1 if unknown),
+#             inventory (INVENTORY_UNKNOWN if unknown), dimensions
+#             in thousandths of an inch (-1 if unknown)             int64
+#   blob      every string, concatenated, UTF-8
+#
+# The walk: kind, query, requested_info, candidates, product; a product is
+# id, title, image_url, interior/exterior l, w, h, variants; a variant is
+# id, title, sku, price, cost, inventory, options (name/value pairs).
+
+import struct
+from array import array
+from itertools import accumulate
+
+from catalog_index import AXES, product_dimensions
+from catalog_snapshot import INVENTORY_UNKNOWN, to_cents, from_cents
+
+FORMAT_VERSION = 1
+DIMENSION_KINDS = ("interior", "exterior")
+
+HEADER = struct.Struct("=BIII")
+
+
+class _Writer:
+    def __init__(self):
+        self.strings = []
+        self.numbers = []
+
+    def string(self, value):
+        self.strings.append(value)
+
+    def number(self, value):
+        self.numbers.append(value)
+
+    def to_bytes(self):
+        nones = array("i", [position for position, value in enumerate(self.strings) if value is None])
+        strings = [value or "" for value in self.strings] if nones else self.strings
+        lengths = array("i", map(len, strings))
+        numbers = array("q", self.numbers)
+        return b"".join((
+            HEADER.pack(FORMAT_VERSION, len(lengths), len(nones), len(numbers)),
+            lengths.tobytes(), nones.tobytes(), numbers.tobytes(), "".join(strings).encode("utf-8"),
+        ))
+
+
+class _Reader:
+    def __init__(self, data):
+        version, string_count, none_count, number_count = HEADER.unpack_from(data)
+        if version != FORMAT_VERSION:
+            raise ValueError(f"unsupported session format version {version}")
+        offset = HEADER.size
+        lengths, nones, numbers = array("i"), array("i"), array("q")
+        for column, count in ((lengths, string_count), (nones, none_count), (numbers, number_count)):
+            column.frombytes(data[offset:offset + count * column.itemsize])
+            offset += count * column.itemsize
+        text = str(data[offset:], "utf-8")
+        strings = [text[end - length:end] for length, end in zip(lengths, accumulate(lengths))]
+        for position in nones:
+            strings[position] = None
+        # Bound __next__ methods: one call per field while walking
+        self.string = iter(strings).__next__
+        self.number = iter(numbers).__next__
+
+
+def financials(price_cents, cost_cents):
+    """(profit, margin, markup) as display strings, "N/A" when they cannot be worked out"""
+    if cost_cents <= 0 or price_cents < 0:
+        return "N/A", "N/A", "N/A"
+    markup = f"{price_cents / cost_cents:.2f}"
+    if price_cents == 0:
+        return "N/A", "N/A", markup
+    profit_cents = price_cents - cost_cents
+    return f"{profit_cents / 100:.2f}", f"{profit_cents / price_cents * 100:.2f}%", markup
+
+
+class Variant:
+    __slots__ = ("id", "title", "sku", "price_cents", "cost_cents", "inventory", "options", "profit", "margin", "markup")
+
+    def __init__(self, id, title=None, sku=None, price_cents=-1, cost_cents=-1, inventory=None, options=()):
+        self.id = id
+        self.title = title
+        self.sku = sku
+        self.price_cents = price_cents
+        self.cost_cents = cost_cents
+        self.inventory = inventory
+        # ((name, value), ...) from selectedOptions
+        self.options = options
+        # Derived once here rather than wherever an answer is built
+        self.profit, self.margin, self.markup = financials(price_cents, cost_cents)
+
+    @property
+    def price(self):
+        return from_cents(self.price_cents)
+
+    @property
+    def cost(self):
+        return from_cents(self.cost_cents)
+
+    @classmethod
+    def from_node(cls, node):
+        cost = ((node.get("inventoryItem") or {}).get("unitCost") or {}).get("amount")
+        return cls(
+            node["id"],
+            node.get("title"),
+            node.get("sku"),
+            to_cents(node.get("price")),
+            to_cents(cost),
+            node.get("inventoryQuantity"),
+            tuple((o["name"], o["value"]) for o in node.get("selectedOptions") or []),
+        )
+
+    def as_node(self):
+        """The variant shaped like a GraphQL variant node, with only the known fields"""
+        node = {"id": self.id, "sku": self.sku, "title": self.title}
+        if self.options:
+            node["selectedOptions"] = [{"name": name, "value": value} for name, value in self.options]
+        if self.price_cents >= 0:
+            node["price"] = self.price
+        if self.inventory is not None:
+            node["inventoryQuantity"] = self.inventory
+        if self.cost_cents >= 0:
+            node["inventoryItem"] = {"unitCost": {"amount": self.cost}}
+        return node
+
+    def write(self, writer):
+        writer.string(self.id)
+        writer.string(self.title)
+        writer.string(self.sku)
+        writer.number(self.price_cents)
+        writer.number(self.cost_cents)
+        writer.number(INVENTORY_UNKNOWN if self.inventory is None else self.inventory)
+        writer.number(len(self.options))
+        for name, value in self.options:
+            writer.string(name)
+            writer.string(value)
+
+    @classmethod
+    def read(cls, reader):
+        string, number = reader.string, reader.number
+        id, title, sku = string(), string(), string()
+        price_cents, cost_cents, inventory = number(), number(), number()
+        options = tuple([(string(), string()) for _ in range(number())])
+        return cls(id, title, sku, price_cents, cost_cents, None if inventory == INVENTORY_UNKNOWN else inventory, options)
+
+
+class Product:
+    __slots__ = ("id", "title", "image_url", "dimensions", "variants")
+
+    def __init__(self, id, title=None, image_url=None, dimensions=None, variants=()):
+        self.id = id
+        self.title = title
+        self.image_url = image_url
+        # {"interior": (l, w, h), "exterior": (l, w, h)} for the sides that are known
+        self.dimensions = dimensions or {}
+        self.variants = variants
+
+    @classmethod
+    def from_node(cls, node, with_variants=True):
+        images = (node.get("images") or {}).get("edges") or []
+        variants = ((node.get("variants") or {}).get("edges") or []) if with_variants else []
+        return cls(
+            node["id"],
+            node.get("title"),
+            images[0]["node"].get("url") if images else None,
+            node.get("dimensions") or product_dimensions(node),
+            tuple(Variant.from_node(edge["node"]) for edge in variants),
+        )
+
+    def as_node(self):
+        """The product shaped like a GraphQL product node, with only the known fields"""
+        node = {
+            "id": self.id,
+            "title": self.title,
+            "variants": {"edges": [{"node": variant.as_node()} for variant in self.variants]},
+            "dimensions": self.dimensions,
+        }
+        if self.image_url:
+            node["images"] = {"edges": [{"node": {"url": self.image_url}}]}
+        return node
+
+    def write(self, writer):
+        writer.string(self.id)
+        writer.string(self.title)
+        writer.string(self.image_url)
+        for kind in DIMENSION_KINDS:
+            sides = self.dimensions.get(kind)
+            for position in range(len(AXES)):
+                writer.number(round(sides[position] * 1000) if sides else -1)
+        writer.number(len(self.variants))
+        for variant in self.variants:
+            variant.write(writer)
+
+    @classmethod
+    def read(cls, reader):
+        string, number = reader.string, reader.number
+        id, title, image_url = string(), string(), string()
+        dimensions = {}
+        for kind in DIMENSION_KINDS:
+            sides = (number(), number(), number())
+            if min(sides) >= 0:
+                dimensions[kind] = (sides[0] / 1000, sides[1] / 1000, sides[2] / 1000)
+        variants = tuple([Variant.read(reader) for _ in range(number())])
+        return cls(id, title, image_url, dimensions, variants)
+
+
+class ClarificationContext:
+    """What a clarification prompt is waiting on: the candidate products
+    ("color_interior_specs") or the product whose variant is being chosen
+    ("variant_color_interior"), plus the question that led to it"""
+
+    __slots__ = ("kind", "query", "requested_info", "candidates", "product")
+
+    def __init__(self, kind, query, requested_info=(), candidates=(), product=None):
+        self.kind = kind
+        self.query = query
+        self.requested_info = tuple(str(item) for item in requested_info or ())
+        self.candidates = candidates
+        self.product = product
+
+    def to_bytes(self):
+        writer = _Writer()
+        writer.string(self.kind)
+        writer.string(self.query)
+        writer.number(len(self.requested_info))
+        for item in self.requested_info:
+            writer.string(item)
+        writer.number(len(self.candidates))
+        for candidate in self.candidates:
+            candidate.write(writer)
+        writer.number(self.product is not None)
+        if self.product is not None:
+            self.product.write(writer)
+        return writer.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = _Reader(data)
+        kind, query = reader.string(), reader.string()
+        requested_info = tuple([reader.string() for _ in range(reader.number())])
+        candidates = tuple([Product.read(reader) for _ in range(reader.number())])
+        product = Product.read(reader) if reader.number() else None
+        return cls(kind, query, requested_info, candidates, product)
+
+
+class ResolvedProduct:
+    """The product the last answer was about, with only the variant it was
+    about, and the fields its details were fetched for; follow-up questions
+    ("and its margin?") are answered from it"""
+
+    __slots__ = ("product", "requested_info")
+
+    def __init__(self, product, requested_info=()):
+        self.product = product
+        self.requested_info = tuple(str(item) for item in requested_info or ())
+
+    @property
+    def variant(self):
+        return self.product.variants[0] if self.product.variants else None
+
+    def to_bytes(self):
+        writer = _Writer()
+        writer.number(len(self.requested_info))
+        for item in self.requested_info:
+            writer.string(item)
+        self.product.write(writer)
+        return writer.to_bytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        reader = _Reader(data)
+        requested_info = tuple([reader.string() for _ in range(reader.number())])
+        return cls(Product.read(reader), requested_info)
@@ -0,0 +1,50 @@
+# shopify_decode.py
+#
+# One decoding layer for Shopify GraphQL responses. Bodies are parsed with
+# orjson when it is installed (the json module otherwise), and product
+# payloads (search edges, product details, nodes) become the typed Product
+# and Variant records of session_models, whose profit, margin and markup
+# are worked out once, when the variant is decoded.
+
+import json
+
+from metrics import stage, traced
+from session_models import Product
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def loads(body):
+    """Parse a JSON body (bytes or str)"""
+    with stage("shopify_parse"):
+        return orjson.loads(body) if orjson is not None else json.loads(body)
+
+
+def loads_lines(lines):
+    """Parse each non-empty line of a JSONL stream (bulk operation results), one object at a time"""
+    parse = orjson.loads if orjson is not None else json.loads
+    for line in lines:
+        if line.strip():
+            yield parse(line)
+
+
+def dumps(value):
+    """Serialize a request payload to bytes"""
+    return orjson.dumps(value) if orjson is not None else json.dumps(value).encode("utf-8")
+
+
+@traced("shopify_decode")
+def decode_search(result):
+    """Products of a products(...) search, without variants"""
+    edges = (((result.get("data") or {}).get("products")) or {}).get("edges") or []
+    return [Product.from_node(edge["node"], with_variants=False) for edge in edges]
+
+
+@traced("shopify_decode")
+def decode_product(result):
+    """The product of a product(id:) result with its variants, or None"""
+    node = (result.get("data") or {}).get("product")
+    return Product.from_node(node) if node else None
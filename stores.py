@@ -0,0 +1,235 @@
+# stores.py
+#
+# The Shopify stores one process serves. Each store has its own keep-alive
+# connection pool, query-cost bucket, circuit breaker, product caches,
+# answer cache, catalog and vector indexes and catalog version. They are
+# created on first use and dropped again, least recently used first, once
+# more than MAX_ACTIVE_STORES are active, so many mostly idle stores share
+# one deployment without each holding a full set of caches. A request picks
+# its store by the X-Store header or a /stores/{store}/... path (see
+# main.py); requests without one, and background work, use DEFAULT_STORE.
+#
+# The "default" store comes from SHOPIFY_STORE_URL and SHOPIFY_ADMIN_API_TOKEN
+# (or SHOPIFY_GRAPHQL_URL) as before. SHOPIFY_STORES_FILE names a JSON file
+# with more stores (or overrides of "default"):
+#
+#   {"outdoor": {"store_url": "outdoor.myshopify.com", "access_token_env": "OUTDOOR_TOKEN"},
+#    "pro": {"graphql_url": "https://pro.myshopify.com/admin/api/2023-07/graphql.json",
+#            "access_token": "shpat_...", "snapshot_path": "pro.snap"}}
+
+import os
+import json
+import logging
+import threading
+import contextvars
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from cache import TTLCache, CatalogVersion
+from catalog_index import CatalogIndex
+from catalog_snapshot import SharedSnapshot
+from vector_index import HashedNgramIndex
+from resilience import CostBucket, forget_upstream
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_STORE = os.getenv("DEFAULT_STORE", "default")
+MAX_ACTIVE_STORES = int(os.getenv("MAX_ACTIVE_STORES", "8"))
+SHOPIFY_API_VERSION = os.getenv("SHOPIFY_API_VERSION", "2023-07")
+
+
+class UnknownStore(KeyError):
+    """No store is configured under that name"""
+
+
+class StoreConfig:
+    __slots__ = ("name", "graphql_url", "access_token", "domain", "snapshot_path")
+
+    def __init__(self, name, graphql_url, access_token=None, domain=None, snapshot_path=None):
+        self.name = name
+        self.graphql_url = graphql_url
+        self.access_token = access_token
+        # The myshopify.com domain, which Shopify webhooks name in X-Shopify-Shop-Domain
+        self.domain = domain
+        self.snapshot_path = snapshot_path
+
+    @classmethod
+    def from_dict(cls, name, entry):
+        domain = entry.get("store_url")
+        graphql_url = entry.get("graphql_url") or f"https://{domain}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"
+        token = entry.get("access_token") or os.getenv(entry.get("access_token_env") or "")
+        return cls(name, graphql_url, token, domain, entry.get("snapshot_path"))
+
+
+def load_store_configs(path=None):
+    """Store name -> StoreConfig: "default" from the environment, plus SHOPIFY_STORES_FILE"""
+    store_url = os.getenv("SHOPIFY_STORE_URL")
+    configs = {"default": StoreConfig(
+        "default",
+        os.getenv("SHOPIFY_GRAPHQL_URL", f"https://{store_url}/admin/api/{SHOPIFY_API_VERSION}/graphql.json"),
+        os.getenv("SHOPIFY_ADMIN_API_TOKEN"),
+        store_url,
+        os.getenv("CATALOG_SNAPSHOT_PATH"),
+    )}
+    path = path or os.getenv("SHOPIFY_STORES_FILE")
+    if path:
+        with open(path) as f:
+            for name, entry in json.load(f).items():
+                configs[name] = StoreConfig.from_dict(name, entry)
+    return configs
+
+
+class Store:
+    """Everything kept for one store; dropped as a whole when the store is evicted"""
+
+    def __init__(self, config, pool_size, cache_ttl, cache_entries, answer_ttl, answer_entries, catalog_version=None):
+        self.name = config.name
+        self.config = config
+        self.graphql_url = config.graphql_url
+        self.headers = {"X-Shopify-Access-Token": config.access_token, "Content-Type": "application/json"}
+        # Breaker and concurrency limit name (resilience); the default store keeps the plain "shopify" ones
+        self.upstream = "shopify" if config.name == DEFAULT_STORE else f"shopify:{config.name}"
+        self.session = requests.Session()
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.cost_bucket = CostBucket(self.upstream)
+        self.search_results = TTLCache(cache_ttl, max_entries=cache_entries, name="product_search")
+        self.product_details = TTLCache(cache_ttl, max_entries=cache_entries, name="product_details")
+        self.answers = TTLCache(answer_ttl, max_entries=answer_entries, name="answers")
+        self.catalog_index = CatalogIndex(cache_ttl)
+        self.vector_index = HashedNgramIndex()
+        self.catalog_version = catalog_version or CatalogVersion()
+        self.catalog_version.on_shared_change(self.forget_products)
+        self.snapshot = SharedSnapshot(config.snapshot_path) if config.snapshot_path else None
+        # Blocks running inside use_store(self); an evicted store is released once the last one ends
+        self.users = 0
+        self.evicted = False
+        self.lock = threading.Lock()
+
+    def forget_products(self):
+        """Another worker received a product change: which product is not known here"""
+        logger.info("store %s: catalog changed in another worker, product caches dropped", self.name)
+        self.product_details.clear()
+        self.search_results.clear()
+        self.catalog_index.entries.clear()
+
+    def enter(self):
+        with self.lock:
+            self.users += 1
+
+    def leave(self):
+        with self.lock:
+            self.users -= 1
+            release = self.evicted and self.users == 0
+        if release:
+            self.release()
+
+    def close(self):
+        """Evicted: release the connection pool, snapshot mapping and upstream state once unused"""
+        with self.lock:
+            self.evicted = True
+            release = self.users == 0
+        if release:
+            self.release()
+
+    def release(self):
+        self.session.close()
+        if self.snapshot:
+            self.snapshot.close()
+        forget_upstream(self.upstream)
+
+
+class StoreRegistry:
+    """Active stores by name, built by build(config, catalog_version) on first use;
+    past max_active the least recently used one (never the default) is evicted.
+
+    Catalog versions are kept by name, across eviction: a rebuilt store carries
+    on from its old version, so nothing cached under that version elsewhere
+    (catalog job results) can match again after the catalog changed."""
+
+    def __init__(self, configs, build, max_active=MAX_ACTIVE_STORES, default=DEFAULT_STORE, on_evict=None):
+        if default not in configs:
+            raise ValueError(f"DEFAULT_STORE {default!r} is not configured")
+        self.configs = configs
+        self.build = build
+        self.on_evict = on_evict
+        self.max_active = max(1, max_active)
+        self.default = default
+        self.active = OrderedDict()
+        self.versions = {}
+        self.lock = threading.Lock()
+
+    def get(self, name=None):
+        name = name or self.default
+        with self.lock:
+            store = self.active.get(name)
+            if store is not None:
+                self.active.move_to_end(name)
+                return store
+            config = self.configs.get(name)
+            if config is None:
+                raise UnknownStore(name)
+            store = self.active[name] = self.build(config, self._catalog_version(config))
+            evicted = []
+            for cold in list(self.active):
+                if len(self.active) <= self.max_active:
+                    break
+                if cold != self.default and cold != name:
+                    evicted.append(self.active.pop(cold))
+        for cold in evicted:
+            # Requests still using it keep it until they finish; the next one builds it afresh
+            logger.info("store %s evicted (more than %s active)", cold.name, self.max_active)
+            cold.close()
+            if self.on_evict:
+                self.on_evict(cold)
+        return store
+
+    def catalog_version(self, name=None):
+        """The store's catalog version, whether or not the store is active"""
+        name = name or self.default
+        if name not in self.configs:
+            raise UnknownStore(name)
+        with self.lock:
+            return self._catalog_version(self.configs[name])
+
+    def _catalog_version(self, config):
+        # Workers sharing a snapshot share its version file too, so a webhook any of them
+        # receives moves every worker's version
+        version = self.versions.get(config.name)
+        if version is None:
+            path = f"{config.snapshot_path}.version" if config.snapshot_path else None
+            version = self.versions[config.name] = CatalogVersion(path)
+        return version
+
+    def peek(self, name=None):
+        """The store if it is active, without building it or counting it as used"""
+        return self.active.get(name or self.default)
+
+    def by_domain(self, domain):
+        """The name of the store with that myshopify.com domain, or None"""
+        return next((name for name, config in self.configs.items() if config.domain and config.domain == domain), None)
+
+    def current(self):
+        """The store of the request being served, or the default store outside one"""
+        return _current_store.get() or self.get()
+
+    def __len__(self):
+        return len(self.active)
+
+
+_current_store = contextvars.ContextVar("current_store", default=None)
+
+
+@contextmanager
+def use_store(store):
+    """Serve everything inside this block from store (a Store)"""
+    store.enter()
+    token = _current_store.set(store)
+    try:
+        yield store
+    finally:
+        _current_store.reset(token)
+        store.leave()
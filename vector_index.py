@@ -0,0 +1,173 @@
+# vector_index.py
+#
+# Local retrieval over product text for descriptive queries that name no
+# title or SKU ("waterproof case that fits a DJI drone"). Each product's
+# title, productType, tags and description become hashed n-gram features
+# (words, word pairs and character trigrams, so "drones" still meets
+# "drone") folded into a fixed number of buckets: one float32 row per
+# product in a NumPy matrix, no vocabulary to keep. Rows hold sublinear term
+# frequencies; IDF weights come from document frequency counts at query time,
+# so adding, replacing or removing a product (webhooks) touches one row and
+# never rebuilds the matrix. Queries are scored together, one matrix product
+# over the buckets they use, and the top k rows by cosine similarity win.
+
+import os
+import re
+import math
+import time
+import zlib
+import threading
+
+import numpy as np
+
+VECTOR_INDEX_DIMENSIONS = int(os.getenv("VECTOR_INDEX_DIMENSIONS", "4096"))
+
+STOPWORDS = frozenset({
+    "a", "an", "the", "and", "or", "of", "for", "to", "in", "on", "with", "by", "at", "from", "that",
+    "which", "what", "is", "are", "it", "its", "this", "me", "my", "i", "you", "any", "some", "fits",
+    "fit", "need", "want", "looking", "show", "find", "have", "do", "does", "can", "will", "into",
+})
+# Character trigrams catch plurals and typos; the whole words still carry most of the weight
+TRIGRAM_WEIGHT = 0.5
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+HTML_TAG = re.compile(r"<[^>]+>")
+
+
+def tokens(text):
+    return [token for token in TOKEN_PATTERN.findall(HTML_TAG.sub(" ", text or "").lower()) if token not in STOPWORDS]
+
+
+def bucket(feature, dimensions):
+    # crc32 rather than hash(): the same bucket in every worker and after a restart
+    return zlib.crc32(feature.encode()) % dimensions
+
+
+class HashedNgramIndex:
+    """Hashed n-gram TF-IDF vectors of documents made of weighted text fields, by id.
+
+    Thread-safe; search() takes a batch of queries.
+    """
+
+    def __init__(self, dimensions=VECTOR_INDEX_DIMENSIONS, initial_rows=256):
+        self.dimensions = dimensions
+        self.matrix = np.zeros((initial_rows, dimensions), dtype=np.float32)
+        # Number of live rows each bucket is non-zero in
+        self.document_frequency = np.zeros(dimensions, dtype=np.float64)
+        self.row_ids = []
+        self.rows = {}
+        self.payloads = {}
+        self.free_rows = []
+        # Weighted row norms, recomputed after any change to the rows (IDF moves with them)
+        self.norms = None
+        self.loaded_at = None
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.rows)
+
+    def vector(self, fields):
+        """Term-frequency vector of [(text, weight), ...]"""
+        counts = {}
+        for text, weight in fields:
+            words = tokens(text)
+            for position, word in enumerate(words):
+                features = [("w:" + word, weight)]
+                if position + 1 < len(words):
+                    features.append(("b:" + word + " " + words[position + 1], weight))
+                padded = f" {word} "
+                trigrams = [padded[i:i + 3] for i in range(len(padded) - 2)]
+                # A word's trigrams together count TRIGRAM_WEIGHT of the word, however long it is
+                features.extend(("c:" + trigram, weight * TRIGRAM_WEIGHT / len(trigrams)) for trigram in trigrams)
+                for feature, amount in features:
+                    index = bucket(feature, self.dimensions)
+                    counts[index] = counts.get(index, 0.0) + amount
+        vector = np.zeros(self.dimensions, dtype=np.float32)
+        for index, count in counts.items():
+            vector[index] = 1.0 + math.log(count) if count >= 1.0 else count
+        return vector
+
+    def upsert(self, doc_id, fields, payload=None):
+        vector = self.vector(fields)
+        with self.lock:
+            row = self.rows.get(doc_id)
+            if row is None:
+                row = self._allocate_row(doc_id)
+            else:
+                self.document_frequency -= self.matrix[row] > 0
+            self.matrix[row] = vector
+            self.document_frequency += vector > 0
+            self.payloads[doc_id] = payload
+            self.norms = None
+
+    def remove(self, doc_id):
+        with self.lock:
+            row = self.rows.pop(doc_id, None)
+            if row is None:
+                return
+            self.document_frequency -= self.matrix[row] > 0
+            self.matrix[row] = 0.0
+            self.row_ids[row] = None
+            self.payloads.pop(doc_id, None)
+            self.free_rows.append(row)
+            self.norms = None
+
+    def load(self, documents):
+        """Replace every document with (id, fields, payload) triples"""
+        vectors = [(doc_id, self.vector(fields), payload) for doc_id, fields, payload in documents]
+        with self.lock:
+            self.matrix = np.zeros((max(len(vectors), 1), self.dimensions), dtype=np.float32)
+            self.row_ids, self.rows, self.payloads, self.free_rows = [], {}, {}, []
+            for doc_id, vector, payload in vectors:
+                row = self._allocate_row(doc_id)
+                self.matrix[row] = vector
+                self.payloads[doc_id] = payload
+            self.document_frequency = (self.matrix > 0).sum(axis=0).astype(np.float64)
+            self.norms = None
+            self.loaded_at = time.monotonic()
+
+    def _allocate_row(self, doc_id):
+        if self.free_rows:
+            row = self.free_rows.pop()
+            self.row_ids[row] = doc_id
+        else:
+            row = len(self.row_ids)
+            if row == len(self.matrix):
+                grown = np.zeros((len(self.matrix) * 2, self.dimensions), dtype=np.float32)
+                grown[:row] = self.matrix
+                self.matrix = grown
+            self.row_ids.append(doc_id)
+        self.rows[doc_id] = row
+        return row
+
+    def search(self, queries, k=5, min_score=0.0):
+        """For each query text, up to k (id, score, payload) by descending cosine similarity"""
+        query_vectors = np.stack([self.vector([(query, 1.0)]) for query in queries]) if queries else None
+        with self.lock:
+            used = len(self.row_ids)
+            if not self.rows or query_vectors is None:
+                return [[] for _ in queries]
+            idf = np.log((1.0 + len(self.rows)) / (1.0 + self.document_frequency)) + 1.0
+            weights = (idf * idf).astype(np.float32)
+            matrix = self.matrix[:used]
+            if self.norms is None:
+                self.norms = np.sqrt(np.einsum("ij,ij,j->i", matrix, matrix, weights))
+            norms = self.norms
+            # Only the buckets some query uses contribute to a dot product
+            columns = np.flatnonzero(query_vectors.any(axis=0))
+            scores = matrix[:, columns] @ (query_vectors[:, columns] * weights[columns]).T
+            query_norms = np.sqrt((query_vectors * query_vectors) @ weights)
+            row_ids = self.row_ids[:used]
+            payloads = self.payloads
+        with np.errstate(divide="ignore", invalid="ignore"):
+            scores = scores / np.outer(norms, query_norms)
+        scores = np.nan_to_num(scores, nan=0.0, posinf=0.0, neginf=0.0)
+        results = []
+        for position in range(len(queries)):
+            column = scores[:, position]
+            top = np.argpartition(-column, min(k, used) - 1)[:k] if used > k else np.arange(used)
+            top = top[np.argsort(-column[top])]
+            results.append([
+                (row_ids[row], float(column[row]), payloads.get(row_ids[row]))
+                for row in top if row_ids[row] is not None and column[row] > min_score
+            ])
+        return results
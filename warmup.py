@@ -0,0 +1,152 @@
+# warmup.py
+#
+# Startup warm-up run from main.py's lifespan hook: opens the Shopify and
+# OpenAI connection pools, creates the OpenAI client and prefetches hot
+# products into the product caches before /ready reports ready.
+#
+# Hot products come from HOT_PRODUCTS (comma-separated SKUs or names) and,
+# with HOT_PRODUCTS_FROM_LOG=N, the N products fetched most often in the
+# query log (HOT_PRODUCTS_LOG_PATH, defaulting to QUERY_LOG_PATH).
+
+import os
+import time
+import logging
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+import query_log
+import chatbot_api
+from resilience import request_budget
+
+logger = logging.getLogger(__name__)
+
+WARMUP_CONNECTIONS = int(os.getenv("WARMUP_CONNECTIONS", "4"))
+WARMUP_BUDGET_SECONDS = float(os.getenv("WARMUP_BUDGET_SECONDS", "60"))
+HOT_PRODUCTS = [p.strip() for p in os.getenv("HOT_PRODUCTS", "").split(",") if p.strip()]
+HOT_PRODUCTS_FROM_LOG = int(os.getenv("HOT_PRODUCTS_FROM_LOG", "0"))
+HOT_PRODUCTS_LOG_PATH = os.getenv("HOT_PRODUCTS_LOG_PATH") or query_log.QUERY_LOG_PATH
+
+SHOP_PING_QUERY = "{ shop { name } }"
+
+
+class WarmupStatus:
+    def __init__(self):
+        self.ready = False
+        self.started_at = None
+        self.seconds = None
+        self.prefetched = 0
+        self.errors = []
+        self.lock = threading.Lock()
+
+    def error(self, message):
+        logger.warning("warm-up: %s", message)
+        with self.lock:
+            self.errors.append(message)
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "status": "ready" if self.ready else "warming",
+                "warmup_seconds": self.seconds,
+                "prefetched_products": self.prefetched,
+                "errors": list(self.errors),
+            }
+
+
+def hot_product_gids_from_log(path, limit):
+    """Most frequently fetched product ids in a query log"""
+    counts = Counter()
+    for entry in query_log.read_log(path):
+        for event in entry.get("upstream", []):
+            if event["kind"] != "shopify":
+                continue
+            product = ((event.get("response") or {}).get("data") or {}).get("product") or {}
+            if product.get("id"):
+                counts[product["id"]] += 1
+    return [gid for gid, _ in counts.most_common(limit)]
+
+
+def warm_shopify_pool(status, connections):
+    def ping(_):
+        chatbot_api.run_shopify_query(SHOP_PING_QUERY, operation="warmup")
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        for future in [pool.submit(ping, n) for n in range(connections)]:
+            try:
+                future.result()
+            except Exception as e:
+                status.error(f"Shopify pool: {e}")
+                break
+
+
+def warm_openai_pool(status, connections):
+    # Creating the client is the expensive part; listing models opens TLS connections without spending tokens
+    client = chatbot_api.model_router.client.with_options(timeout=5)
+
+    with ThreadPoolExecutor(max_workers=connections) as pool:
+        for future in [pool.submit(client.models.list) for _ in range(connections)]:
+            try:
+                future.result()
+            except Exception as e:
+                status.error(f"OpenAI pool: {e}")
+                break
+
+
+def prefetch_hot_products(status, names, gids):
+    gids = list(gids)
+    for name in names:
+        try:
+            edges = chatbot_api.search_products(name).get("data", {}).get("products", {}).get("edges", [])
+        except Exception as e:
+            status.error(f"search {name!r}: {e}")
+            continue
+        if edges:
+            gids.append(edges[0]["node"]["id"])
+
+    def prefetch(gid):
+        # No requested fields means the full selection, so any later question is served from cache
+        chatbot_api.fetch_product_details_by_gid(gid)
+
+    with ThreadPoolExecutor(max_workers=WARMUP_CONNECTIONS) as pool:
+        futures = {pool.submit(prefetch, gid): gid for gid in dict.fromkeys(gids)}
+        for future, gid in futures.items():
+            try:
+                future.result()
+                with status.lock:
+                    status.prefetched += 1
+            except Exception as e:
+                status.error(f"prefetch {gid}: {e}")
+
+
+def run_warmup(status):
+    status.started_at = time.monotonic()
+    # The default store's; other stores map theirs on first use
+    chatbot_api.current_snapshot()
+    with request_budget(WARMUP_BUDGET_SECONDS):
+        warm_shopify_pool(status, WARMUP_CONNECTIONS)
+        warm_openai_pool(status, WARMUP_CONNECTIONS)
+        if chatbot_api.VECTOR_SEARCH:
+            try:
+                chatbot_api.load_vector_index(chatbot_api.current_store())
+            except Exception as e:
+                status.error(f"vector index: {e}")
+        # With a snapshot, dimensions come from it
+        if chatbot_api.current_snapshot() is None:
+            try:
+                chatbot_api.load_dimension_index(chatbot_api.current_store())
+            except Exception as e:
+                status.error(f"dimension index: {e}")
+
+        gids = []
+        if HOT_PRODUCTS_FROM_LOG and HOT_PRODUCTS_LOG_PATH and os.path.exists(HOT_PRODUCTS_LOG_PATH):
+            try:
+                gids = hot_product_gids_from_log(HOT_PRODUCTS_LOG_PATH, HOT_PRODUCTS_FROM_LOG)
+            except Exception as e:
+                status.error(f"reading {HOT_PRODUCTS_LOG_PATH}: {e}")
+        prefetch_hot_products(status, HOT_PRODUCTS, gids)
+
+    status.seconds = round(time.monotonic() - status.started_at, 3)
+    # Upstream errors are reported on /ready but do not hold readiness back
+    status.ready = True
+    logger.info("warm-up finished in %ss, %s products prefetched", status.seconds, status.prefetched)